@@ -0,0 +1,378 @@
+"""
+asyncio interface
+
+Asynchronous versions of the download, install, update and loading functions
+so that many operations can be driven concurrently from a single event loop.
+Downloads use a minimal HTTP/1.1 client built on ``asyncio`` streams,
+while disk-bound steps (extraction, local copies, parsing) run in the default executor.
+
+The number of concurrent operations is bounded by a semaphore and cancelling a task
+removes any partial file or staging directory it had created.
+The install locks are polled from the event loop, so that waiting for a lock never
+takes a thread of the executor.
+Note that blocking steps already running in the executor (e.g., the extraction of a tarball)
+finish before the cancellation takes effect.
+
+Example
+-------
+
+>>> from lhapdf_management import aio
+>>> results = asyncio.run(aio.install_pdfs(["CT18NNLO", "NNPDF40_nnlo_as_01180"]))
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+import fcntl
+import hashlib
+import logging
+from pathlib import Path
+import shutil
+import ssl
+import tempfile
+import time
+import urllib.parse
+
+from . import management, manifest, profiling, usage
+from .configuration import environment
+from .net_utilities import (
+    DEFAULT_TIMEOUT,
+    Download,
+    _byte_print,
+    _copy_file,
+    _local_source_path,
+    _temporary_path,
+    _update_ranking,
+    rank_sources,
+)
+from .pdfsets import TARBALL_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+# Seconds between attempts to acquire an install lock held by somebody else
+LOCK_POLL_INTERVAL = 0.1
+_CHUNK_SIZE = 1024**2
+_MAX_REDIRECTS = 5
+
+
+class HTTPError(OSError):
+    """The server answered with an error status"""
+
+    def __init__(self, url, status, reason):
+        super().__init__(f"HTTP Error {status}: {reason} ({url})")
+        self.status = status
+
+
+async def _run(function, *args, **kwargs):
+    """Run a blocking function in the default executor.
+    If the task is cancelled, wait for the function to finish before propagating the
+    cancellation so that the cleanup never races with the function"""
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(None, lambda: function(*args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+@asynccontextmanager
+async def _limit(semaphore):
+    """Acquire the semaphore, if any"""
+    if semaphore is None:
+        yield
+    else:
+        async with semaphore:
+            yield
+
+
+async def _open_url(url, timeout=DEFAULT_TIMEOUT, method="GET"):
+    """Send a request and read the headers of the response, following redirections
+
+    Returns the reader and writer of the connection, the status and the headers
+    """
+    for _ in range(_MAX_REDIRECTS + 1):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported url: {url}")
+        https = parsed.scheme == "https"
+        port = parsed.port or (443 if https else 80)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                parsed.hostname, port, ssl=ssl.create_default_context() if https else None
+            ),
+            timeout,
+        )
+        try:
+            path = parsed.path or "/"
+            if parsed.query:
+                path += f"?{parsed.query}"
+            request = (
+                f"{method} {path} HTTP/1.1\r\nHost: {parsed.netloc}\r\n"
+                "User-Agent: lhapdf-management\r\nAccept-Encoding: identity\r\n"
+                "Connection: close\r\n\r\n"
+            )
+            writer.write(request.encode())
+            await writer.drain()
+            raw_headers = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        except BaseException:
+            writer.close()
+            raise
+        status_line, *header_lines = raw_headers.decode("latin-1").split("\r\n")
+        _, status, *reason = status_line.split(" ", 2)
+        status = int(status)
+        headers = {}
+        for line in header_lines:
+            key, sep, value = line.partition(":")
+            if sep:
+                headers[key.strip().lower()] = value.strip()
+
+        if status in (301, 302, 303, 307, 308) and "location" in headers:
+            writer.close()
+            url = urllib.parse.urljoin(url, headers["location"])
+            continue
+        if status >= 400:
+            writer.close()
+            raise HTTPError(url, status, " ".join(reason))
+        return reader, writer, status, headers
+    raise HTTPError(url, status, "Too many redirections")
+
+
+async def _iter_body(reader, headers, timeout=DEFAULT_TIMEOUT):
+    """Iterate over the chunks of the body of a response"""
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size_line = await asyncio.wait_for(reader.readline(), timeout)
+            size = int(size_line.split(b";")[0], 16)
+            if size == 0:
+                return
+            yield await asyncio.wait_for(reader.readexactly(size), timeout)
+            await reader.readline()
+    remaining = int(headers["content-length"]) if "content-length" in headers else None
+    while remaining is None or remaining > 0:
+        size = _CHUNK_SIZE if remaining is None else min(_CHUNK_SIZE, remaining)
+        chunk = await asyncio.wait_for(reader.read(size), timeout)
+        if not chunk:
+            if remaining:
+                raise ConnectionError("Connection closed before the end of the download")
+            return
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+
+async def _download_url(url, dest_path, timeout=DEFAULT_TIMEOUT):
+    """Download a file from a url through a temporary file next to the destination.
+    Returns the number of bytes downloaded and the sha256 of the file"""
+    tmp_dest = _temporary_path(dest_path)
+    span = profiling.span("download", source=url)
+    try:
+        with span:
+            reader, writer, _, headers = await _open_url(url, timeout)
+            nbytes = 0
+            file_hash = hashlib.sha256()
+            try:
+                with tmp_dest.open("wb") as tmp_file:
+                    async for chunk in _iter_body(reader, headers, timeout):
+                        tmp_file.write(chunk)
+                        file_hash.update(chunk)
+                        nbytes += len(chunk)
+            finally:
+                writer.close()
+            span.set(bytes=nbytes)
+        logger.info("%s [%s]", url, _byte_print(nbytes))
+        tmp_dest.replace(dest_path)
+    finally:
+        tmp_dest.unlink(missing_ok=True)
+    return nbytes, file_hash.hexdigest()
+
+
+async def download_magic(target_name, destination, timeout=DEFAULT_TIMEOUT):
+    """Asynchronous version of ``net_utilities.download_magic``:
+    download (or copy) ``target_name`` from the fastest source to ``destination``.
+
+    Returns a ``Download`` object (False if the download failed)
+    """
+    dest_dir = Path(destination)
+    dest_dir.mkdir(exist_ok=True, parents=True)
+    dest_path = dest_dir / target_name
+
+    errors = []
+    for source in await _run(rank_sources, timeout):
+        source_path = _local_source_path(source)
+        if source_path is not None:
+            try:
+                await _run(_copy_file, source_path / target_name, dest_path)
+                return Download((source_path / target_name).as_posix(), dest_path.stat().st_size)
+            except FileNotFoundError:
+                errors.append(f"{source} not found")
+                continue
+
+        url = source + target_name
+        try:
+            start = time.perf_counter()
+            nbytes, sha256 = await _download_url(url, dest_path, timeout)
+            elapsed = time.perf_counter() - start
+            if elapsed > 0:
+                _update_ranking(source, throughput=nbytes / elapsed)
+            return Download(url, nbytes, sha256)
+        except HTTPError as e:
+            # The source is alive, but cannot provide the target
+            errors.append(f"Unable to download from {url}: {e}")
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            errors.append(f"Unable to download from {url}: {e}")
+            _update_ranking(source, healthy=False)
+    for error in errors:
+        logger.error(error)
+    return False
+
+
+@asynccontextmanager
+async def _install_lock(target_path, name):
+    """Asynchronous version of ``management._install_lock`` (and compatible with it):
+    the lock is polled so that waiting never blocks the loop nor a thread of the executor.
+    Yields whether the lock was held by somebody else and we had to wait for it.
+    """
+    lock_path = target_path / f".{name}.lock"
+    with lock_path.open("a") as lock_file:
+        waited = False
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not waited:
+                    logger.info("Waiting for another process installing %s", name)
+                waited = True
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield waited
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+async def install_pdf(
+    name,
+    upgrade=False,
+    keep=False,
+    target_path=None,
+    archive_only=False,
+    link_mode=None,
+    jobs=management.DEFAULT_JOBS,
+    members=None,
+    semaphore=None,
+):
+    """Asynchronous version of ``management.install_pdf`` (download, extract, move into place),
+    the quota (if any) is enforced after the installation.
+
+    Partial installations (``members``) and links to local sources (``link_mode``)
+    are only supported by ``management.install_pdf``, a ValueError is raised otherwise.
+
+    Parameters
+    ----------
+        name: str
+            name of the PDF set
+        upgrade: bool
+            reinstall the set even if it is already installed
+        keep: bool
+            keep the tarball next to the installed set
+        target_path: Path
+            folder in which to install the PDF, by default ``environment.datapath``
+        archive_only: bool
+            keep only the tarball without extracting it
+        jobs: int
+            number of writer threads used for the extraction
+        semaphore: asyncio.Semaphore
+            bounds the number of concurrent operations
+
+    Returns
+    -------
+        success: bool
+    """
+    if members is not None or link_mode is not None:
+        raise ValueError("Partial or linked installations are only supported by management")
+    if target_path is None:
+        target_path = environment.datapath
+    target_path = Path(target_path)
+    tarname = f"{name}{TARBALL_SUFFIX}"
+    final_folder = target_path / tarname if archive_only else target_path / name
+
+    if upgrade and final_folder.is_dir():
+        if (manifest.read_manifest(final_folder) or {}).get("members") is not None:
+            raise ValueError(f"{name} is a partial installation, upgrade it with management")
+    if not upgrade:
+        if (target_path / name).exists() or final_folder.exists():
+            logger.error("The PDF %s already exists at %s", name, target_path)
+            return False
+
+    async with _limit(semaphore):
+        target_path.mkdir(exist_ok=True, parents=True)
+        async with _install_lock(target_path, name) as waited:
+            # Another process might have installed the PDF since the check above
+            if (waited or not upgrade) and final_folder.exists():
+                logger.info("The PDF %s has been installed by another process", name)
+                return True
+            staging = Path(tempfile.mkdtemp(prefix=f".{name}.", dir=target_path))
+            try:
+                download = await download_magic(tarname, staging)
+                if not download:
+                    logger.error("Unable to download the %s PDF", name)
+                    return False
+                if archive_only:
+                    (staging / tarname).replace(final_folder)
+                else:
+                    files, tarball_hash = await _run(
+                        management._extract_tarball,
+                        staging / tarname,
+                        staging,
+                        jobs=jobs,
+                        sha256=download.sha256,
+                    )
+                    if not (staging / name).is_dir():
+                        raise FileNotFoundError(f"The tarball {tarname} does not contain {name}")
+                    await _run(
+                        management._write_set_manifest,
+                        staging / name,
+                        files,
+                        download.source,
+                        tarball_hash,
+                    )
+                    management._move_into_place(staging / name, final_folder, staging)
+                    if keep:
+                        (staging / tarname).replace(target_path / tarname)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+        # Make space for the new set if a quota has been set
+        await _run(usage.enforce_quota, target_path, exclude=(name,))
+    return True
+
+
+async def install_pdfs(names, concurrency=DEFAULT_CONCURRENCY, **kwargs):
+    """Install concurrently several PDF sets, with at most ``concurrency`` installations
+    running at the same time. Returns a dictionary {name: success}"""
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(
+        *(install_pdf(name, semaphore=semaphore, **kwargs) for name in names)
+    )
+    return dict(zip(names, results))
+
+
+async def update_reference_file(semaphore=None):
+    """Asynchronous version of ``management.update_reference_file``"""
+    async with _limit(semaphore):
+        if await download_magic(environment.index_filename, environment.datapath):
+            return True
+    logger.error("Unable to update the index reference file")
+    return False
+
+
+async def load(set_info, semaphore=None, record=True):
+    """Asynchronous version of ``SetInfo.load``, the info file of the PDF is already parsed"""
+
+    def _load():
+        pdf = set_info.load(record=record)
+        pdf.info
+        return pdf
+
+    async with _limit(semaphore):
+        return await _run(_load)
@@ -0,0 +1,293 @@
+"""
+Catalog of the metadata of the installed PDF sets
+
+The content of the .info file of every installed set is stored in an sqlite database
+(in the datapath) with one indexed row per key so that the installed sets can be queried
+without reading any .info file.
+The catalog is refreshed incrementally: only the sets whose .info file (or tarball)
+has changed since the last refresh are parsed again.
+
+Queries are written as ``Key OP value`` conditions, combined with ``and``, ``or``, ``not``
+and parentheses, where ``OP`` is one of ``=, !=, <, <=, >, >=`` or ``~`` (glob match), e.g.,
+
+>>> from lhapdf_management.catalog import query
+>>> query("ErrorType=replicas and NumMembers>100 and AlphaS_MZ=0.118")
+"""
+
+import json
+import logging
+from pathlib import Path, PurePosixPath
+import re
+import sqlite3
+import tarfile
+
+import yaml
+
+from .configuration import environment
+from .pdfsets import TARBALL_SUFFIX, PDF
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILENAME = ".catalog.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sets (
+    name TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    info TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fields (
+    name TEXT NOT NULL REFERENCES sets(name) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    text_value TEXT,
+    num_value REAL
+);
+CREATE INDEX IF NOT EXISTS fields_num ON fields (key, num_value);
+CREATE INDEX IF NOT EXISTS fields_text ON fields (key, text_value);
+CREATE INDEX IF NOT EXISTS fields_name ON fields (name);
+"""
+
+_OPERATORS = ("<=", ">=", "!=", "=", "<", ">", "~")
+_TOKEN = re.compile(
+    r"""\s*(?:
+        (?P<paren>[()])
+        |(?P<keyword>and|or|not)(?![\w.])
+        |(?P<key>[A-Za-z_][\w.]*)\s*(?P<op><=|>=|!=|=|<|>|~)\s*
+            (?P<value>"[^"]*"|'[^']*'|[^\s()<>=!~][^\s()]*)
+    )""",
+    re.VERBOSE | re.IGNORECASE,
+)
+
+
+def _installed_sets():
+    """Find all installed sets, {name: path}, the first path of the environment has priority"""
+    found = {}
+    for data_path in environment.paths:
+        candidates = [i.parent for i in data_path.glob("*/*.info") if i.stem == i.parent.name]
+        candidates += list(data_path.glob(f"*{TARBALL_SUFFIX}"))
+        for path in candidates:
+            name = path.name[: -len(TARBALL_SUFFIX)] if path.is_file() else path.name
+            found.setdefault(name, path)
+    return found
+
+
+def _fingerprint(path):
+    """(mtime_ns, size) of the file that determines the metadata of a set"""
+    if path.is_dir():
+        path = path / f"{path.name}.info"
+    stat = path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _read_info(path):
+    """Content of the .info file of a set. Tarballs are read only up to their .info member"""
+    if path.is_dir():
+        return PDF(path, record=False).info
+    name = path.name[: -len(TARBALL_SUFFIX)]
+    with tarfile.open(path, "r|gz") as tar_file:
+        for member in tar_file:
+            if member.isfile() and PurePosixPath(member.name).name == f"{name}.info":
+                return yaml.safe_load(tar_file.extractfile(member).read())
+    raise FileNotFoundError(f"No info file found for {name}")
+
+
+def _field_rows(name, info):
+    """Rows of the fields table for the given info dictionary"""
+    rows = []
+    for key, value in info.items():
+        num_value = None
+        if isinstance(value, (int, float)):
+            num_value = float(value)
+        text_value = value if isinstance(value, str) else json.dumps(value, default=str)
+        rows.append((name, key, text_value, num_value))
+    return rows
+
+
+class _Parser:
+    """Translate a query into an SQL condition over the sets table (and its parameters)"""
+
+    def __init__(self, where):
+        self._tokens = []
+        position = 0
+        where = where.strip()
+        while position < len(where):
+            match = _TOKEN.match(where, position)
+            if match is None or match.end() == position:
+                raise ValueError(f"Cannot parse the query at: {where[position:]}")
+            self._tokens.append(match)
+            position = match.end()
+            while position < len(where) and where[position].isspace():
+                position += 1
+        self._position = 0
+        self.params = []
+
+    def _peek(self, kind, value=None):
+        if self._position >= len(self._tokens):
+            return False
+        token = self._tokens[self._position].group(kind)
+        return token is not None and (value is None or token.lower() == value)
+
+    def _next(self):
+        self._position += 1
+        return self._tokens[self._position - 1]
+
+    def parse(self):
+        sql = self._or()
+        if self._position != len(self._tokens):
+            raise ValueError(f"Unexpected {self._tokens[self._position].group(0).strip()}")
+        return sql
+
+    def _or(self):
+        terms = [self._and()]
+        while self._peek("keyword", "or"):
+            self._next()
+            terms.append(self._and())
+        return " OR ".join(terms) if len(terms) == 1 else f"({' OR '.join(terms)})"
+
+    def _and(self):
+        terms = [self._not()]
+        while self._peek("keyword", "and"):
+            self._next()
+            terms.append(self._not())
+        return " AND ".join(terms) if len(terms) == 1 else f"({' AND '.join(terms)})"
+
+    def _not(self):
+        if self._peek("keyword", "not"):
+            self._next()
+            return f"NOT {self._not()}"
+        if self._peek("paren", "("):
+            self._next()
+            sql = self._or()
+            if not self._peek("paren", ")"):
+                raise ValueError("Unbalanced parentheses in the query")
+            self._next()
+            return f"({sql})"
+        if not self._peek("key"):
+            raise ValueError("Expected a condition of the form Key OP value")
+        return self._condition(self._next())
+
+    def _condition(self, token):
+        key, operator, value = token.group("key", "op", "value")
+        if value[0] in "\"'":
+            value = value[1:-1]
+            number = None
+        else:
+            try:
+                number = float(value)
+            except ValueError:
+                number = None
+
+        negate = operator == "!="
+        if negate:
+            operator = "="
+        if operator == "~":
+            column, comparison = "text_value", "GLOB"
+        elif number is not None:
+            column, comparison, value = "num_value", operator, number
+        else:
+            column, comparison = "text_value", operator
+        self.params += [key, value]
+        sql = (
+            "EXISTS (SELECT 1 FROM fields WHERE fields.name = sets.name "
+            f"AND fields.key = ? AND fields.{column} {comparison} ?)"
+        )
+        return f"NOT {sql}" if negate else sql
+
+
+def parse_where(where):
+    """Translate a query into an SQL condition and its parameters"""
+    parser = _Parser(where)
+    return parser.parse(), parser.params
+
+
+class Catalog:
+    """sqlite catalog of the metadata of the installed sets
+
+    Parameters
+    ----------
+        db_path: Path
+            database file, by default ``CATALOG_FILENAME`` in the datapath
+    """
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = environment.datapath / CATALOG_FILENAME
+        self.db_path = Path(db_path)
+        self._connection = sqlite3.connect(self.db_path)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        with self._connection:
+            self._connection.executescript(_SCHEMA)
+
+    def refresh(self):
+        """Update the catalog with the sets installed, removed or modified since the last refresh.
+        Returns the number of sets that have been (re)parsed"""
+        installed = _installed_sets()
+        known = {
+            name: (Path(path), mtime_ns, size)
+            for name, path, mtime_ns, size in self._connection.execute(
+                "SELECT name, path, mtime_ns, size FROM sets"
+            )
+        }
+
+        updated = 0
+        with self._connection:
+            removed = [(i,) for i in known if i not in installed]
+            self._connection.executemany("DELETE FROM sets WHERE name = ?", removed)
+            for name, path in installed.items():
+                try:
+                    fingerprint = _fingerprint(path)
+                except FileNotFoundError:
+                    continue
+                if known.get(name) == (path, *fingerprint):
+                    continue
+                try:
+                    info = _read_info(path) or {}
+                except Exception as e:
+                    logger.warning("Could not read the metadata of %s: %s", name, e)
+                    continue
+                self._connection.execute("DELETE FROM sets WHERE name = ?", (name,))
+                self._connection.execute(
+                    "INSERT INTO sets VALUES (?, ?, ?, ?, ?)",
+                    (name, path.as_posix(), *fingerprint, json.dumps(info, default=str)),
+                )
+                self._connection.executemany(
+                    "INSERT INTO fields VALUES (?, ?, ?, ?)", _field_rows(name, info)
+                )
+                updated += 1
+        logger.debug("Catalog refreshed: %d sets updated, %d removed", updated, len(removed))
+        return updated
+
+    def query(self, where=None):
+        """Names of the sets matching the query (all sets if no query is given)"""
+        sql = "SELECT name FROM sets"
+        params = []
+        if where:
+            condition, params = parse_where(where)
+            sql += f" WHERE {condition}"
+        return [i for (i,) in self._connection.execute(f"{sql} ORDER BY name", params)]
+
+    def info(self, name):
+        """Content of the .info file of the given set as stored in the catalog"""
+        row = self._connection.execute("SELECT info FROM sets WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(f"{name} is not in the catalog")
+        return json.loads(row[0])
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def query(where=None, refresh=True):
+    """Names of the installed sets matching the query, see ``Catalog.query``"""
+    with Catalog() as catalog:
+        if refresh:
+            catalog.refresh()
+        return catalog.query(where)
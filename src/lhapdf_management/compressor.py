@@ -0,0 +1,257 @@
+"""
+Compression of Monte Carlo PDF sets into a smaller set of representative replicas
+
+A subset of the replicas is selected such that its mean, standard deviation and
+correlations (between flavours and values of x at the initial scale) reproduce
+those of the full set.
+The distance between the two is measured by an error function normalised to its
+average over random subsets of the same size: 1 corresponds to a random selection.
+
+The selection is a search over swaps of replicas in which the statistics of the subset
+are updated incrementally and a batch of candidate swaps is evaluated at once.
+Several independent searches (with different seeds) run in parallel and the best one is kept.
+
+Example
+-------
+
+>>> from lhapdf_management.compressor import compress_replicas
+>>> small_pdf = compress_replicas(pdf, 100, "NNPDF40_nnlo_as_01180_100")
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from .configuration import environment
+from .pdfsets import GridPDF, write_pdf
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRIALS = 8
+DEFAULT_ITERATIONS = 2000
+# Number of candidate swaps evaluated at once
+SWAP_BATCH = 32
+# The correlations are computed for (at most) this many points in (x, flavour)
+CORRELATION_POINTS = 64
+# Number of random subsets used to normalise the error function
+_RANDOM_SUBSETS = 32
+
+
+@dataclass
+class Compression:
+    """Replicas selected by the compression and the error function of the selection"""
+
+    replicas: list
+    erf: float
+
+
+def _features(pdf, replicas):
+    """Values of all flavours at the x knots of the initial scale for every replica,
+    standardised with the mean and standard deviation of the full set"""
+    values = []
+    for replica in replicas:
+        first = pdf.get_member_grids(replica)[0]
+        # In LHAPDF files x is the outer loop and q the inner loop
+        grid = np.reshape(first.grid, (len(first.x), len(first.q2), -1))
+        values.append(grid[:, 0, :].ravel())
+    values = np.stack(values)
+    std = values.std(axis=0, ddof=1)
+    # Flavours which vanish at the initial scale (e.g., heavy quarks) carry no information
+    values = values[:, std > 0]
+    return (values - values.mean(axis=0)) / std[std > 0]
+
+
+class _ErrorFunction:
+    """Distance between the statistics of a subset of (standardised) replicas and the full set
+
+    Parameters
+    ----------
+        features: np.ndarray
+            standardised features of all replicas, (replicas, points)
+        nreplicas: int
+            size of the subsets
+    """
+
+    def __init__(self, features, nreplicas):
+        self.features = features
+        self.nreplicas = nreplicas
+        self.columns = np.unique(
+            np.linspace(0, features.shape[1] - 1, CORRELATION_POINTS).astype(int)
+        )
+        reduced = features[:, self.columns]
+        self.correlation = reduced.T @ reduced / (len(features) - 1)
+
+        # Normalise each component to its average over random subsets
+        self.norms = 1.0
+        rng = np.random.default_rng(0)
+        subsets = [
+            rng.choice(len(features), nreplicas, replace=False) for _ in range(_RANDOM_SUBSETS)
+        ]
+        self.norms = np.mean([self.components(self.sums(i)) for i in subsets], axis=0)
+
+    def sums(self, subset):
+        """Sum of the features, of their squares and of the outer products of the features
+        used for the correlations"""
+        features = self.features[subset]
+        reduced = features[:, self.columns]
+        return features.sum(axis=0), (features**2).sum(axis=0), reduced.T @ reduced
+
+    def components(self, sums):
+        """Distance of the mean, standard deviation and correlations to those of the full set.
+        The sums can have a leading dimension to evaluate several subsets at once"""
+        sum1, sum2, cross = sums
+        n = self.nreplicas
+        mean = sum1 / n
+        std = np.sqrt(np.maximum(sum2 - n * mean**2, 0.0) / (n - 1))
+
+        # The correlation matrix is built in place, this is the bulk of the cost
+        reduced_mean = mean[..., self.columns]
+        correlation = cross - n * np.einsum("...i,...j->...ij", reduced_mean, reduced_mean)
+        inverse_std = 1.0 / np.sqrt(np.diagonal(correlation, axis1=-2, axis2=-1))
+        correlation *= inverse_std[..., :, None]
+        correlation *= inverse_std[..., None, :]
+        correlation -= self.correlation
+
+        distances = [
+            np.mean(mean**2, axis=-1),
+            np.mean((std - 1.0) ** 2, axis=-1),
+            np.einsum("...ij,...ij->...", correlation, correlation) / len(self.columns) ** 2,
+        ]
+        return np.stack(distances, axis=-1) / self.norms
+
+    def __call__(self, sums):
+        return self.components(sums).sum(axis=-1) / 3.0
+
+
+def _search(error_function, iterations, seed):
+    """Search a subset of replicas minimising the error function starting from a random one.
+    At every step a batch of random swaps is evaluated and the best one kept if it improves.
+
+    Returns
+    -------
+        subset: np.ndarray
+            indices of the selected replicas
+        erf: float
+    """
+    rng = np.random.default_rng(seed)
+    features = error_function.features
+    reduced = features[:, error_function.columns]
+    nreplicas = error_function.nreplicas
+
+    subset = rng.choice(len(features), nreplicas, replace=False)
+    selected = np.zeros(len(features), dtype=bool)
+    selected[subset] = True
+    sum1, sum2, cross = error_function.sums(subset)
+    best = error_function((sum1, sum2, cross))
+
+    for _ in range(iterations):
+        positions = rng.integers(nreplicas, size=SWAP_BATCH)
+        old = subset[positions]
+        new = rng.choice(np.flatnonzero(~selected), SWAP_BATCH)
+        candidates = (
+            sum1 + features[new] - features[old],
+            sum2 + features[new] ** 2 - features[old] ** 2,
+            cross
+            + np.einsum("bi,bj->bij", reduced[new], reduced[new])
+            - np.einsum("bi,bj->bij", reduced[old], reduced[old]),
+        )
+        erfs = error_function(candidates)
+        best_swap = np.argmin(erfs)
+        if erfs[best_swap] < best:
+            best = erfs[best_swap]
+            selected[old[best_swap]] = False
+            selected[new[best_swap]] = True
+            subset[positions[best_swap]] = new[best_swap]
+            sum1, sum2, cross = (i[best_swap] for i in candidates)
+
+    # Avoid any rounding error accumulated by the incremental updates
+    return np.sort(subset), float(error_function(error_function.sums(subset)))
+
+
+def select_replicas(
+    pdf, nreplicas, trials=DEFAULT_TRIALS, iterations=DEFAULT_ITERATIONS, jobs=None, seed=0
+):
+    """Select the subset of ``nreplicas`` replicas of a Monte Carlo set which best
+    reproduces the statistics of the full set
+
+    Parameters
+    ----------
+        pdf: PDF
+            Monte Carlo PDF set (``ErrorType: replicas``)
+        nreplicas: int
+            number of replicas to select
+        trials: int
+            number of independent searches, the best one is kept
+        iterations: int
+            number of steps of every search
+        jobs: int
+            number of processes running the searches (default: number of cpus)
+        seed: int
+            seed of the first search, the following ones use consecutive seeds
+
+    Returns
+    -------
+        compression: Compression
+    """
+    if pdf.error_type != "replicas":
+        raise ValueError(f"Only Monte Carlo sets can be compressed, {pdf.name} is {pdf.error_type}")
+    # Member 0 is the average of the replicas
+    replicas = pdf.members[1:]
+    if not 1 < nreplicas < len(replicas):
+        raise ValueError(f"Cannot select {nreplicas} out of {len(replicas)} replicas")
+
+    error_function = _ErrorFunction(_features(pdf, replicas), nreplicas)
+    seeds = range(seed, seed + trials)
+    if jobs == 1:
+        results = [_search(error_function, iterations, i) for i in seeds]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(
+                executor.map(_search, [error_function] * trials, [iterations] * trials, seeds)
+            )
+    subset, erf = min(results, key=lambda i: i[1])
+    logger.info("Selected %d replicas of %s (ERF: %.3f)", nreplicas, pdf.name, erf)
+    return Compression([replicas[i] for i in subset], erf)
+
+
+def compress_replicas(pdf, nreplicas, set_dir, jobs=None, **kwargs):
+    """Write down a new Monte Carlo set with the ``nreplicas`` replicas of ``pdf`` which best
+    reproduce its statistics (see ``select_replicas``, which receives any extra argument).
+    Member 0 of the new set is the average of the selected replicas.
+
+    Parameters
+    ----------
+        pdf: PDF
+            Monte Carlo PDF set
+        nreplicas: int
+            number of replicas of the new set
+        set_dir: Path or str
+            folder of the new set, a name is understood as a folder in ``environment.datapath``
+        jobs: int
+            number of processes used for the selection and for writing the members
+
+    Returns
+    -------
+        new_pdf: PDF
+    """
+    set_dir = Path(set_dir)
+    if set_dir.parent == Path("."):
+        set_dir = environment.datapath / set_dir
+    compression = select_replicas(pdf, nreplicas, jobs=jobs, **kwargs)
+
+    members = [pdf.get_member_grids(i) for i in compression.replicas]
+    central = [
+        GridPDF(subgrid.x, subgrid.q2, subgrid.flav, np.mean([i.grid for i in subgrids], axis=0))
+        for subgrid, *subgrids in zip(members[0], *members)
+    ]
+    info = {
+        **pdf.info,
+        "SetDesc": f"{pdf.description} (compressed to {nreplicas} replicas)",
+        "NumMembers": nreplicas + 1,
+        "CompressedFrom": pdf.name,
+        "CompressedReplicas": [int(i) for i in compression.replicas],
+    }
+    return write_pdf(set_dir, info, [central] + members, jobs=jobs)
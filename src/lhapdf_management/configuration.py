@@ -126,7 +126,8 @@ class _Environment:
         """Adds a source to the environment.
         By default new sources take priority.
         """
-        to_add = Path(new_source)
+        # Sources can be URLs, which cannot be stored as paths
+        to_add = str(new_source)
         if priority:
             self._sources.insert(0, to_add)
         else:
@@ -0,0 +1,106 @@
+"""
+Interpolation of the PDF grids for many members at once
+
+The grids of all members are stacked in a single array per subgrid so that
+every interpolation is done for all members (and all flavours) in one vectorized pass.
+The interpolation is linear in (log x, log q2) on xf(x, q2).
+Note that LHAPDF uses a (log) bicubic interpolation by default and so results
+can differ by an amount of the order of the grid resolution.
+Points outside of the grid are frozen to its boundaries.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class StackedSubgrid:
+    """The same subgrid for many members: the values are an array
+    of shape (members, x, q2, flavours)"""
+
+    x: np.ndarray
+    q2: np.ndarray
+    flav: np.ndarray
+    values: np.ndarray
+
+    @property
+    def q2_min(self):
+        return self.q2[0]
+
+    @property
+    def q2_max(self):
+        return self.q2[-1]
+
+
+def stack_members(pdf, members=None):
+    """Stack the grids of the given members of a PDF (by default, all of them)
+
+    Returns
+    -------
+        stack: list(StackedSubgrid)
+            one entry per subgrid
+    """
+    if members is None:
+        members = pdf.members
+    all_grids = [pdf.get_member_grids(i) for i in members]
+    stack = []
+    for subgrids in zip(*all_grids):
+        first = subgrids[0]
+        # In LHAPDF files x is the outer loop and q the inner loop
+        shape = (len(first.x), len(first.q2), -1)
+        values = np.stack([np.reshape(i.grid, shape) for i in subgrids])
+        stack.append(StackedSubgrid(first.x, first.q2, np.ravel(first.flav), values))
+    return stack
+
+
+def _weights(knots, points):
+    """Lower index and weight of the upper knot for a linear interpolation in log space"""
+    log_knots = np.log(knots)
+    log_points = np.clip(np.log(points), log_knots[0], log_knots[-1])
+    index = np.clip(np.searchsorted(log_knots, log_points, side="right") - 1, 0, len(knots) - 2)
+    weight = (log_points - log_knots[index]) / (log_knots[index + 1] - log_knots[index])
+    return index, weight
+
+
+def interpolate(stack, x, q2):
+    """Interpolate xf(x, q2) for all members and flavours in the stack
+
+    Parameters
+    ----------
+        stack: list(StackedSubgrid)
+            output of ``stack_members``
+        x: np.ndarray
+            values of x
+        q2: np.ndarray
+            values of q2, same shape as ``x``
+
+    Returns
+    -------
+        xf: np.ndarray
+            array of shape (members, *x.shape, flavours)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    q2 = np.broadcast_to(np.asarray(q2, dtype=np.float64), x.shape)
+    flat_x = x.ravel()
+    flat_q2 = np.clip(q2.ravel(), stack[0].q2_min, stack[-1].q2_max)
+    nmembers, _, _, nflav = stack[0].values.shape
+    result = np.empty((nmembers, flat_x.size, nflav))
+
+    pending = np.ones(flat_x.size, dtype=bool)
+    for subgrid in stack:
+        # Each point is assigned to the first subgrid containing its q2
+        selected = pending & (flat_q2 <= subgrid.q2_max)
+        if not selected.any():
+            continue
+        pending &= ~selected
+        ix, wx = _weights(subgrid.x, flat_x[selected])
+        iq, wq = _weights(subgrid.q2, flat_q2[selected])
+        values = subgrid.values
+        result[:, selected] = (
+            values[:, ix, iq] * ((1 - wx) * (1 - wq))[:, None]
+            + values[:, ix + 1, iq] * (wx * (1 - wq))[:, None]
+            + values[:, ix, iq + 1] * ((1 - wx) * wq)[:, None]
+            + values[:, ix + 1, iq + 1] * (wx * wq)[:, None]
+        )
+    return result.reshape(nmembers, *x.shape, nflav)
@@ -0,0 +1,161 @@
+"""
+Parton luminosities
+
+The luminosity for the channel ij at an invariant mass M and a center of mass energy sqrt(s) is
+
+    L_ij(M) = 1/s int_tau^1 dx/x f_i(x, M^2) f_j(tau/x, M^2),   tau = M^2/s
+
+which is computed as an integral over the rapidity with a Gauss-Legendre quadrature.
+All members and masses are computed in a single vectorized pass over the grids.
+
+Example
+-------
+
+>>> lumi = pdf.luminosity([100, 1000], sqrts=13000, channel="gg")
+>>> lumi.central, lumi.error_plus
+"""
+
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+
+from .interpolation import interpolate, stack_members
+
+DEFAULT_NODES = 64
+_GLUON = 21
+_QUARKS = (1, 2, 3, 4, 5, 6)
+
+
+@lru_cache(maxsize=None)
+def _gauss_legendre(nodes):
+    """Gauss-Legendre nodes and weights in [-1, 1]"""
+    return np.polynomial.legendre.leggauss(nodes)
+
+
+def _channel_matrix(channel, flavours):
+    """Matrix C such that the integrand of the luminosity is sum_ab C_ab xf_a(x1) xf_b(x2)
+
+    The channel can be a pair of PDG ids or one of
+    ``gg``, ``qg`` (quark or antiquark with gluon), ``qq`` (any two quarks or antiquarks)
+    and ``qqbar`` (quark with its antiquark)
+    """
+    flavours = [_GLUON if int(i) == 0 else int(i) for i in flavours]
+    index = {pdg: i for i, pdg in enumerate(flavours)}
+    quarks = [i for i in flavours if abs(i) in _QUARKS]
+    if isinstance(channel, str):
+        pairs = {
+            "gg": [(_GLUON, _GLUON)],
+            "qg": [(q, _GLUON) for q in quarks] + [(_GLUON, q) for q in quarks],
+            "qq": [(q1, q2) for q1 in quarks for q2 in quarks],
+            "qqbar": [(q, -q) for q in quarks if -q in index],
+        }.get(channel)
+        if pairs is None:
+            raise ValueError(f"Unknown luminosity channel: {channel}")
+    else:
+        pairs = [tuple(_GLUON if int(i) == 0 else int(i) for i in channel)]
+
+    matrix = np.zeros((len(flavours), len(flavours)))
+    for a, b in pairs:
+        if a in index and b in index:
+            matrix[index[a], index[b]] += 1.0
+    return matrix
+
+
+def compute_uncertainty(values, error_type):
+    """Central value and uncertainties of a quantity computed for every member of a set,
+    following the prescription of LHAPDF for the given ``ErrorType``
+
+    Parameters
+    ----------
+        values: np.ndarray
+            array whose first axis runs over all members of the set (member 0 first)
+        error_type: str
+            ``ErrorType`` of the set, (``replicas``, ``symmhessian``, ``hessian``)
+            possibly with parameter variations (e.g., ``replicas+as``) which are not included
+
+    Returns
+    -------
+        central, error_plus, error_minus: np.ndarray
+    """
+    values = np.asarray(values)
+    error_type, *parameters = (error_type or "none").split("+")
+    # Every parameter variation adds two members at the end of the set
+    error_members = values[1 : len(values) - 2 * len(parameters)]
+    central = values[0]
+
+    if error_type == "replicas":
+        central = error_members.mean(axis=0)
+        error = error_members.std(axis=0, ddof=1)
+        return central, error, error
+    if error_type == "symmhessian":
+        error = np.sqrt(np.sum((error_members - central) ** 2, axis=0))
+        return central, error, error
+    if error_type == "hessian":
+        up = error_members[0::2] - central
+        down = error_members[1::2] - central
+        zero = np.zeros_like(up)
+        error_plus = np.sqrt(np.sum(np.maximum.reduce([up, down, zero]) ** 2, axis=0))
+        error_minus = np.sqrt(np.sum(np.minimum.reduce([up, down, zero]) ** 2, axis=0))
+        return central, error_plus, error_minus
+    zero = np.zeros_like(central)
+    return central, zero, zero
+
+
+@dataclass
+class Luminosity:
+    """Result of a luminosity computation, ``values`` has shape (members, masses)"""
+
+    masses: np.ndarray
+    values: np.ndarray
+    central: np.ndarray
+    error_plus: np.ndarray
+    error_minus: np.ndarray
+
+
+def luminosity(pdf, masses, sqrts, channel="gg", nodes=DEFAULT_NODES):
+    """Compute the parton luminosity for all members of a PDF
+
+    Parameters
+    ----------
+        pdf: PDF
+            PDF set, all members need to be available
+        masses: list(float)
+            invariant masses (GeV)
+        sqrts: float
+            center of mass energy (GeV)
+        channel: str or (int, int)
+            partonic channel, see ``_channel_matrix``
+        nodes: int
+            number of quadrature nodes in rapidity
+
+    Returns
+    -------
+        lumi: Luminosity
+    """
+    if pdf.is_partial:
+        raise ValueError(f"Luminosities need all members of {pdf.name}, only some are installed")
+    masses = np.atleast_1d(np.asarray(masses, dtype=np.float64))
+    tau = (masses / sqrts) ** 2
+    if np.any(tau >= 1.0):
+        raise ValueError("The invariant masses must be smaller than the center of mass energy")
+
+    # x1 = sqrt(tau) e^y, x2 = sqrt(tau) e^-y, with |y| < -log(sqrt(tau))
+    y_max = -0.5 * np.log(tau)
+    unit_nodes, unit_weights = _gauss_legendre(nodes)
+    y = y_max[:, None] * unit_nodes
+    x1 = np.sqrt(tau)[:, None] * np.exp(y)
+    q2 = np.broadcast_to((masses**2)[:, None], y.shape)
+
+    stack = stack_members(pdf)
+    xf1 = interpolate(stack, x1, q2)
+    # The nodes are symmetric around 0, so x2 at every node is x1 at the opposite one
+    # and the interpolation is only done once
+    xf2 = xf1[:, :, ::-1]
+    matrix = _channel_matrix(channel, stack[0].flav)
+    # f_i(x1) f_j(x2) = xf_i xf_j / tau and dx1/x1 = dy
+    integrand = np.einsum("mnka,ab,mnkb->mnk", xf1, matrix, xf2, optimize=True)
+    values = (integrand @ unit_weights) * y_max / (tau * sqrts**2)
+
+    central, error_plus, error_minus = compute_uncertainty(values, pdf.error_type)
+    return Luminosity(masses, values, central, error_plus, error_minus)
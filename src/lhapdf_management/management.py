@@ -2,18 +2,47 @@
 LHAPDF management library
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import csv
+import ctypes
+import fcntl
+import hashlib
 import logging
+import os
 from pathlib import Path
+import shutil
 import tarfile
+import tempfile
+import threading
 
+import yaml
+
+from . import manifest, profiling, usage
 from .configuration import environment
-from .net_utilities import download_magic
-from .pdfsets import SetInfo
+from .net_utilities import (
+    clone_file,
+    download_magic,
+    find_local_source,
+    open_stream,
+    query_size,
+    rank_sources,
+)
+from .pdfsets import COMPRESSION_FORMATS, TARBALL_SUFFIX, SetInfo
 
 # Set up the logger
 logger = logging.getLogger(__name__)
 
+_CHUNK_SIZE = 1024**2
+
+# Default number of concurrent jobs for operations that run in parallel
+DEFAULT_JOBS = 8
+# Maximum amount of decompressed data waiting to be written during extraction
+EXTRACTION_MEMORY = 256 * 1024**2
+
+# Ways of installing a PDF set which is already unpacked in a local source
+LINK_MODES = ("symlink", "hardlink", "clone")
+
 
 ### Listing utilities
 def get_reference_list(filepath=None):
@@ -60,11 +89,36 @@ def get_installed_list():
     all_pdfs = []
     for data_path in environment.paths:
         all_pdfs += [i.stem for i in data_path.glob("*/*.info")]
+        # Sets installed in archive-only mode
+        all_pdfs += [i.name[: -len(TARBALL_SUFFIX)] for i in data_path.glob(f"*{TARBALL_SUFFIX}")]
     all_pdfs = set(all_pdfs)
     # Return the SetInfo objects for the installed PDFs that are in the index
     return [reference_pdfs[pdfname] for pdfname in all_pdfs if pdfname in reference_pdfs]
 
 
+def _installed_version(set_info):
+    """Version of an installed set, read from the install manifest when available
+    (which is cheaper than parsing the .info file)"""
+    pdf = set_info.load(record=False)
+    installed = manifest.read_manifest(pdf.path) if pdf.path.is_dir() else None
+    if installed is not None and installed.get("version") is not None:
+        return installed["version"]
+    return pdf.version
+
+
+def get_outdated_list():
+    """Returns a list of SetInfo objects representing installed PDF sets
+    for which a newer version is available in the index."""
+    outdated = []
+    for set_info in get_installed_list():
+        installed_version = _installed_version(set_info)
+        if set_info.version is None or installed_version is None:
+            continue
+        if set_info.version > installed_version:
+            outdated.append(set_info)
+    return outdated
+
+
 #####
 
 
@@ -76,48 +130,518 @@ def update_reference_file():
     return False
 
 
-def install_pdf(name, dry=False, upgrade=False, keep=False, target_path=None):
+def get_download_sizes(names, jobs=DEFAULT_JOBS):
+    """Query concurrently the size of the tarballs of the given PDFs
+
+    Returns a dictionary {name: RemoteSize}, the value is None for PDFs not found in any source.
+    """
+    tarnames = [f"{name}{TARBALL_SUFFIX}" for name in names]
+    # Rank the sources only once before spawning all queries
+    rank_sources()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(names, executor.map(query_size, tarnames)))
+
+
+@contextmanager
+def _install_lock(target_path, name):
+    """Exclusive (cross-process) lock for the installation of ``name`` in ``target_path``.
+    Yields whether the lock was held by another process and we had to wait for it.
+    """
+    # The lock file is never removed, removing it would allow two processes
+    # to hold a lock on different files
+    lock_path = target_path / f".{name}.lock"
+    with lock_path.open("a") as lock_file:
+        waited = False
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("Waiting for another process installing %s", name)
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            waited = True
+        try:
+            yield waited
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _exchange_paths(path_a, path_b):
+    """Atomically exchange two paths with renameat2(RENAME_EXCHANGE)
+    Returns False if not supported by the system"""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        return False
+    at_fdcwd, rename_exchange = -100, 2
+    ret = renameat2(
+        at_fdcwd, bytes(path_a), at_fdcwd, bytes(path_b), ctypes.c_uint(rename_exchange)
+    )
+    return ret == 0
+
+
+def _move_into_place(new_path, final_path, trash_dir):
+    """Move ``new_path`` to ``final_path`` so that the final path is never seen half-written.
+    If the final path already exists, it is moved to ``trash_dir``.
+    """
+    if not final_path.exists():
+        new_path.rename(final_path)
+    elif _exchange_paths(new_path, final_path):
+        # now the old version is in new_path, which lives in trash_dir
+        pass
+    else:
+        final_path.rename(trash_dir / f"{final_path.name}.old")
+        new_path.rename(final_path)
+
+
+def _link_set(source_dir, dest_dir, mode):
+    """Make the PDF set in ``source_dir`` available in ``dest_dir`` duplicating
+    as little data as possible.
+
+    mode: str
+        symlink: ``dest_dir`` is a symbolic link to ``source_dir``
+        hardlink: every file is hard-linked (cloned if that is not possible)
+        clone: every file is cloned (reflink or in-kernel copy if possible)
+    """
+    if mode == "symlink":
+        dest_dir.symlink_to(source_dir.resolve(), target_is_directory=True)
+        return
+    dest_dir.mkdir()
+    for source_file in source_dir.iterdir():
+        dest_file = dest_dir / source_file.name
+        if mode == "hardlink":
+            try:
+                os.link(source_file, dest_file)
+                continue
+            except OSError:
+                # e.g., across different filesystems
+                pass
+        clone_file(source_file, dest_file)
+        shutil.copystat(source_file, dest_file)
+
+
+def install_pdf(
+    name,
+    dry=False,
+    upgrade=False,
+    keep=False,
+    target_path=None,
+    archive_only=False,
+    link_mode=None,
+    jobs=DEFAULT_JOBS,
+    members=None,
+):
     """Install the named pdf
     Don't install if the PDF already exists (unless upgrade=True)
     If keep is true, do not remove the tarball.
     If dry is true, skip the download (and extract) step.
+    If archive_only is true, skip the extraction step and keep only the tarball,
+    which can be read directly by ``PDF`` (sets installed this way are always upgraded so).
+    If link_mode is one of ``LINK_MODES`` and the PDF is found unpacked in a local source
+    (e.g., CVMFS) it will be linked (or cloned) from there instead.
     The target path for the PDF installation can be explicitly declared, if None
     it will default to ``environment.datapath``.
+    The tarball is extracted using ``jobs`` writer threads.
+    If a list of members is given, only those members are installed
+    and the set is marked as partial in its manifest (upgrades keep the same members).
+
+    Concurrent installations of the same PDF (from different processes) are serialized:
+    the first process downloads and extracts the PDF in a staging directory and moves
+    it into place, the others wait and then find the PDF installed.
     """
     if target_path is None:
         target_path = environment.datapath
+    target_path = Path(target_path)
+
+    tarname = f"{name}{TARBALL_SUFFIX}"
+    final_folder = target_path / name
+    if upgrade and not final_folder.exists() and (target_path / tarname).is_file():
+        # Sets installed as archives are upgraded as archives
+        archive_only = True
+    if archive_only:
+        final_folder = target_path / tarname
+
+    if members is not None and (keep or archive_only):
+        raise ValueError("A selection of members cannot be installed as an archive nor kept")
+    if upgrade and members is None and final_folder.is_dir():
+        # Partial installations are upgraded with the same selection of members
+        members = (manifest.read_manifest(final_folder) or {}).get("members")
+        if members is not None and keep:
+            logger.warning("%s is a partial installation, the tarball will not be kept", name)
+            keep = False
 
     if not upgrade:
-        final_folder = target_path / name
-        if final_folder.exists():
-            logger.error("The PDF %s already exists at %s", name, environment.datapath)
+        if (target_path / name).exists() or final_folder.exists():
+            logger.error("The PDF %s already exists at %s", name, target_path)
             return False
 
-    # While I would prefer to download to a temporary folder, LHAPDF downloads directly
-    # to the target folder, and we want to reproduce LHAPDF's behaviour
-    tarname = f"{name}.tar.gz"
-    if download_magic(tarname, target_path, dry=dry):
-        if dry:
+    if dry:
+        if download_magic(tarname, target_path, dry=dry):
             return True
-        extract_tarball(target_path / tarname, target_path, keep_tarball=keep)
-        return True
-    logger.error("Unable to download the %s PDF", name)
-    return False
+        logger.error("Unable to download the %s PDF", name)
+        return False
 
+    target_path.mkdir(exist_ok=True, parents=True)
+    span = profiling.span("install", set=name)
+    with span, _install_lock(target_path, name) as waited:
+        span.set(waited=waited)
+        # Another process might have installed the PDF since the check above, even if
+        # the lock was already released when we asked for it
+        if (waited or not upgrade) and final_folder.exists():
+            logger.info("The PDF %s has been installed by another process", name)
+            return True
 
-def extract_tarball(tar_filename, dest_dir, keep_tarball=False):
-    """Extracts a given tarball to the destination directory"""
-    tar_filepath = Path(tar_filename)
+        # Download and extract in a staging directory in the same filesystem
+        staging = Path(tempfile.mkdtemp(prefix=f".{name}.", dir=target_path))
+        try:
+            extra = {}
+            local_set = find_local_source(name) if link_mode and not archive_only else None
+            local_tarball = find_local_source(tarname)
+            if members is not None:
+                files, source = _extract_members(name, members, staging, jobs=jobs)
+                # The tarball has not been read entirely
+                tarball_hash = None
+                extra["members"] = sorted(members)
+                local_set = None
+            elif local_set is not None and local_set.is_dir():
+                logger.debug("Installing %s from %s (%s)", name, local_set, link_mode)
+                _link_set(local_set, staging / name, link_mode)
+                source = local_set.as_posix()
+            elif local_tarball is not None and not (keep or archive_only):
+                # Extract directly from the (possibly read-only) source, without a copy
+                logger.debug("Extracting %s directly from %s", name, local_tarball)
+                files, tarball_hash = _extract_tarball(local_tarball, staging, jobs=jobs)
+                source = local_tarball.as_posix()
+            else:
+                download = download_magic(tarname, staging)
+                if not download:
+                    logger.error("Unable to download the %s PDF", name)
+                    return False
+                source = download.source
+                if not archive_only:
+                    files, tarball_hash = _extract_tarball(
+                        staging / tarname, staging, jobs=jobs, sha256=download.sha256
+                    )
+            span.set(source=source)
+            if archive_only:
+                (staging / tarname).replace(final_folder)
+            else:
+                if not (staging / name).is_dir():
+                    raise FileNotFoundError(f"The tarball {tarname} does not contain {name}")
+                if local_set is None or not local_set.is_dir():
+                    _write_set_manifest(staging / name, files, source, tarball_hash, **extra)
+                _move_into_place(staging / name, final_folder, staging)
+                if keep and (staging / tarname).exists():
+                    (staging / tarname).replace(target_path / tarname)
+                elif keep:
+                    logger.warning("No tarball of %s has been downloaded, nothing to keep", name)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+    # Make space for the new set if a quota has been set
+    usage.enforce_quota(target_path, exclude=(name,))
+    return True
+
+
+def _safe_path(dest_dir, member_name):
+    """Return the path of a member of a tarball inside ``dest_dir``, failing if
+    the member would end up outside of ``dest_dir``"""
+    # Links are never extracted so it is enough to normalize the path
+    dest_dir = os.path.abspath(dest_dir)
+    target = os.path.normpath(os.path.join(dest_dir, member_name))
+    if os.path.commonpath([dest_dir, target]) != dest_dir:
+        raise ValueError(f"The member {member_name} would be extracted outside of {dest_dir}")
+    return Path(target)
+
+
+class _MemoryBudget:
+    """Blocks the producer while more than ``limit`` bytes are waiting to be written.
+    A single item bigger than the limit is only accepted when nothing else is pending.
+    """
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._used == 0 or self._used + nbytes <= self._limit
+            )
+            self._used += nbytes
+
+    def release(self, nbytes):
+        with self._condition:
+            self._used -= nbytes
+            self._condition.notify_all()
+
+
+def _write_member(target, data, mode, mtime):
+    """Write down an extracted file, return its hash"""
+    with target.open("wb", buffering=0) as target_file:
+        target_file.write(data)
+    target.chmod(mode & 0o777)
+    os.utime(target, (mtime, mtime))
+    return hashlib.sha256(data).hexdigest()
+
+
+def _extract_stream(fileobj, dest_dir, jobs=DEFAULT_JOBS, wanted=None):
+    """Extracts a .tar.gz read as a stream from ``fileobj`` to the destination directory.
+
+    The tarball is decompressed in the calling thread while the files are
+    written (and hashed) by a pool of ``jobs`` writer threads.
+    The data waiting to be written is limited to ``EXTRACTION_MEMORY`` bytes.
+    Members which would end up outside of ``dest_dir`` are rejected.
+
+    If ``wanted`` is given, only the members in ``wanted`` are extracted and the stream
+    is abandoned as soon as all of them have been found.
+
+    Returns a dictionary {member name: sha256} for all extracted files
+    """
+    budget = _MemoryBudget(EXTRACTION_MEMORY)
+    futures = {}
+    span = profiling.span("extract")
+    extracted_bytes = 0
+
+    def _write(target, data, member):
+        try:
+            return _write_member(target, data, member.mode, member.mtime)
+        finally:
+            budget.release(len(data))
+
+    with span, ThreadPoolExecutor(jobs) as executor:
+        # Members are read in order, so the gzip stream only ever moves forward
+        with tarfile.open(fileobj=fileobj, mode="r:gz") as tar_file:
+            for member in tar_file:
+                if wanted is not None and member.name not in wanted:
+                    continue
+                target = _safe_path(dest_dir, member.name)
+                if member.isdir():
+                    target.mkdir(parents=True, exist_ok=True)
+                    continue
+                if not member.isfile():
+                    logger.warning("Skipping %s", member.name)
+                    continue
+                target.parent.mkdir(parents=True, exist_ok=True)
+                budget.acquire(member.size)
+                data = tar_file.extractfile(member).read()
+                extracted_bytes += len(data)
+                futures[member.name] = executor.submit(_write, target, data, member)
+                if wanted is not None and len(futures) == len(wanted):
+                    break
+        files = {name: future.result() for name, future in futures.items()}
+        span.set(bytes=extracted_bytes, files=len(files))
+    return files
+
+
+def _extract_tarball(tar_filepath, dest_dir, jobs=DEFAULT_JOBS, sha256=None):
+    """Extracts a given tarball to the destination directory, leaving the tarball untouched.
+    See ``_extract_stream``.
+    If the sha256 of the tarball is already known (e.g., computed while downloading it)
+    it is not computed again.
+
+    Returns a dictionary {member name: sha256} for all extracted files
+    and the sha256 of the tarball.
+    """
     if not tar_filepath.exists():
         raise FileNotFoundError(f"Cannot find the {tar_filepath}")
     try:
-        with tarfile.open(tar_filepath, "r:gz") as tar_file:
-            tar_file.extractall(dest_dir)
+        with tar_filepath.open("rb") as raw_file:
+            if sha256 is not None:
+                return _extract_stream(raw_file, dest_dir, jobs=jobs), sha256
+            reader = manifest.HashingReader(raw_file)
+            files = _extract_stream(reader, dest_dir, jobs=jobs)
+            reader.drain()
     except Exception as e:
         logging.error("Unable to extract %s to %s", tar_filepath, dest_dir)
         # Reraise the exception and don't continue!!
         raise e
+    return files, reader.hexdigest()
+
+
+def _extract_members(name, members, dest_dir, jobs=DEFAULT_JOBS):
+    """Extract only the .info file and the given members of a PDF set directly from
+    the stream of the tarball in the fastest source, without downloading the whole tarball
+    (as long as the selected members are found before the end of the tarball).
+
+    Returns a dictionary {member name: sha256} for all extracted files and the source
+    """
+    wanted = {f"{name}/{name}.info"}
+    wanted.update(f"{name}/{name}_{i:04d}.dat" for i in members)
+    source, stream = open_stream(f"{name}{TARBALL_SUFFIX}")
+    logger.debug("Extracting %d members of %s from %s", len(members), name, source)
+    with stream:
+        files = _extract_stream(stream, dest_dir, jobs=jobs, wanted=wanted)
+    missing = wanted.difference(files)
+    if missing:
+        raise FileNotFoundError(f"Members not found in {source}: {', '.join(sorted(missing))}")
+    return files, source
+
+
+def parse_members(members_spec):
+    """Parse a selection of members such as "0-99,120,200-210" into a sorted list of members"""
+    members = set()
+    for item in members_spec.split(","):
+        first, _, last = item.strip().partition("-")
+        last = last or first
+        members.update(range(int(first), int(last) + 1))
+    return sorted(members)
+
+
+def _write_set_manifest(set_dir, files, source, tarball_hash, **extra):
+    """Write the manifest of a freshly extracted PDF set, ``files`` contains the hashes
+    of all the files of the tarball, with paths relative to the extraction folder"""
+    prefix = f"{set_dir.name}/"
+    set_files = {k[len(prefix) :]: v for k, v in files.items() if k.startswith(prefix)}
+    info_file = set_dir / f"{set_dir.name}.info"
+    version = None
+    if info_file.exists():
+        version = yaml.safe_load(info_file.read_text()).get("DataVersion")
+    manifest.write_manifest(
+        set_dir, set_files, source=source, tarball_sha256=tarball_hash, version=version, **extra
+    )
+
+
+def extract_tarball(tar_filename, dest_dir, keep_tarball=False, jobs=DEFAULT_JOBS):
+    """Extracts a given tarball to the destination directory"""
+    tar_filepath = Path(tar_filename)
+    files, _ = _extract_tarball(tar_filepath, dest_dir, jobs=jobs)
     if keep_tarball:
         tar_filename.rename(dest_dir / tar_filename.name)
     else:
         tar_filepath.unlink()
+    return files
+
+
+def upgrade_pdfs(set_infos, jobs=DEFAULT_JOBS, keep=False):
+    """Upgrade concurrently the given installed PDF sets (a list of SetInfo)
+
+    Every set is upgraded in the folder in which it is installed and is swapped
+    atomically into place, so that readers never see a half-updated set.
+    Returns a dictionary {name: success}
+    """
+
+    def _upgrade(set_info):
+        target_path = set_info.load(record=False).path.parent
+        try:
+            return install_pdf(set_info.name, upgrade=True, keep=keep, target_path=target_path)
+        except Exception as e:
+            logger.error("Unable to upgrade %s: %s", set_info.name, e)
+            return False
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip([i.name for i in set_infos], executor.map(_upgrade, set_infos)))
+
+
+def _sync_file(source_file, dest_file):
+    """Mirror a single file, skipping it if it is already up to date (same size and mtime).
+    Hard links are preferred, then clones (reflink or in-kernel copy).
+    Returns whether the file was copied."""
+    source_stat = source_file.stat()
+    try:
+        dest_stat = dest_file.stat()
+        if (dest_stat.st_size, dest_stat.st_mtime_ns) == (
+            source_stat.st_size,
+            source_stat.st_mtime_ns,
+        ):
+            return False
+    except FileNotFoundError:
+        pass
+    tmp_file = dest_file.with_name(f".{dest_file.name}.staging")
+    tmp_file.unlink(missing_ok=True)
+    try:
+        try:
+            os.link(source_file, tmp_file)
+        except OSError:
+            # e.g., across different filesystems
+            clone_file(source_file, tmp_file)
+            shutil.copystat(source_file, tmp_file)
+        tmp_file.replace(dest_file)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+    return True
+
+
+def stage_pdfs(set_infos, destination, jobs=DEFAULT_JOBS):
+    """Mirror the given installed PDF sets (a list of SetInfo) to ``destination``
+    (e.g., node-local storage) and prepend ``destination`` to the paths of the environment
+    so that the sets are read from there.
+
+    Files are copied concurrently and files which are already up to date are skipped.
+    Returns the number of files copied.
+    """
+    destination = Path(destination)
+    destination.mkdir(exist_ok=True, parents=True)
+    to_sync = []
+    for set_info in set_infos:
+        source = set_info.load(record=False).path
+        if source.is_file():
+            # Sets installed in archive-only mode
+            to_sync.append((source, destination / source.name))
+            continue
+        dest_dir = destination / source.name
+        dest_dir.mkdir(exist_ok=True)
+        source_files = {i.name for i in source.iterdir() if i.is_file()}
+        # Remove files that no longer exist in the source
+        for stale_file in dest_dir.iterdir():
+            if stale_file.name not in source_files:
+                stale_file.unlink()
+        to_sync += [(source / i, dest_dir / i) for i in source_files]
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        ncopied = sum(executor.map(lambda i: _sync_file(*i), to_sync))
+    logger.info("Staged %d sets to %s (%d files updated)", len(set_infos), destination, ncopied)
+    environment.add_path(destination)
+    return ncopied
+
+
+def _compress_file(dat_file, compression):
+    """Compress a file in place (the original is removed once the compressed file is ready)
+    Returns the name of the new file and its hash"""
+    target = dat_file.with_name(f"{dat_file.name}.{compression}")
+    tmp_target = target.with_name(f".{target.name}.tmp")
+    try:
+        with dat_file.open("rb") as source:
+            with COMPRESSION_FORMATS[compression].open(tmp_target, "wb") as compressed:
+                shutil.copyfileobj(source, compressed, _CHUNK_SIZE)
+        tmp_target.replace(target)
+    finally:
+        tmp_target.unlink(missing_ok=True)
+    dat_file.unlink()
+    return target.name, manifest.hash_file(target)
+
+
+def compress_pdfs(set_dirs, compression="gz", jobs=DEFAULT_JOBS):
+    """Compress concurrently the .dat files of the given installed PDF sets
+    The manifests of the sets are updated accordingly.
+
+    Note that the resulting sets can only be read by lhapdf-management.
+    Returns the number of files compressed.
+    """
+    to_compress = [(i, dat_file) for i in set_dirs for dat_file in sorted(i.glob("*.dat"))]
+    changes = {i: ([], {}) for i in set_dirs}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        compressed = executor.map(lambda i: _compress_file(i[1], compression), to_compress)
+        for (set_dir, dat_file), (new_name, sha256) in zip(to_compress, compressed):
+            removed, added = changes[set_dir]
+            removed.append(dat_file.name)
+            added[new_name] = sha256
+
+    for set_dir, (removed, added) in changes.items():
+        manifest.replace_entries(set_dir, removed, added)
+    return len(to_compress)
+
+
+def verify_pdfs(set_dirs, jobs=DEFAULT_JOBS):
+    """Verify concurrently the given installed PDF sets against their manifests
+
+    Returns a dictionary {set_dir: list of problems}, with None for sets without a manifest.
+    """
+
+    def _verify(set_dir):
+        try:
+            return manifest.verify_set(set_dir)
+        except FileNotFoundError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(set_dirs, executor.map(_verify, set_dirs)))
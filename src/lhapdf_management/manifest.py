@@ -0,0 +1,144 @@
+"""
+Install manifests
+
+Upon installation a manifest containing the list of files of the PDF set
+(with their size, modification time and hash) together with the source of the installation
+is written to the folder of the PDF set.
+
+The manifest can then be used to verify the integrity of the installed set.
+Files whose size and modification time are unchanged are considered to be intact,
+the (expensive) hash is only computed when these don't match.
+"""
+
+import hashlib
+import json
+import logging
+from pathlib import Path
+import time
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = ".manifest.json"
+_CHUNK_SIZE = 1024**2
+
+
+class HashingReader:
+    """Wraps a binary file object and hashes all bytes read through it"""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._hash = hashlib.sha256()
+        self.nbytes = 0
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._hash.update(data)
+        self.nbytes += len(data)
+        return data
+
+    def drain(self):
+        """Read (and hash) whatever is left in the file"""
+        while self.read(_CHUNK_SIZE):
+            pass
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def hash_file(path):
+    """Compute the sha256 of a file"""
+    file_hash = hashlib.sha256()
+    with Path(path).open("rb") as hfile:
+        while chunk := hfile.read(_CHUNK_SIZE):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def manifest_path(set_dir):
+    return Path(set_dir) / MANIFEST_FILENAME
+
+
+def read_manifest(set_dir):
+    """Read the manifest of the set, return None if there is no manifest"""
+    try:
+        return json.loads(manifest_path(set_dir).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(set_dir, files, **metadata):
+    """Write down the manifest for the PDF set in ``set_dir``
+
+    Parameters
+    ----------
+        set_dir: Path
+            folder of the PDF set
+        files: dict
+            {filename: sha256} for all files of the set
+        metadata:
+            any extra information to be saved (source, version...)
+    """
+    set_dir = Path(set_dir)
+    file_entries = {}
+    for filename, sha256 in sorted(files.items()):
+        stat = (set_dir / filename).stat()
+        file_entries[filename] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": sha256,
+        }
+    manifest = {"created": time.time(), **metadata, "files": file_entries}
+    manifest_path(set_dir).write_text(json.dumps(manifest, indent=1))
+
+
+def replace_entries(set_dir, removed, added):
+    """Update the manifest of the set (if any) after some files have been replaced
+
+    Parameters
+    ----------
+        set_dir: Path
+            folder of the PDF set
+        removed: list(str)
+            files no longer part of the set
+        added: dict
+            {filename: sha256} for the new files of the set
+    """
+    set_dir = Path(set_dir)
+    manifest = read_manifest(set_dir)
+    if manifest is None:
+        logger.warning("No manifest found for %s, it cannot be updated", set_dir.name)
+        return
+    files = {k: v["sha256"] for k, v in manifest.pop("files").items() if k not in removed}
+    files.update(added)
+    manifest.pop("created", None)
+    write_manifest(set_dir, files, **manifest)
+
+
+def verify_set(set_dir):
+    """Verify the PDF set in ``set_dir`` against its manifest
+
+    Returns a list of problems, the list is empty if the set is intact.
+    Raises FileNotFoundError if the set has no manifest.
+    """
+    set_dir = Path(set_dir)
+    manifest = read_manifest(set_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No manifest found for {set_dir.name}")
+
+    problems = []
+    for filename, expected in manifest["files"].items():
+        file_path = set_dir / filename
+        try:
+            stat = file_path.stat()
+        except FileNotFoundError:
+            problems.append(f"{filename} is missing")
+            continue
+        if stat.st_size != expected["size"]:
+            problems.append(f"{filename} has size {stat.st_size}, expected {expected['size']}")
+            continue
+        if stat.st_mtime_ns == expected["mtime_ns"]:
+            continue
+        logger.debug("%s has been modified, checking its hash", file_path)
+        if hash_file(file_path) != expected["sha256"]:
+            problems.append(f"{filename} is corrupted (hash mismatch)")
+    return problems
@@ -2,13 +2,22 @@
 Network utilities of LHAPDF
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import fcntl
+import hashlib
+import json
 import logging
 import math
+import os
 from pathlib import Path
 import shutil
-import tempfile
+import struct
+import time
+import urllib.error
 import urllib.parse
 import urllib.request
+import uuid
 
 try:
     from tqdm import tqdm
@@ -21,37 +30,92 @@ except ImportError:
         pass
 
 
+from . import profiling
 from .configuration import environment
 
 logger = logging.getLogger(__name__)
 
+# Timeout (in seconds) for every network operation
+DEFAULT_TIMEOUT = float(os.environ.get("LHAPDF_MANAGEMENT_TIMEOUT", 10))
+# Ranking of the sources, cached in the datapath for SOURCE_RANKING_TTL seconds
+SOURCE_RANKING_FILE = ".sources_ranking.json"
+SOURCE_RANKING_TTL = 3600
+# Reference size used to weight latency against throughput when ranking sources
+_REFERENCE_SIZE = 50 * 1024**2
+_CHUNK_SIZE = 1024**2
+
 
 def _byte_print(byte_size):
     """Return size as a nicely-formatted string"""
-    units = ("B", "KB", "MB", "GB")
-    order = int(math.log(byte_size, 1024))
+    if byte_size <= 0:
+        return "0 B"
+    units = ("B", "KB", "MB", "GB", "TB")
+    order = min(int(math.log(byte_size, 1024)), len(units) - 1)
     value = byte_size / 1024**order
     if value > 0:
         return f"{value:.2f} {units[order]}"
     return "0 B"
 
 
-class _ProgressBar(tqdm):
-    """Progress bar prepared for urllib.request.urlretrieve"""
+def _temporary_path(dest_path):
+    """Return a unique temporary path in the same folder as ``dest_path``
+    so that the final file can be atomically moved into place"""
+    return dest_path.with_name(f".{dest_path.name}.{uuid.uuid4().hex}")
+
+
+# ioctl request to create a copy-on-write clone of a file (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+
+def clone_file(source, destination):
+    """Copy a file letting the filesystem share or copy the data on its own when possible.
+    Try first a copy-on-write clone (reflink), then an in-kernel ``copy_file_range``
+    and, only if everything else fails, a regular copy.
+    """
+    with open(source, "rb") as fsrc, open(destination, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+
+        if hasattr(os, "copy_file_range"):
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = 0
+            try:
+                while copied < size:
+                    nbytes = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if nbytes == 0:
+                        break
+                    copied += nbytes
+            except OSError:
+                pass
+            if copied == size:
+                return
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+def _local_source_path(source):
+    """Return the path of a source if the source is a local folder, None otherwise"""
+    source_url = urllib.parse.urlparse(source)
+    if source_url.path and not source_url.netloc:
+        return Path(source_url.path)
+    return None
 
-    def progress_update(self, block_num=1, block_size=1, total_size=None):
-        """
-        block_num: int
-            Number of blocks already transferred
-        block_size: int
-            Size of each block
-        total_size: int
-            Total size
-        """
-        if total_size is not None:
-            self.total = total_size
-        self.update(block_num * block_size - self.n)
-        # At every point self.n is set to = block_num * block_Size
+
+def find_local_source(target_name):
+    """Look for the target name in the sources which are local folders (e.g., CVMFS)
+    Returns the path of the first match or None if none of the local sources contain it.
+    """
+    for source in environment.sources:
+        source_path = _local_source_path(source)
+        if source_path is not None and (source_path / target_name).exists():
+            return source_path / target_name
+    return None
 
 
 def _copy_file(source, destination, dryrun=False):
@@ -64,35 +128,251 @@ def _copy_file(source, destination, dryrun=False):
     if dryrun:
         file_size = source_path.stat().st_size
         logger.info("%s [%s]", source_path.name, _byte_print(file_size))
-    # Finally, copy
-    shutil.copy(source_path, destination)
+    # Finally, copy (through a temporary file so that the destination is never half-written)
+    destination = Path(destination)
+    tmp_dest = _temporary_path(destination)
+    try:
+        with profiling.span("copy", source=source_path.as_posix()) as span:
+            clone_file(source_path, tmp_dest)
+            span.set(bytes=tmp_dest.stat().st_size)
+        tmp_dest.replace(destination)
+    finally:
+        tmp_dest.unlink(missing_ok=True)
 
 
-def _download_url(source_url, dest_path):
+def _download_url(source_url, dest_path, timeout=DEFAULT_TIMEOUT):
     """Download a file from a source url to a destination
-    It first downloads to some temporary folder"""
-    tmp_dest = tempfile.mktemp()
-    if _enable_fancy_progress:
-        with _ProgressBar(
-            unit="B", unit_scale=True, unit_divisor=1024, miniters=1, desc=dest_path.name
-        ) as pbar:
-            urllib.request.urlretrieve(source_url, tmp_dest, pbar.progress_update)
-    else:
-        urllib.request.urlretrieve(source_url, tmp_dest)
-        logger.info("%s [%s]", source_url, _byte_print(Path(tmp_dest).stat().st_size))
-    shutil.move(tmp_dest, dest_path)
-
-
-def _get_remote_size(source_url):
+    It first downloads to a temporary file next to the destination
+    The sha256 of the file is computed while the data is downloaded.
+    Returns the number of bytes downloaded and the hash"""
+    tmp_dest = _temporary_path(dest_path)
+    span = profiling.span("download", source=source_url)
+    try:
+        with span, urllib.request.urlopen(source_url, timeout=timeout) as response:
+            total_size = int(response.headers.get("Content-Length", 0)) or None
+            pbar = None
+            if _enable_fancy_progress:
+                pbar = tqdm(
+                    unit="B",
+                    unit_scale=True,
+                    unit_divisor=1024,
+                    miniters=1,
+                    total=total_size,
+                    desc=dest_path.name,
+                )
+            nbytes = 0
+            file_hash = hashlib.sha256()
+            with tmp_dest.open("wb") as tmp_file:
+                while chunk := response.read(_CHUNK_SIZE):
+                    tmp_file.write(chunk)
+                    file_hash.update(chunk)
+                    nbytes += len(chunk)
+                    if pbar is not None:
+                        pbar.update(len(chunk))
+            if pbar is not None:
+                pbar.close()
+            else:
+                logger.info("%s [%s]", source_url, _byte_print(nbytes))
+            span.set(bytes=nbytes)
+        tmp_dest.replace(dest_path)
+    finally:
+        tmp_dest.unlink(missing_ok=True)
+    return nbytes, file_hash.hexdigest()
+
+
+def _get_remote_size(source_url, timeout=DEFAULT_TIMEOUT):
     """Query the remote for the size of the object that would
     be downloaded"""
     req = urllib.request.Request(source_url, method="HEAD")
-    url_open = urllib.request.urlopen(req)
+    with profiling.span("remote_size", source=source_url):
+        url_open = urllib.request.urlopen(req, timeout=timeout)
     if url_open.status != 200:
         raise urllib.request.URLError
     return int(url_open.headers.get("Content-Length", 0))
 
 
+@dataclass
+class Download:
+    """Result of a successful ``download_magic``.
+    The sha256 is only computed for files that have been downloaded (None for local copies)
+    """
+
+    source: str
+    size: int
+    sha256: str = None
+
+
+@dataclass
+class RemoteSize:
+    """Size of a target in a given source.
+    For gzip files, ``extracted_size`` is the size of the uncompressed data (None if unknown)
+    """
+
+    source: str
+    size: int
+    extracted_size: int = None
+
+
+def _gzip_extracted_size(trailer, compressed_size):
+    """The last 4 bytes of a gzip file contain the size of the uncompressed data (mod 2^32)"""
+    extracted_size = struct.unpack("<I", trailer[-4:])[0]
+    if extracted_size < compressed_size:
+        # Most likely the data is bigger than 4 GB, unknown
+        return None
+    return extracted_size
+
+
+def _local_size(source, target_path):
+    """Size of a file in a local source"""
+    size = target_path.stat().st_size
+    extracted_size = None
+    if target_path.suffix == ".gz" and size >= 4:
+        with target_path.open("rb") as target_file:
+            target_file.seek(-4, os.SEEK_END)
+            extracted_size = _gzip_extracted_size(target_file.read(4), size)
+    return RemoteSize(source, size, extracted_size)
+
+
+def _remote_size(source, url, timeout):
+    """Size of a file in a remote source, the extracted size of gzip files is obtained
+    by requesting only the last 4 bytes of the file"""
+    size = _get_remote_size(url, timeout=timeout)
+    extracted_size = None
+    if url.endswith(".gz") and size >= 4:
+        request = urllib.request.Request(url, headers={"Range": "bytes=-4"})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                # 206: partial content, otherwise the server is sending the whole file
+                if response.status == 206:
+                    extracted_size = _gzip_extracted_size(response.read(4), size)
+        except (urllib.error.URLError, TimeoutError) as e:
+            logger.debug("Unable to get the extracted size of %s: %s", url, e)
+    return RemoteSize(source, size, extracted_size)
+
+
+def query_size(target_name, timeout=DEFAULT_TIMEOUT):
+    """Look for the target in all sources (fastest first) and return its size as a ``RemoteSize``
+    Local sources are answered with ``stat``, remote sources with a HEAD request.
+    Returns None if the target is not found in any source.
+    """
+    for source in rank_sources(timeout=timeout):
+        source_path = _local_source_path(source)
+        try:
+            if source_path is not None:
+                return _local_size(source, source_path / target_name)
+            return _remote_size(source, source + target_name, timeout)
+        except (OSError, ValueError) as e:
+            logger.debug("%s not available in %s: %s", target_name, source, e)
+    return None
+
+
+def open_stream(target_name, timeout=DEFAULT_TIMEOUT):
+    """Open the target from the fastest source that contains it as a binary stream,
+    without downloading it first.
+
+    Returns the source (path or url) and the file object (to be closed by the caller).
+    Raises FileNotFoundError if the target is not found in any source.
+    """
+    for source in rank_sources(timeout=timeout):
+        source_path = _local_source_path(source)
+        try:
+            if source_path is not None:
+                target_path = source_path / target_name
+                return target_path.as_posix(), target_path.open("rb")
+            url = source + target_name
+            return url, urllib.request.urlopen(url, timeout=timeout)
+        except OSError as e:
+            logger.debug("%s not available in %s: %s", target_name, source, e)
+    raise FileNotFoundError(f"{target_name} not found in any source")
+
+
+### Ranking of sources
+def _ranking_path():
+    return environment.possible_datapath / SOURCE_RANKING_FILE
+
+
+def _read_ranking():
+    """Read the cached measurements of the sources, {source: measurements}"""
+    try:
+        return json.loads(_ranking_path().read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_ranking(ranking):
+    """Write down the measurements of the sources, failures are not important"""
+    ranking_path = _ranking_path()
+    try:
+        tmp_path = _temporary_path(ranking_path)
+        tmp_path.write_text(json.dumps(ranking, indent=1))
+        tmp_path.replace(ranking_path)
+    except OSError as e:
+        logger.debug("Unable to save the ranking of sources: %s", e)
+
+
+def _update_ranking(source, **measurements):
+    """Update the cached measurements of the given source"""
+    ranking = _read_ranking()
+    entry = ranking.setdefault(source, {})
+    entry.update(measurements, time=time.time())
+    _write_ranking(ranking)
+
+
+def _probe_source(source, timeout):
+    """Measure the latency of a source (in seconds), return None if the source is not reachable"""
+    start = time.perf_counter()
+    source_path = _local_source_path(source)
+    try:
+        if source_path is not None:
+            if not source_path.is_dir():
+                return None
+        else:
+            _get_remote_size(source + environment.index_filename, timeout=timeout)
+    except (OSError, ValueError) as e:
+        logger.debug("Source %s is not available: %s", source, e)
+        return None
+    return time.perf_counter() - start
+
+
+def _score(measurements):
+    """Estimated time to get a reference-size file from the source, lower is better"""
+    if not measurements.get("healthy"):
+        return math.inf
+    score = measurements["latency"]
+    throughput = measurements.get("throughput")
+    if throughput:
+        score += _REFERENCE_SIZE / throughput
+    return score
+
+
+def rank_sources(timeout=DEFAULT_TIMEOUT, refresh=False):
+    """Return the list of sources sorted from fastest to slowest.
+
+    All sources without a recent measurement are probed concurrently (with the given timeout)
+    and the measurements are cached in the datapath for ``SOURCE_RANKING_TTL`` seconds.
+    Unreachable sources are kept at the end of the list as a last resort.
+    """
+    sources = list(environment.sources)
+    ranking = _read_ranking()
+    now = time.time()
+    to_probe = [
+        i
+        for i in sources
+        if refresh or i not in ranking or now - ranking[i].get("time", 0) > SOURCE_RANKING_TTL
+    ]
+    if to_probe:
+        with profiling.span("rank_sources", probed=len(to_probe)):
+            with ThreadPoolExecutor(max_workers=len(to_probe)) as executor:
+                latencies = executor.map(lambda i: _probe_source(i, timeout), to_probe)
+                for source, latency in zip(to_probe, latencies):
+                    entry = ranking.setdefault(source, {})
+                    entry.update(healthy=latency is not None, latency=latency, time=now)
+        _write_ranking(ranking)
+
+    # sorted is stable so that on equal footing the order of the sources is respected
+    return sorted(sources, key=lambda i: _score(ranking[i]))
+
+
 def download_magic(target_name, destination, dry=False):
     """Utilizes the internal sources (with an option for a list of more)
     to download (or copy) the target name to the given destination.
@@ -101,6 +381,7 @@ def download_magic(target_name, destination, dry=False):
     logs all errors only on total failure.
 
     The final result is the download/copy of ``target_name`` to ``destination/target_name``
+    Returns a ``Download`` object (False if the download failed)
 
     Parameters
     ---------
@@ -109,8 +390,16 @@ def download_magic(target_name, destination, dry=False):
         destination: path or str
             Destination folder for the download
         dry: bool
-            If true do not download anything
+            If true do not download anything, only print the size of the target
     """
+    if dry:
+        remote_size = query_size(target_name)
+        if remote_size is None:
+            logger.error("%s not found in any source", target_name)
+            return False
+        print(f"{target_name} [{_byte_print(remote_size.size)}]")
+        return True
+
     dest_dir = Path(destination)
     dest_dir.mkdir(exist_ok=True, parents=True)
     dest_path = dest_dir / target_name
@@ -118,13 +407,13 @@ def download_magic(target_name, destination, dry=False):
     errors = []
 
     # Using a "better ask forgiveness rather than permission" approach for now
-    for source in environment.sources:
-        source_url = urllib.parse.urlparse(source)
-        if source_url.path and not source_url.netloc:
+    for source in rank_sources():
+        source_path = _local_source_path(source)
+        if source_path is not None:
             try:
-                source_path = Path(source_url.path) / target_name
+                source_path = source_path / target_name
                 _copy_file(source_path, dest_path)
-                return True
+                return Download(source_path.as_posix(), dest_path.stat().st_size)
             except FileNotFoundError:
                 errors.append(f"{source} not found")
                 continue
@@ -134,10 +423,18 @@ def download_magic(target_name, destination, dry=False):
             b_size = _get_remote_size(url)
             print(f"{target_name} [{_byte_print(b_size)}]")
             logger.info("%s [%s]", target_name, _byte_print(b_size))
-            _download_url(url, dest_path)
-            return True
-        except urllib.request.URLError as e:
+            start = time.perf_counter()
+            nbytes, sha256 = _download_url(url, dest_path)
+            elapsed = time.perf_counter() - start
+            if elapsed > 0:
+                _update_ranking(source, throughput=nbytes / elapsed)
+            return Download(url, nbytes, sha256)
+        except urllib.error.HTTPError as e:
+            # The source is alive, but cannot provide the target
+            errors.append(f"Unable to download from {url}: {e}")
+        except (urllib.error.URLError, TimeoutError) as e:
             errors.append(f"Unable to download from {url}: {e}")
+            _update_ranking(source, healthy=False)
         except KeyboardInterrupt:
             # Allow cancelling specific downloads
             logger.error("Download halted by user")
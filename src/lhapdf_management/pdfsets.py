@@ -12,13 +12,34 @@ Example
 
 """
 
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
 from fnmatch import fnmatch
-from pathlib import Path
+import gzip
+import lzma
+from pathlib import Path, PurePosixPath
+import tarfile
+import threading
 
 import numpy as np
 import yaml
 
+from . import profiling
+from .manifest import hash_file, read_manifest, write_manifest
+
+TARBALL_SUFFIX = ".tar.gz"
+# Files of a PDF set can be compressed with any of these formats
+COMPRESSION_FORMATS = {"gz": gzip, "xz": lzma}
+# Number of files of a tarball kept in memory once decompressed
+TARBALL_CACHE_SIZE = 16
+# Threads used by default by ``PDF.prefetch``
+DEFAULT_PREFETCH_JOBS = 4
+# Number of significant digits written by default (same as LHAPDF)
+DEFAULT_PRECISION = 8
+_SEPARATOR = "---"
+_WRITE_BUFFER = 1024**2
+
 
 @dataclass
 class SetInfo:
@@ -43,15 +64,20 @@ class SetInfo:
             return other.name == self.name
         raise ValueError(f"Trying to compare a SetInfo object to {type(other)}:{other}")
 
-    def load(self):
-        """Try to load a PDF object, fails if the PDF does not exist in the system"""
+    def load(self, record=True):
+        """Try to load a PDF object, fails if the PDF does not exist in the system.
+        If ``record`` is false, the access is not recorded (see ``PDF``)"""
         from lhapdf_management import environment
 
         # Import here to avoid circular imports
         for possible_path in environment.paths:
             pdf_path = possible_path / self.name
             if pdf_path.is_dir():
-                return PDF(pdf_path, setinfo_object=self)
+                return PDF(pdf_path, setinfo_object=self, record=record)
+            # Sets installed in archive-only mode are read from the tarball
+            tar_path = possible_path / f"{self.name}{TARBALL_SUFFIX}"
+            if tar_path.is_file():
+                return PDF(tar_path, setinfo_object=self, record=record)
         raise FileNotFoundError("Could not find {self.name} in the system.")
 
     def install(self):
@@ -71,6 +97,43 @@ class GridPDF:
     flav: list
     grid: np.ndarray
 
+    def to_text(self, precision=DEFAULT_PRECISION):
+        """Format the subgrid as a block of a LHAPDF .dat file (without the separators).
+        The whole block is formatted at once with a single format string.
+        Note that LHAPDF files contain q and not q2.
+        """
+        grid = np.asarray(self.grid, dtype=np.float64)
+        nrows, ncols = grid.reshape(len(grid), -1).shape
+        number = f"%.{precision}e"
+        row_format = " ".join([number] * ncols) + "\n"
+        lines = [
+            " ".join([number] * len(self.x)) % tuple(np.ravel(self.x)),
+            " ".join([number] * len(self.q2)) % tuple(np.sqrt(self.q2)),
+            " ".join(str(int(i)) for i in np.ravel(self.flav)),
+        ]
+        return "\n".join(lines) + "\n" + (row_format * nrows) % tuple(grid.ravel().tolist())
+
+
+def _parse_data(pdf_text):
+    """
+    Parses the content of a PDF .dat file and retrieves a list of grids
+    See ``_load_data``
+    """
+    pdf_lines = pdf_text.split("\n")
+    positions = [i for i, line in enumerate(pdf_lines) if line.strip() == _SEPARATOR]
+
+    grids = []
+    for separator_line in positions[:-1]:
+        skip_me = separator_line + 1
+        x = np.loadtxt(pdf_lines[skip_me : skip_me + 1])
+        q2 = pow(np.loadtxt(pdf_lines[skip_me + 1 : skip_me + 2]), 2)
+        flav = np.loadtxt(pdf_lines[skip_me + 2 : skip_me + 3])
+        grid_size = len(x) * len(q2)
+        grid = np.loadtxt(pdf_lines[skip_me + 3 : skip_me + 3 + grid_size])
+        grids.append(GridPDF(x, q2, flav, grid))
+
+    return grids
+
 
 def _load_data(pdf_file):
     """
@@ -92,51 +155,295 @@ def _load_data(pdf_file):
             list of GridPDFs containing all PDF information
     """
     pdf_file = Path(pdf_file)
+    with profiling.span("load_data", file=pdf_file.name):
+        return _parse_data(_read_text(pdf_file))
 
-    # We need to know how the grids are separated
-    separator = "---"
-    pdf_lines = pdf_file.read_text().split("\n")
-    positions = [i for i, line in enumerate(pdf_lines) if line.strip() == separator]
 
-    grids = []
-    for separator_line in positions[:-1]:
-        skip_me = separator_line + 1
-        x = np.loadtxt(pdf_file, skiprows=skip_me, max_rows=1)
-        q2 = pow(np.loadtxt(pdf_file, skiprows=skip_me + 1, max_rows=1), 2)
-        flav = np.loadtxt(pdf_file, skiprows=skip_me + 2, max_rows=1)
-        grid_size = len(x) * len(q2)
-        grid = np.loadtxt(pdf_file, skiprows=skip_me + 3, max_rows=grid_size)
-        grids.append(GridPDF(x, q2, flav, grid))
+def _member_text(grids, pdf_type, precision=DEFAULT_PRECISION):
+    """Content of the .dat file of a member made of the given list of GridPDF"""
+    blocks = [f"PdfType: {pdf_type}\nFormat: lhagrid1\n"]
+    blocks.extend(grid.to_text(precision) for grid in grids)
+    blocks.append("")
+    return f"{_SEPARATOR}\n".join(blocks)
+
+
+def _write_member(args):
+    """Write down the .dat file of a member, (path, grids, pdf_type, precision)"""
+    path, grids, pdf_type, precision = args
+    with open(path, "w", buffering=_WRITE_BUFFER) as dat_file:
+        dat_file.write(_member_text(grids, pdf_type, precision))
+    return path
+
+
+def _pdf_type(member, error_type):
+    """PdfType of a member as written by LHAPDF"""
+    if member == 0:
+        return "central"
+    return "replica" if error_type == "replicas" else "error"
+
+
+def write_info(path, info):
+    """Write down a dictionary as a LHAPDF .info file"""
+    # Lists of numbers in flow style, as in the files distributed by LHAPDF
+    text = yaml.safe_dump(info, default_flow_style=None, sort_keys=False, width=float("inf"))
+    Path(path).write_text(text)
 
-    return grids
+
+def write_pdf(set_dir, info, members, jobs=None, precision=DEFAULT_PRECISION):
+    """Write down a full PDF set in LHAPDF format
+
+    Parameters
+    ----------
+        set_dir: Path
+            folder of the new PDF set, the name of the folder is the name of the set
+        info: dict
+            content of the .info file, ``NumMembers`` is filled if not given
+        members: list(list(GridPDF)) or dict
+            list of members, each one a list of subgrids, or a dictionary {member: subgrids}.
+            If only some of the members are given, the set is written down as a
+            partial set which keeps the original numbering of the members
+        jobs: int
+            number of processes writing members in parallel (default: number of cpus)
+        precision: int
+            number of digits written for every value
+
+    Returns
+    -------
+        pdf: PDF
+            the PDF set that has been written
+    """
+    set_dir = Path(set_dir)
+    set_dir.mkdir(parents=True, exist_ok=True)
+    name = set_dir.name
+    if not isinstance(members, dict):
+        members = dict(enumerate(members))
+    info = {**info}
+    info.setdefault("NumMembers", max(members) + 1)
+    error_type = info.get("ErrorType")
+
+    write_info(set_dir / f"{name}.info", info)
+    to_write = [
+        (set_dir / f"{name}_{i:04d}.dat", grids, _pdf_type(i, error_type), precision)
+        for i, grids in sorted(members.items())
+    ]
+    if jobs == 1:
+        paths = list(map(_write_member, to_write))
+    else:
+        # Formatting is CPU bound, use processes rather than threads
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            paths = list(executor.map(_write_member, to_write, chunksize=4))
+
+    if sorted(members) != list(range(info["NumMembers"])):
+        # Partial sets are marked as such in their manifest, as partial installations
+        files = {i.name: hash_file(i) for i in [set_dir / f"{name}.info", *paths]}
+        write_manifest(set_dir, files, members=sorted(members))
+    return PDF(set_dir, record=False)
+
+
+def _read_text(path):
+    """Read a file, decompressing it on the fly if it is compressed"""
+    compression = COMPRESSION_FORMATS.get(path.suffix[1:])
+    if compression is None:
+        return path.read_text()
+    with compression.open(path, "rt") as compressed_file:
+        return compressed_file.read()
+
+
+def _with_compression(filename):
+    """All possible names of a file, uncompressed first"""
+    return [filename] + [f"{filename}.{i}" for i in COMPRESSION_FORMATS]
+
+
+class _DirectorySource:
+    """Reads the files of a PDF set from its folder, files can be compressed"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _find(self, filename):
+        for candidate in _with_compression(filename):
+            file_path = self.path / candidate
+            if file_path.exists():
+                return file_path
+        return None
+
+    def __contains__(self, filename):
+        return self._find(filename) is not None
+
+    def read_text(self, filename):
+        file_path = self._find(filename)
+        if file_path is None:
+            raise FileNotFoundError(f"{filename} not found in {self.path}")
+        return _read_text(file_path)
+
+    def clear_cache(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _TarballSource:
+    """Reads the files of a PDF set directly from its .tar.gz without extracting it.
+
+    Nothing is decompressed upon creation: checking for a file (or reading the .info file)
+    streams the tarball only until the file is found, the index of all members is built
+    (and the tarball kept open) the first time a member is read.
+    Members read in order are then decompressed in one pass
+    and the last ``TARBALL_CACHE_SIZE`` files that have been read are cached.
+    Reads are serialized since the tarball is shared.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tar = None
+        self._members = None
+        # Files found (or not) before the index was built, {filename: name in the tarball}
+        self._found = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _index(self):
+        """Open the tarball and index all its members, to be called with the lock held"""
+        if self._members is None:
+            self._tar = tarfile.open(self.path, "r:gz")
+            self._members = {PurePosixPath(i.name).name: i for i in self._tar if i.isfile()}
+        return self._members
+
+    def _stream(self, filename, read=False):
+        """Stream the tarball until ``filename`` (possibly compressed) is found.
+        Returns its name in the tarball (None if not found) and its raw content if ``read``"""
+        candidates = _with_compression(filename)
+        with tarfile.open(self.path, "r|gz") as tar_file:
+            for member in tar_file:
+                member_name = PurePosixPath(member.name).name
+                if member.isfile() and member_name in candidates:
+                    return member_name, tar_file.extractfile(member).read() if read else None
+        return None, None
+
+    def _find(self, filename):
+        if self._members is not None:
+            for candidate in _with_compression(filename):
+                if candidate in self._members:
+                    return candidate
+            return None
+        if filename not in self._found:
+            self._found[filename] = self._stream(filename)[0]
+        return self._found[filename]
+
+    def __contains__(self, filename):
+        if filename.endswith(".info"):
+            # The .info file is always read afterwards, read it already
+            try:
+                self.read_text(filename)
+                return True
+            except FileNotFoundError:
+                return False
+        with self._lock:
+            return filename in self._cache or self._find(filename) is not None
+
+    def read_text(self, filename):
+        with self._lock:
+            text = self._cache.get(filename)
+            if text is not None:
+                self._cache.move_to_end(filename)
+                return text
+            if self._members is None and filename.endswith(".info"):
+                # The metadata alone does not justify decompressing the whole tarball
+                member_name, raw = self._stream(filename, read=True)
+            else:
+                self._index()
+                member_name = self._find(filename)
+                if member_name is not None:
+                    raw = self._tar.extractfile(self._members[member_name]).read()
+        if member_name is None:
+            raise FileNotFoundError(f"{filename} not found in {self.path}")
+        compression = COMPRESSION_FORMATS.get(member_name.rpartition(".")[2])
+        if member_name != filename and compression is not None:
+            raw = compression.decompress(raw)
+        text = raw.decode()
+        with self._lock:
+            self._cache[filename] = text
+            while len(self._cache) > TARBALL_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return text
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def close(self):
+        """Close the tarball (it is opened again if needed)"""
+        with self._lock:
+            if self._tar is not None:
+                self._tar.close()
+            self._tar = None
+            self._members = None
+
+    def __del__(self):
+        if self._tar is not None:
+            self._tar.close()
+
+
+def _record_access(pdf_path):
+    """Record the use of a set, see ``usage.record_access``"""
+    from .usage import record_access
+
+    # Import here to avoid circular imports
+    record_access(pdf_path)
 
 
 class PDF:
     """Comodity object lazily-containing a LHAPDF PDF
-    Receives a folder containing a PDF and stores the information
+    Receives a folder (or a .tar.gz tarball) containing a PDF and stores the information
     to read it when necessary
+
+    It is safe to use the same object from several threads:
+    every member is parsed only once, even if it is requested concurrently.
+    The access is recorded in the access log (see ``usage``) unless ``record`` is false,
+    which is meant for sets that are only inspected (e.g., by the management commands)
     """
 
     _name = "None"
 
-    def __init__(self, pdf_path, setinfo_object=None):
+    def __init__(self, pdf_path, setinfo_object=None, record=True):
         # Ensure it is a path
         pdf_path = Path(pdf_path)
         # Perform some checks
-        if not pdf_path.is_dir():
-            raise ValueError(f"The given pdf path {pdf_path} is not a directory")
-        self._name = pdf_path.name
+        if pdf_path.is_file() and pdf_path.name.endswith(TARBALL_SUFFIX):
+            self._name = pdf_path.name[: -len(TARBALL_SUFFIX)]
+            self._source = _TarballSource(pdf_path)
+        elif pdf_path.is_dir():
+            self._name = pdf_path.name
+            self._source = _DirectorySource(pdf_path)
+        else:
+            raise ValueError(f"The given pdf path {pdf_path} is not a directory nor a tarball")
         self._path = pdf_path
-        self._info_file = pdf_path / f"{self._name}.info"
+        self._info_file = f"{self._name}.info"
         self._info = None
-        if not self._info_file.exists():
+        if self._info_file not in self._source:
             raise FileNotFoundError(f"No info file found for {self._name}")
+        # Partial installations only contain some of the members
+        self._members = None
+        if pdf_path.is_dir():
+            installed = read_manifest(pdf_path)
+            if installed is not None:
+                self._members = installed.get("members")
+        first_member = self._members[0] if self._members else 0
         # Check there is at least one dat file (is this true?)
-        if not (pdf_path / f"{self._name}_0000.dat").exists():
+        if f"{self._name}_{first_member:04d}.dat" not in self._source:
             raise FileNotFoundError(f"No dat file found for {self._name}")
+        # Keep track of which sets are being used
+        self._record = record
+        if record:
+            _record_access(pdf_path)
         # Store the metadata if given
         self._setinfo = setinfo_object
         self._grid = {}
+        # Members being loaded: {member: Future}
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._executor = None
 
     @property
     def name(self):
@@ -157,8 +464,8 @@ class PDF:
         """Information from the PDF .info file as a dictionary"""
         if self._info:
             return self._info
-        with self._info_file.open() as info_file:
-            self._info = yaml.safe_load(info_file)
+        with profiling.span("parse_info", set=self._name):
+            self._info = yaml.safe_load(self._source.read_text(self._info_file))
         return self._info
 
     @property
@@ -176,23 +483,100 @@ class PDF:
         """Return the version of the PDF that is installed"""
         return self.info.get("DataVersion")
 
+    @property
+    def is_partial(self):
+        """Whether only a subset of the members of the set is installed"""
+        return self._members is not None
+
+    @property
+    def members(self):
+        """List of the members available"""
+        if self._members is not None:
+            return list(self._members)
+        return list(range(self.info["NumMembers"]))
+
     def get_member_grids(self, i):
         """Get a PDF member (as a list of GridPDF)"""
+        if self._record:
+            _record_access(self._path)
         i = str(i)
         member = self._grid.get(i)
         if member is not None:
+            profiling.event("load_member", set=self._name, cache_hit=True)
             return member
-        member_path = self._path / f"{self._name}_{i.zfill(4)}.dat"
-        member = _load_data(member_path)
-        self._grid[i] = member
+
+        with self._lock:
+            member = self._grid.get(i)
+            if member is not None:
+                return member
+            future = self._loading.get(i)
+            loader = future is None
+            if loader:
+                future = self._loading[i] = Future()
+        if not loader:
+            # Somebody else is already parsing this member
+            return future.result()
+
+        try:
+            member_file = f"{self._name}_{i.zfill(4)}.dat"
+            with profiling.span("load_member", set=self._name, cache_hit=False) as span:
+                text = self._source.read_text(member_file)
+                member = _parse_data(text)
+                span.set(bytes=len(text))
+        except BaseException as e:
+            with self._lock:
+                del self._loading[i]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._grid[i] = member
+            del self._loading[i]
+        future.set_result(member)
         return member
 
+    def prefetch(self, members=None, jobs=DEFAULT_PREFETCH_JOBS):
+        """Load the given members (by default, all of them) in a background pool of threads
+
+        Returns a list of futures, one per member, resolving to the member grids.
+        Members requested while being prefetched are not parsed twice.
+        """
+        if members is None:
+            members = self.members
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=jobs, thread_name_prefix=f"prefetch-{self._name}"
+                )
+        return [self._executor.submit(self.get_member_grids, i) for i in members]
+
     def get_all_member_grids(self):
-        """Get all PDF members"""
-        nm = self["NumMembers"]
-        all_members = {i: self.get_member_grids(i) for i in range(nm)}
+        """Get all (available) PDF members"""
+        all_members = {i: self.get_member_grids(i) for i in self.members}
         return all_members
 
+    def clear_cache(self):
+        """Forget all members loaded so far"""
+        with self._lock:
+            self._grid = {}
+        self._source.clear_cache()
+
+    def close(self):
+        """Close the files kept open to read the members (e.g., the tarball of the set)"""
+        self._source.close()
+
+    def luminosity(self, masses, sqrts, channel="gg", **kwargs):
+        """Parton luminosity for all members (see ``luminosity.luminosity``)"""
+        from .luminosity import luminosity
+
+        # Import here to avoid circular imports
+        return luminosity(self, masses, sqrts, channel=channel, **kwargs)
+
+    def write(self, set_dir, jobs=None, precision=DEFAULT_PRECISION):
+        """Write down a copy of this PDF to ``set_dir`` (see ``write_pdf``),
+        partial sets keep the numbering of their members"""
+        members = {i: self.get_member_grids(i) for i in self.members}
+        return write_pdf(set_dir, self.info, members, jobs=jobs, precision=precision)
+
     def __getitem__(self, key):
         """Return an item from the info file"""
         item = self.info.get(key)
@@ -204,6 +588,9 @@ class PDF:
         return self._name
 
     def __len__(self):
+        """Number of members available (for partial installations, the installed members)"""
+        if self._members is not None:
+            return len(self._members)
         return self.info["NumMembers"]
 
 
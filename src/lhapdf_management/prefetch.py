@@ -0,0 +1,243 @@
+"""
+Background preparation of the PDF sets needed by a job
+
+A job declares in a manifest the sets (and members) it needs, e.g., in YAML:
+
+    NNPDF40_nnlo_as_01180: 0-99
+    CT18NNLO:               # all members
+    MSHT20nnlo_as118: [0, 1, 2]
+
+The sets are resolved against the index, installed if missing and their members loaded
+in the background while the job initialises.
+The ``Prefetcher`` reports the readiness of every set and gives access to the (warm) PDFs.
+When the members are going to be read by a different process (e.g., ``lhapdf-management
+prefetch`` running next to the job) it is enough to warm up the page cache instead.
+
+Example
+-------
+
+>>> from lhapdf_management.prefetch import prefetch
+>>> prefetcher = prefetch("job.yaml")
+>>> # ... initialise the job ...
+>>> pdf = prefetcher.get("NNPDF40_nnlo_as_01180")  # waits only if the set is not ready yet
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from dataclasses import dataclass
+import logging
+import os
+from pathlib import Path
+import threading
+
+import yaml
+
+from . import management, profiling
+from .pdfsets import DEFAULT_PREFETCH_JOBS, TARBALL_SUFFIX, _with_compression
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOBS = 4
+_READ_CHUNK = 1024**2
+
+
+def read_job_manifest(manifest):
+    """Read a job manifest: a mapping of set names to the members needed (``None`` for all of
+    them, a list of members or a string such as "0-99,120") or a plain list of set names.
+    ``manifest`` can be a path to a YAML (or JSON) file or the content itself.
+
+    Returns
+    -------
+        sets: dict
+            {name: sorted list of members or None}
+    """
+    if isinstance(manifest, (str, Path)):
+        manifest = yaml.safe_load(Path(manifest).read_text())
+    if isinstance(manifest, (list, tuple)):
+        manifest = dict.fromkeys(manifest)
+    if not isinstance(manifest, dict):
+        raise ValueError("The job manifest must be a mapping (or list) of PDF sets")
+
+    sets = {}
+    for name, members in manifest.items():
+        if isinstance(members, str):
+            members = management.parse_members(members)
+        elif isinstance(members, int):
+            members = [members]
+        elif members is not None:
+            members = sorted(int(i) for i in members)
+        sets[str(name)] = members
+    return sets
+
+
+@dataclass
+class SetStatus:
+    """Readiness of a set of the manifest,
+    ``state`` is one of pending, installing, loading, ready or failed"""
+
+    name: str
+    members: list = None
+    state: str = "pending"
+    loaded: int = 0
+    error: str = None
+    pdf: object = None
+
+    @property
+    def done(self):
+        return self.state in ("ready", "failed")
+
+
+def _warm_file(path):
+    """Ask the kernel to read the file into the page cache (read it if that is not possible)"""
+    with path.open("rb") as opened_file:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(opened_file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            return
+        while opened_file.read(_READ_CHUNK):
+            pass
+
+
+def _member_files(pdf, members):
+    """Files backing the given members of a set (the tarball for sets installed as archives)"""
+    if pdf.path.name.endswith(TARBALL_SUFFIX):
+        return [pdf.path]
+    files = []
+    for member in members:
+        for candidate in _with_compression(f"{pdf.name}_{member:04d}.dat"):
+            if (pdf.path / candidate).exists():
+                files.append(pdf.path / candidate)
+                break
+    return files
+
+
+class Prefetcher:
+    """Prepare in the background the sets of a job manifest: install the missing ones
+    and load the requested members (or only warm up the page cache)
+
+    Parameters
+    ----------
+        manifest: dict or Path
+            job manifest, see ``read_job_manifest``
+        install: bool
+            install the sets which are not installed
+        partial: bool
+            install only the requested members of the missing sets
+        load: bool
+            parse the members into the PDF objects, otherwise only warm up the page cache
+        jobs: int
+            number of sets prepared concurrently
+        member_jobs: int
+            number of threads loading the members of every set
+    """
+
+    def __init__(
+        self,
+        manifest,
+        install=True,
+        partial=False,
+        load=True,
+        jobs=DEFAULT_JOBS,
+        member_jobs=DEFAULT_PREFETCH_JOBS,
+    ):
+        sets = read_job_manifest(manifest)
+        self._statuses = {name: SetStatus(name, members) for name, members in sets.items()}
+        self._install = install
+        self._partial = partial
+        self._load = load
+        self._member_jobs = member_jobs
+        self._jobs = jobs
+        self._futures = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the preparation of all sets in the background, returns the prefetcher"""
+        with self._lock:
+            if self._executor is not None:
+                return self
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._jobs, thread_name_prefix="prefetch-manifest"
+            )
+        index = {i.name: i for i in management.get_reference_list()}
+        for name, status in self._statuses.items():
+            self._futures[name] = self._executor.submit(self._prepare, status, index.get(name))
+        self._executor.shutdown(wait=False)
+        return self
+
+    def _prepare(self, status, set_info):
+        span = profiling.span("prefetch", set=status.name)
+        try:
+            with span:
+                if set_info is None:
+                    raise ValueError(f"{status.name} is not in the index")
+                try:
+                    pdf = set_info.load()
+                except FileNotFoundError:
+                    if not self._install:
+                        raise
+                    status.state = "installing"
+                    members = status.members if self._partial else None
+                    if not management.install_pdf(status.name, members=members):
+                        raise RuntimeError(f"Unable to install {status.name}")
+                    pdf = set_info.load()
+
+                status.state = "loading"
+                members = status.members if status.members is not None else pdf.members
+                missing = set(members) - set(pdf.members)
+                if missing:
+                    raise ValueError(f"Members {sorted(missing)} of {status.name} not installed")
+                if self._load:
+                    futures = pdf.prefetch(members, jobs=self._member_jobs)
+                    for future in futures:
+                        future.result()
+                        status.loaded += 1
+                else:
+                    for member_file in _member_files(pdf, members):
+                        _warm_file(member_file)
+                    status.loaded = len(members)
+                span.set(members=len(members))
+            status.pdf = pdf
+            status.state = "ready"
+            logger.info("%s is ready (%d members)", status.name, status.loaded)
+        except Exception as e:
+            status.error = str(e)
+            status.state = "failed"
+            logger.error("Could not prefetch %s: %s", status.name, e)
+        return status
+
+    def status(self):
+        """Readiness of every set of the manifest, {name: SetStatus}"""
+        return dict(self._statuses)
+
+    @property
+    def ready(self):
+        """Whether all sets are ready"""
+        return all(i.state == "ready" for i in self._statuses.values())
+
+    def wait(self, timeout=None):
+        """Wait until all sets are prepared (or failed), returns whether all of them are ready"""
+        wait(self._futures.values(), timeout=timeout)
+        return self.ready
+
+    def as_completed(self):
+        """Iterate over the statuses of the sets as they are prepared"""
+        for future in as_completed(self._futures.values()):
+            yield future.result()
+
+    def get(self, name, timeout=None):
+        """PDF object of a set of the manifest, waiting for it to be prepared if necessary"""
+        if name not in self._futures:
+            raise KeyError(f"{name} is not in the job manifest")
+        status = self._futures[name].result(timeout=timeout)
+        if status.state == "failed":
+            raise RuntimeError(f"Could not prefetch {name}: {status.error}")
+        return status.pdf
+
+
+def prefetch(manifest, **kwargs):
+    """Start preparing in the background the sets of a job manifest (see ``Prefetcher``)
+
+    Returns
+    -------
+        prefetcher: Prefetcher
+    """
+    return Prefetcher(manifest, **kwargs).start()
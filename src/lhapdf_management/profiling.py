@@ -0,0 +1,227 @@
+"""
+Lightweight instrumentation of the hot paths of the library
+
+The code is instrumented with spans recording their duration and some attributes
+(bytes transferred, cache hits, source used...).
+Profiling is disabled by default, in which case a span costs a single function call.
+
+Example
+-------
+
+>>> from lhapdf_management import profiling
+>>> profiling.enable()
+>>> profiling.add_hook(print)  # called with every finished span
+>>> pdf.get_member_grids(0)
+>>> print(profiling.format_summary())
+"""
+
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ("summary", "json", "chrome")
+# Keys present in all records, the rest are attributes of the span
+_RECORD_KEYS = ("name", "start", "duration", "pid", "tid")
+
+_enabled = False
+_records = []
+_hooks = []
+_lock = threading.Lock()
+
+
+class _NullSpan:
+    """Span used when profiling is disabled, does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """Record the duration of a block of code together with some attributes"""
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        """Add (or update) attributes of the span"""
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        duration = time.perf_counter() - self._start
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        _record(self.name, self._start, duration, self.attributes)
+
+
+def _record(name, start, duration, attributes):
+    """Save a finished span and pass it to all hooks"""
+    record = {
+        "name": name,
+        "start": start,
+        "duration": duration,
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        **attributes,
+    }
+    with _lock:
+        _records.append(record)
+        hooks = list(_hooks)
+    for hook in hooks:
+        try:
+            hook(record)
+        except Exception as e:
+            logger.warning("Profiling hook %s failed: %s", hook, e)
+
+
+def span(name, **attributes):
+    """Context manager timing the enclosed code when profiling is enabled
+
+    Parameters
+    ----------
+        name: str
+            name of the span, spans with the same name are aggregated in the summary
+        attributes:
+            extra information, ``bytes`` is summed up in the summary and
+            ``cache_hit`` counted
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, attributes)
+
+
+def event(name, **attributes):
+    """Record an instantaneous event (e.g., a cache hit) when profiling is enabled"""
+    if _enabled:
+        _record(name, time.perf_counter(), 0.0, attributes)
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+@contextmanager
+def profile():
+    """Enable profiling for the enclosed code"""
+    was_enabled = _enabled
+    enable()
+    try:
+        yield
+    finally:
+        if not was_enabled:
+            disable()
+
+
+def add_hook(hook):
+    """Register a callable to be called with every finished span (as a dictionary)"""
+    with _lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    with _lock:
+        _hooks.remove(hook)
+
+
+def records():
+    """All spans recorded so far"""
+    with _lock:
+        return list(_records)
+
+
+def clear():
+    """Forget all spans recorded so far"""
+    with _lock:
+        _records.clear()
+
+
+def summary():
+    """Aggregate the recorded spans by name
+
+    Returns
+    -------
+        summary: dict
+            {name: {count, total, max, bytes, cache_hits}}, sorted by total time
+    """
+    result = {}
+    for record in records():
+        entry = result.setdefault(
+            record["name"], {"count": 0, "total": 0.0, "max": 0.0, "bytes": 0, "cache_hits": 0}
+        )
+        entry["count"] += 1
+        entry["total"] += record["duration"]
+        entry["max"] = max(entry["max"], record["duration"])
+        entry["bytes"] += record.get("bytes") or 0
+        entry["cache_hits"] += bool(record.get("cache_hit"))
+    return dict(sorted(result.items(), key=lambda i: -i[1]["total"]))
+
+
+def format_summary():
+    """Summary of the recorded spans as a table"""
+    header = ("span", "count", "total (s)", "mean (ms)", "max (ms)", "MB", "hits")
+    lines = ["{:<28} {:>7} {:>10} {:>10} {:>10} {:>9} {:>6}".format(*header)]
+    for name, entry in summary().items():
+        mean = entry["total"] / entry["count"]
+        lines.append(
+            f"{name:<28} {entry['count']:>7} {entry['total']:>10.3f} {mean * 1e3:>10.2f} "
+            f"{entry['max'] * 1e3:>10.2f} {entry['bytes'] / 1024**2:>9.2f} {entry['cache_hits']:>6}"
+        )
+    return "\n".join(lines)
+
+
+def to_chrome_trace():
+    """Recorded spans in the Chrome trace event format (chrome://tracing, Perfetto)"""
+    events = []
+    for record in records():
+        args = {k: v for k, v in record.items() if k not in _RECORD_KEYS}
+        events.append(
+            {
+                "name": record["name"],
+                "ph": "X",
+                "ts": record["start"] * 1e6,
+                "dur": record["duration"] * 1e6,
+                "pid": record["pid"],
+                "tid": record["tid"],
+                "args": args,
+            }
+        )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def report(output_format="summary"):
+    """Recorded spans as a string in one of ``OUTPUT_FORMATS``"""
+    if output_format == "summary":
+        return format_summary()
+    if output_format == "json":
+        return json.dumps(records(), indent=1, default=str)
+    if output_format == "chrome":
+        return json.dumps(to_chrome_trace(), default=str)
+    raise ValueError(f"Unknown profiling output format {output_format}")
@@ -0,0 +1,139 @@
+"""
+Regridding of PDF sets onto new x/Q knots
+
+The members of the set are interpolated onto the new knots in batches, all members of a batch
+at once (see ``interpolation``), with the batches spread over a pool of processes.
+The result is written down as a new LHAPDF set, a selection of members keeps its numbering.
+The subgrids of the original set (usually separated at the heavy quark thresholds)
+are kept, so that the new set preserves the discontinuities of the original one.
+
+Example
+-------
+
+>>> from lhapdf_management.regrid import regrid
+>>> new_pdf = regrid(pdf, np.geomspace(1e-5, 1, 50), np.geomspace(1.65, 1e4, 30), "MY_SMALL_SET")
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .configuration import environment
+from .interpolation import interpolate, stack_members
+from .pdfsets import PDF, GridPDF, write_pdf
+
+logger = logging.getLogger(__name__)
+
+# Members are interpolated in batches to limit the memory usage of big sets
+BATCH_SIZE = 100
+
+
+def parse_knots(knots_spec):
+    """Parse a list of knots given either as comma separated values (1e-5,1e-3,0.1,1)
+    or as ``log:start:stop:n`` (``n`` log-spaced knots)"""
+    if knots_spec.startswith("log:"):
+        _, start, stop, nknots = knots_spec.split(":")
+        return np.geomspace(float(start), float(stop), int(nknots))
+    return np.array(sorted(float(i) for i in knots_spec.split(",")))
+
+
+def _target_subgrids(stack, q2_knots):
+    """Distribute the new q2 knots among the subgrids of the original set.
+    The boundaries of every subgrid are always included"""
+    subgrids = []
+    for subgrid in stack:
+        inside = q2_knots[(q2_knots > subgrid.q2_min) & (q2_knots < subgrid.q2_max)]
+        subgrids.append(np.concatenate([[subgrid.q2_min], inside, [subgrid.q2_max]]))
+    return subgrids
+
+
+def _regrid_batch(args):
+    """Interpolate a batch of members onto the new knots, (pdf_path, members, x_knots, target_q2)
+
+    Returns a dictionary {member: list(GridPDF)}
+    """
+    pdf_path, members, x_knots, target_q2 = args
+    stack = stack_members(PDF(pdf_path, record=False), members)
+    batch = [[] for _ in members]
+    for subgrid, q2 in zip(stack, target_q2):
+        # All points of the new subgrid, x in the outer loop as in the LHAPDF files
+        x_points, q2_points = np.meshgrid(x_knots, q2, indexing="ij")
+        values = interpolate([subgrid], x_points.ravel(), q2_points.ravel())
+        for member_grids, member_values in zip(batch, values):
+            member_grids.append(GridPDF(x_knots, q2, subgrid.flav, member_values))
+    return dict(zip(members, batch))
+
+
+def regrid(pdf, x_knots, q_knots, set_dir, members=None, jobs=None):
+    """Write down a new PDF set with the content of ``pdf`` interpolated onto new knots
+
+    Parameters
+    ----------
+        pdf: PDF
+            original PDF set
+        x_knots: list(float)
+            new knots in x
+        q_knots: list(float)
+            new knots in Q (GeV, not Q2, as in the LHAPDF files)
+        set_dir: Path or str
+            folder of the new set, a name is understood as a folder in ``environment.datapath``
+        members: list(int)
+            members to regrid, by default all of them.
+            A selection of members is written as a partial set with the original numbering
+        jobs: int
+            number of processes interpolating and writing the members (default: number of cpus)
+
+    Returns
+    -------
+        new_pdf: PDF
+    """
+    set_dir = Path(set_dir)
+    if set_dir.parent == Path("."):
+        set_dir = environment.datapath / set_dir
+    if members is None:
+        members = pdf.members
+    members = sorted(members)
+    missing = set(members) - set(pdf.members)
+    if missing:
+        raise ValueError(f"Members {sorted(missing)} of {pdf.name} not available")
+    x_knots = np.unique(np.asarray(x_knots, dtype=np.float64))
+    q2_knots = np.unique(np.asarray(q_knots, dtype=np.float64) ** 2)
+
+    # All members share the same subgrids
+    stack = stack_members(pdf, members[:1])
+    x_min = min(i.x[0] for i in stack)
+    x_max = max(i.x[-1] for i in stack)
+    if x_knots[0] < x_min or x_knots[-1] > x_max:
+        logger.warning("Knots outside [%g, %g] are frozen to the boundaries", x_min, x_max)
+    target_q2 = _target_subgrids(stack, q2_knots)
+
+    # Make sure that there is work for all processes
+    nprocs = jobs or os.cpu_count() or 1
+    batch_size = max(1, min(BATCH_SIZE, -(-len(members) // nprocs)))
+    batches = [
+        (pdf.path, members[first : first + batch_size], x_knots, target_q2)
+        for first in range(0, len(members), batch_size)
+    ]
+    new_members = {}
+    if jobs == 1 or len(batches) == 1:
+        results = map(_regrid_batch, batches)
+    else:
+        # Parsing and interpolating are CPU bound, use processes rather than threads
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_regrid_batch, batches))
+    for result in results:
+        new_members.update(result)
+
+    q_range = np.sqrt([target_q2[0][0], target_q2[-1][-1]])
+    info = {
+        **pdf.info,
+        "XMin": float(x_knots[0]),
+        "XMax": float(x_knots[-1]),
+        "QMin": float(q_range[0]),
+        "QMax": float(q_range[1]),
+    }
+    logger.info("Writing %d members of %s to %s", len(new_members), pdf.name, set_dir)
+    return write_pdf(set_dir, info, new_members, jobs=jobs)
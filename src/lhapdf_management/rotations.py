@@ -0,0 +1,131 @@
+"""
+Rotation of the PDF grids from the flavour basis (PDG ids) to other bases
+
+The rotation matrix for a given list of flavours is built only once and cached,
+the rotation of all members of a set is then a single matrix product per subgrid.
+Flavours missing from the set (usually the photon or the top quark) are taken to be zero.
+
+Example
+-------
+
+>>> from lhapdf_management.rotations import rotate_members, basis_labels
+>>> rotated = rotate_members(pdf)  # one (members, x*q, basis) array per subgrid
+>>> labels = basis_labels("evolution")
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+# Ordered as in the definition of the non-singlet combinations (u, d, s, c, b, t)
+_QUARKS = (2, 1, 3, 4, 5, 6)
+_GLUON = 21
+_PHOTON = 22
+
+
+def _plus(quark):
+    """q + qbar"""
+    return {quark: 1.0, -quark: 1.0}
+
+
+def _minus(quark):
+    """q - qbar"""
+    return {quark: 1.0, -quark: -1.0}
+
+
+def _combine(*terms):
+    """Sum the given {pdg: coefficient} terms, each of them given as (factor, term)"""
+    result = {}
+    for factor, term in terms:
+        for pdg, coefficient in term.items():
+            result[pdg] = result.get(pdg, 0.0) + factor * coefficient
+    return result
+
+
+def _evolution_basis():
+    """Singlet, gluon, valence and the non-singlet T_i/V_i combinations,
+    with i = 3, 8, 15, 24, 35 (i.e., k^2 - 1 for the first k quarks)"""
+    basis = {
+        "photon": {_PHOTON: 1.0},
+        "Sigma": _combine(*((1, _plus(q)) for q in _QUARKS)),
+        "g": {_GLUON: 1.0},
+        "V": _combine(*((1, _minus(q)) for q in _QUARKS)),
+    }
+    for label, component in (("V", _minus), ("T", _plus)):
+        for k in range(2, len(_QUARKS) + 1):
+            lighter = [(1, component(q)) for q in _QUARKS[: k - 1]]
+            basis[f"{label}{k**2 - 1}"] = _combine(*lighter, (1 - k, component(_QUARKS[k - 1])))
+    return basis
+
+
+BASES = {"evolution": _evolution_basis()}
+
+
+def basis_labels(basis="evolution"):
+    """Name of the elements of the basis, in the order used by the rotation"""
+    return list(BASES[basis])
+
+
+@lru_cache(maxsize=None)
+def _rotation_matrix(flavours, basis):
+    definition = BASES[basis]
+    matrix = np.zeros((len(definition), len(flavours)))
+    for row, combination in enumerate(definition.values()):
+        for column, pdg in enumerate(flavours):
+            matrix[row, column] = combination.get(pdg, 0.0)
+    matrix.flags.writeable = False
+    return matrix
+
+
+def rotation_matrix(flavours, basis="evolution"):
+    """Matrix rotating the given flavours (PDG ids, as in ``GridPDF.flav``) to the basis
+
+    Parameters
+    ----------
+        flavours: list(int)
+            PDG ids of the columns of the grid, 0 is understood as the gluon
+        basis: str
+            target basis, one of ``BASES``
+
+    Returns
+    -------
+        matrix: np.ndarray
+            (read-only) array of shape (len(basis), len(flavours))
+    """
+    flavours = tuple(_GLUON if int(i) == 0 else int(i) for i in np.ravel(flavours))
+    return _rotation_matrix(flavours, basis)
+
+
+def rotate(grid, flavours, basis="evolution"):
+    """Rotate an array whose last axis runs over the given flavours"""
+    return np.asarray(grid) @ rotation_matrix(flavours, basis).T
+
+
+def rotate_members(pdf, members=None, basis="evolution"):
+    """Rotate the grids of several members of a PDF at once
+
+    Parameters
+    ----------
+        pdf: PDF
+            PDF set (or any object implementing ``get_member_grids``)
+        members: list(int)
+            members to rotate, by default all of them
+        basis: str
+            target basis, one of ``BASES``
+
+    Returns
+    -------
+        rotated: list(np.ndarray)
+            for every subgrid, an array of shape (members, x*q, len(basis))
+    """
+    if members is None:
+        members = pdf.members
+    all_grids = [pdf.get_member_grids(i) for i in members]
+    rotated = []
+    for subgrids in zip(*all_grids):
+        stack = np.stack([i.grid for i in subgrids])
+        matrix = rotation_matrix(subgrids[0].flav, basis)
+        # Flatten the members and the points into a single matrix for a single product
+        product = stack.reshape(-1, stack.shape[-1]) @ matrix.T
+        rotated.append(product.reshape(*stack.shape[:-1], len(matrix)))
+    return rotated
@@ -7,24 +7,40 @@ as a drop-in replacement.
 
 It accepts the following commands:
 
+    compress: compress the grids of installed PDF sets
+    compress-replicas: select a smaller set of representative replicas of a Monte Carlo set
+    du: show the disk usage and last access of installed PDF sets
     install: download and install PDF sets
     list: list available (or installed) PDF sets
+    prefetch: install and warm up the PDF sets (and members) listed in a job manifest
+    prune: remove the least recently used PDF sets
+    regrid: interpolate an installed PDF set onto new x/Q knots and write it as a new set
+    serve: keep PDF sets in memory and serve them through a Unix socket
     show: show some information about a given PDF set
+    stage: mirror installed PDF sets to local storage
     update: update the PDF index
+    upgrade: upgrade installed PDF sets (e.g., all outdated sets with --outdated)
+    validate: check that installed PDF sets are sane (sum rules, NaNs, knots...)
+    verify: verify the integrity of installed PDF sets
 
 e.g.,
     lhapdf-management install NNPDF40MC_nnlo_as_01180
     lhapdf-management update --init
 """
 import argparse
+from fnmatch import fnmatch
+import json
 import logging
 from pathlib import Path
 import sys
+import time
 
 import yaml
 
-from lhapdf_management import management
+from lhapdf_management import catalog, management, profiling, usage, validation
 from lhapdf_management.configuration import DEFAULT_CONF, environment
+from lhapdf_management.net_utilities import _byte_print
+from lhapdf_management.pdfsets import COMPRESSION_FORMATS
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +52,38 @@ def _filter_by_pattern(input_list, pattern):
     return input_list
 
 
+def _print_size_report(sizes):
+    """Print a table with the download and extracted size of every PDF and the total"""
+    width = max(len(i) for i in list(sizes) + ["Total"])
+    print(f"{'PDF':<{width}}  {'Download':>12}  {'Disk':>12}")
+    total_size = total_disk = 0
+    unknown_disk = False
+    for name, remote_size in sizes.items():
+        if remote_size is None:
+            print(f"{name:<{width}}  {'not found':>12}")
+            continue
+        total_size += remote_size.size
+        if remote_size.extracted_size is None:
+            unknown_disk = True
+            disk = "?"
+        else:
+            total_disk += remote_size.extracted_size
+            disk = _byte_print(remote_size.extracted_size)
+        print(f"{name:<{width}}  {_byte_print(remote_size.size):>12}  {disk:>12}")
+    total_disk = f"{'>' if unknown_disk else ''}{_byte_print(total_disk)}"
+    print("-" * (width + 28))
+    print(f"{'Total':<{width}}  {_byte_print(total_size):>12}  {total_disk:>12}")
+
+
+def _write_profile(output_format, output_file=None):
+    """Print (or write to a file) the profiling report"""
+    profiling_report = profiling.report(output_format)
+    if output_file is None:
+        print(profiling_report, file=sys.stderr)
+    else:
+        output_file.write_text(profiling_report)
+
+
 def _init_config_file(lhadir_path):
     """Create the lhapdf.conf config file if it doesn't exist."""
     config_path = lhadir_path / "lhapdf.conf"
@@ -58,12 +106,11 @@ class Runner:
 
     def __init__(self, interactive=False):
         # Accepted commands
-        commands = [i for i in dir(self) if not i.startswith("_")]
+        commands = [i.replace("_", "-") for i in dir(self) if not i.startswith("_")]
 
         # Create aliases
         self.ls = self.list
         self.get = self.install
-        self.upgrade = lambda *x: self.install(*(list(x) + ["--upgrade"]))
 
         self._interactive = interactive
 
@@ -90,6 +137,14 @@ class Runner:
             "--sources", type=str, nargs="+", default=[], help="Sources to look for remote data"
         )
         main_parser.add_argument("--verbose", action="store_true", help="Increase verbosity level")
+        main_parser.add_argument(
+            "--profile",
+            choices=profiling.OUTPUT_FORMATS,
+            help="Time the internal operations and print a report at the end",
+        )
+        main_parser.add_argument(
+            "--profile-output", type=Path, help="Write the profiling report to a file"
+        )
 
         # First ask for the command (and other global variables)
         self._parser = ArgumentParser(parents=[main_parser])
@@ -105,6 +160,8 @@ class Runner:
             environment.debug_logger()
         for new_source in main_args.sources:
             environment.add_source(new_source)
+        if main_args.profile:
+            profiling.enable()
 
         # Select command (and add it to the program name which is useful for the error
         # and I hope it doesn't break anything in the way
@@ -112,9 +169,12 @@ class Runner:
         self._parser.prog += f" {prog_command}"
 
         try:
-            getattr(self, prog_command)(*remaining_args)
+            getattr(self, prog_command.replace("-", "_"))(*remaining_args)
         except AttributeError:
             main_parser.error(f"Unknown command '{prog_command}' ({' '.join(remaining_args)})")
+        finally:
+            if main_args.profile:
+                _write_profile(main_args.profile, main_args.profile_output)
 
     def list(self, *extra_args):
         """List available PDF sets, optionally filtered and/or categorised by status"""
@@ -125,9 +185,14 @@ class Runner:
             "--outdated", help="Show installed outdated sets", action="store_true"
         )
         list_args.add_argument("--codes", help="Show ID codes", action="store_true")
+        list_args.add_argument(
+            "--where",
+            help="Show only installed sets whose metadata matches the query, "
+            "e.g., 'ErrorType=replicas and NumMembers>100'",
+        )
         args = self._parser.parse_args(extra_args)
 
-        if args.installed or args.outdated:
+        if args.installed or args.outdated or args.where:
             index_db = management.get_installed_list()
         else:
             index_db = management.get_reference_list()
@@ -135,8 +200,15 @@ class Runner:
         # If any of the patterns matches a PDF, the PDF will be printed
         index_db = _filter_by_pattern(index_db, args.PATTERNS)
 
+        if args.where:
+            try:
+                selected = set(catalog.query(args.where))
+            except ValueError as e:
+                self._parser.error(f"Invalid query: {e}")
+            index_db = [i for i in index_db if i.name in selected]
+
         if args.outdated:
-            index_db = [i for i in index_db if i.version > i.load().version]
+            index_db = [i for i in index_db if i.version > i.load(record=False).version]
 
         if self._interactive:
             return index_db
@@ -158,7 +230,7 @@ class Runner:
 
         all_info = []
         for pdf_set in index_db:
-            pdf = pdf_set.load()
+            pdf = pdf_set.load(record=False)
             out = f"""{pdf}
 {"="*len(pdf.name)}
 LHAPDF ID: {pdf_set.id_code:d}
@@ -169,6 +241,54 @@ Error type: {pdf.error_type}"""
             all_info.append(out)
         print("\n\n\n".join(all_info))
 
+    def serve(self, *extra_args):
+        """Keep PDF sets resident in memory and serve them through a Unix socket"""
+        from lhapdf_management import server
+
+        serve_args = self._parser.add_argument_group(
+            "serve arguments", description=self.serve.__doc__
+        )
+        serve_args.add_argument(
+            "--socket",
+            type=Path,
+            default=server.default_socket_path(),
+            help="Path of the Unix socket (default: %(default)s)",
+        )
+        serve_args.add_argument(
+            "--max-sets",
+            type=int,
+            default=server.DEFAULT_MAX_SETS,
+            help="Maximum number of sets kept in memory (default: %(default)s)",
+        )
+        args = self._parser.parse_args(extra_args)
+        server.serve(args.socket, max_sets=args.max_sets)
+
+    def stage(self, *extra_args):
+        """Mirror installed PDF sets to (node-local) storage"""
+        stage_args = self._parser.add_argument_group(
+            "stage arguments", description=self.stage.__doc__
+        )
+        stage_args.add_argument("PATTERNS", nargs="+", help="Patterns to match PDF set against")
+        stage_args.add_argument(
+            "--to", type=Path, required=True, help="Destination folder (e.g., /local/scratch)"
+        )
+        stage_args.add_argument(
+            "--jobs",
+            type=int,
+            default=management.DEFAULT_JOBS,
+            help="Number of files copied concurrently (default: %(default)s)",
+        )
+        args = self._parser.parse_args(extra_args)
+
+        index_db = list(_filter_by_pattern(management.get_installed_list(), args.PATTERNS))
+        if not index_db:
+            logger.error(f"No installed PDF found matching: {' '.join(args.PATTERNS)}")
+            return False
+        management.stage_pdfs(index_db, args.to, jobs=args.jobs)
+        if not self._interactive:
+            print(f"Prepend {args.to} to the LHAPDF paths to use the staged sets")
+        return True
+
     def update(self, *extra_args):
         """Download and install a new PDF set index file"""
         update_args = self._parser.add_argument_group(
@@ -188,6 +308,349 @@ Error type: {pdf.error_type}"""
 
         return management.update_reference_file()
 
+    def compress(self, *extra_args):
+        """Compress the .dat files of installed PDF sets.
+        Note that LHAPDF cannot read compressed sets."""
+        compress_args = self._parser.add_argument_group(
+            "compress arguments", description=self.compress.__doc__
+        )
+        compress_args.add_argument("PATTERNS", nargs="+", help="Patterns to match PDF set against")
+        compress_args.add_argument(
+            "--format", choices=list(COMPRESSION_FORMATS), default="gz", help="Compression format"
+        )
+        compress_args.add_argument(
+            "--jobs",
+            type=int,
+            default=management.DEFAULT_JOBS,
+            help="Number of files compressed concurrently (default: %(default)s)",
+        )
+        args = self._parser.parse_args(extra_args)
+
+        index_db = _filter_by_pattern(management.get_installed_list(), args.PATTERNS)
+        set_dirs = [i.load(record=False).path for i in index_db]
+        set_dirs = [i for i in set_dirs if i.is_dir() and not i.is_symlink()]
+        ncompressed = management.compress_pdfs(set_dirs, compression=args.format, jobs=args.jobs)
+        logger.info("Compressed %d files from %d sets", ncompressed, len(set_dirs))
+        return True
+
+    def compress_replicas(self, *extra_args):
+        """Write a new Monte Carlo PDF set with the subset of replicas of an installed set
+        which best reproduces its mean, standard deviation and correlations"""
+        from lhapdf_management import compressor
+
+        compress_args = self._parser.add_argument_group(
+            "compress-replicas arguments", description=self.compress_replicas.__doc__
+        )
+        compress_args.add_argument("NAME", help="Monte Carlo PDF set to compress")
+        compress_args.add_argument("REPLICAS", type=int, help="Number of replicas of the new set")
+        compress_args.add_argument(
+            "--output", help="Name (or folder) of the new PDF set (default: NAME_REPLICAS)"
+        )
+        compress_args.add_argument(
+            "--trials",
+            type=int,
+            default=compressor.DEFAULT_TRIALS,
+            help="Number of independent searches (default: %(default)s)",
+        )
+        compress_args.add_argument(
+            "--iterations",
+            type=int,
+            default=compressor.DEFAULT_ITERATIONS,
+            help="Number of steps of every search (default: %(default)s)",
+        )
+        compress_args.add_argument("--seed", type=int, default=0, help="Random seed")
+        compress_args.add_argument(
+            "--jobs",
+            type=int,
+            default=management.DEFAULT_JOBS,
+            help="Number of processes used for the searches (default: %(default)s)",
+        )
+        args = self._parser.parse_args(extra_args)
+
+        index_db = [i for i in management.get_installed_list() if i.name == args.NAME]
+        if not index_db:
+            self._parser.error(f"The PDF {args.NAME} is not installed")
+        output = args.output or f"{args.NAME}_{args.REPLICAS}"
+        pdf = compressor.compress_replicas(
+            index_db[0].load(record=False),
+            args.REPLICAS,
+            output,
+            trials=args.trials,
+            iterations=args.iterations,
+            seed=args.seed,
+            jobs=args.jobs,
+        )
+        if self._interactive:
+            return pdf
+        logger.info("Compressed %s written to %s", args.NAME, pdf.path)
+
+    def du(self, *extra_args):
+        """Show the disk usage and the last access time of the installed PDF sets"""
+        du_args = self._parser.add_argument_group("du arguments", description=self.du.__doc__)
+        du_args.add_argument("PATTERNS", nargs="*", help="Patterns to match PDF set against")
+        du_args.add_argument(
+            "--jobs",
+            type=int,
+            default=management.DEFAULT_JOBS,
+            help="Number of sets measured concurrently (default: %(default)s)",
+        )
+        args = self._parser.parse_args(extra_args)
+
+        set_usage = usage.disk_usage(jobs=args.jobs)
+        if args.PATTERNS:
+            set_usage = [i for i in set_usage if any(fnmatch(i.name, k) for k in args.PATTERNS)]
+        if self._interactive:
+            return set_usage
+
+        for i in set_usage:
+            last_access = time.strftime("%Y-%m-%d %H:%M", time.localtime(i.last_access))
+            print(f"{_byte_print(i.size):>12}  {last_access}  {i.name}")
+        print(f"{_byte_print(sum(i.size for i in set_usage)):>12}  total")
+
+    def prefetch(self, *extra_args):
+        """Install the PDF sets listed in a job manifest (YAML mapping of set names to members)
+        and warm up the page cache for the requested members, reporting when every set is ready.
+        It can run in the background while the job initialises."""
+        from lhapdf_management import prefetch
+
+        prefetch_args = self._parser.add_argument_group(
+            "prefetch arguments", description=self.prefetch.__doc__
+        )
+        prefetch_args.add_argument("MANIFEST", type=Path, help="Job manifest")
+        prefetch_args.add_argument(
+            "--no-install", action="store_true", help="Do not install the missing sets"
+        )
+        prefetch_args.add_argument(
+            "--partial",
+            action="store_true",
+            help="Install only the requested members of the missing sets",
+        )
+        prefetch_args.add_argument(
+            "--jobs",
+            type=int,
+            default=prefetch.DEFAULT_JOBS,
+            help="Number of sets prepared concurrently (default: %(default)s)",
+        )
+        prefetch_args.add_argument(
+            "--status", type=Path, help="Write the readiness of every set to this file (JSON)"
+        )
+        args = self._parser.parse_args(extra_args)
+
+        prefetcher = prefetch.prefetch(
+            args.MANIFEST,
+            install=not args.no_install,
+            partial=args.partial,
+            # The members are read by another process, the page cache is what can be warmed up
+            load=self._interactive,
+            jobs=args.jobs,
+        )
+        if self._interactive:
+            return prefetcher
+
+        for status in prefetcher.as_completed():
+            if status.state == "ready":
+                print(f"{status.name}: ready ({status.loaded} members)", flush=True)
+            else:
+                print(f"{status.name}: FAILED ({status.error})", flush=True)
+        if args.status is not None:
+            readiness = {
+                k: {"state": v.state, "members": v.loaded, "error": v.error}
+                for k, v in prefetcher.status().items()
+            }
+            args.status.write_text(json.dumps(readiness, indent=1))
+        if not prefetcher.ready:
+            sys.exit(1)
+
+    def prune(self, *extra_args):
+        """Remove the least recently used PDF sets (together with their tarballs and caches)"""
+        prune_args = self._parser.add_argument_group(
+            "prune arguments", description=self.prune.__doc__
+        )
+        prune_args.add_argument(
+            "--keep-size",
+            type=usage.parse_size,
+            help="Remove sets until the total size is below this (e.g., 200G)",
+        )
+        prune_args.add_argument(
+            "--older-than",
+            type=usage.parse_age,
+            help="Remove sets which have not been used for this long (e.g., 90d, 12h)",
+        )
+        prune_args.add_argument(
+            "--dryrun", action="store_true", help="Only show which sets would be removed"
+        )
+        args = self._parser.parse_args(extra_args)
+        if args.keep_size is None and args.older_than is None:
+            self._parser.error("At least one of --keep-size or --older-than is necessary")
+
+        removed = usage.prune_pdfs(
+            keep_size=args.keep_size, older_than=args.older_than, dry=args.dryrun
+        )
+        if self._interactive:
+            return removed
+
+        action = "Would remove" if args.dryrun else "Removed"
+        for i in removed:
+            print(f"{action} {i.name} [{_byte_print(i.size)}]")
+        print(f"{_byte_print(sum(i.size for i in removed))} freed")
+
+    def regrid(self, *extra_args):
+        """Interpolate all members of an installed PDF set onto new x/Q knots
+        and write the result as a new PDF set"""
+        from lhapdf_management.regrid import parse_knots, regrid
+
+        regrid_args = self._parser.add_argument_group(
+            "regrid arguments", description=self.regrid.__doc__
+        )
+        regrid_args.add_argument("NAME", help="PDF set to regrid")
+        regrid_args.add_argument("OUTPUT", help="Name (or folder) of the new PDF set")
+        regrid_args.add_argument(
+            "--x",
+            type=parse_knots,
+            required=True,
+            help="New x knots, comma separated or as log:start:stop:n (e.g., log:1e-5:1:50)",
+        )
+        regrid_args.add_argument(
+            "--q",
+            type=parse_knots,
+            required=True,
+            help="New Q knots (GeV), comma separated or as log:start:stop:n",
+        )
+        regrid_args.add_argument(
+            "--members",
+            type=management.parse_members,
+            help="Members to regrid (e.g., 0-99), the new set is partial and keeps their numbering",
+        )
+        regrid_args.add_argument(
+            "--jobs",
+            type=int,
+            default=management.DEFAULT_JOBS,
+            help="Number of processes interpolating and writing the members (default: %(default)s)",
+        )
+        args = self._parser.parse_args(extra_args)
+
+        index_db = [i for i in management.get_installed_list() if i.name == args.NAME]
+        if not index_db:
+            self._parser.error(f"The PDF {args.NAME} is not installed")
+        pdf = regrid(
+            index_db[0].load(record=False),
+            args.x,
+            args.q,
+            args.OUTPUT,
+            members=args.members,
+            jobs=args.jobs,
+        )
+        if self._interactive:
+            return pdf
+        logger.info("Regridded %s written to %s", args.NAME, pdf.path)
+
+    def verify(self, *extra_args):
+        """Verify the integrity of installed PDF sets against their install manifest"""
+        verify_args = self._parser.add_argument_group(
+            "verify arguments", description=self.verify.__doc__
+        )
+        verify_args.add_argument("PATTERNS", nargs="*", help="Patterns to match PDF set against")
+        verify_args.add_argument(
+            "--jobs",
+            type=int,
+            default=management.DEFAULT_JOBS,
+            help="Number of sets verified concurrently (default: %(default)s)",
+        )
+        args = self._parser.parse_args(extra_args)
+
+        index_db = management.get_installed_list()
+        index_db = _filter_by_pattern(index_db, args.PATTERNS)
+        set_dirs = [i.load(record=False).path for i in index_db]
+        # Sets installed in archive-only mode have no manifest to check
+        set_dirs = [i for i in set_dirs if i.is_dir()]
+
+        results = management.verify_pdfs(set_dirs, jobs=args.jobs)
+        if self._interactive:
+            return {k.name: v for k, v in results.items()}
+
+        all_ok = True
+        for set_dir, problems in results.items():
+            if problems is None:
+                print(f"{set_dir.name}: no manifest found, skipping")
+            elif problems:
+                all_ok = False
+                print(f"{set_dir.name}: FAILED")
+                for problem in problems:
+                    print(f"    {problem}")
+            else:
+                print(f"{set_dir.name}: ok")
+        if not all_ok:
+            sys.exit(1)
+
+    def validate(self, *extra_args):
+        """Load installed PDF sets and check that all members are sane"""
+        validate_args = self._parser.add_argument_group(
+            "validate arguments", description=self.validate.__doc__
+        )
+        validate_args.add_argument("PATTERNS", nargs="*", help="Patterns to match PDF set against")
+        validate_args.add_argument(
+            "--jobs",
+            type=int,
+            default=management.DEFAULT_JOBS,
+            help="Number of sets validated concurrently (default: %(default)s)",
+        )
+        validate_args.add_argument("--output", type=Path, help="Write the full report (JSON)")
+        args = self._parser.parse_args(extra_args)
+
+        index_db = _filter_by_pattern(management.get_installed_list(), args.PATTERNS)
+        pdf_paths = [i.load(record=False).path for i in index_db]
+        reports = validation.validate_pdfs(pdf_paths, jobs=args.jobs)
+        if args.output is not None:
+            args.output.write_text(json.dumps(reports, indent=1))
+        if self._interactive:
+            return reports
+
+        for report in reports:
+            status = "ok" if report["ok"] else "FAILED"
+            print(
+                f"{report['name']}: {status} ({report.get('members', 0)} members, "
+                f"loaded in {report['load_time']:.2f}s, {_byte_print(report['grid_bytes'])}, "
+                f"{len(report['warnings'])} warnings)"
+            )
+            for failure in report["failures"]:
+                print(f"    {failure}")
+        if not all(i["ok"] for i in reports):
+            sys.exit(1)
+
+    def upgrade(self, *extra_args):
+        """Upgrade installed PDF sets, either the given ones or all outdated sets"""
+        if "--outdated" not in extra_args:
+            return self.install(*extra_args, "--upgrade")
+
+        upgrade_args = self._parser.add_argument_group(
+            "upgrade arguments", description=self.upgrade.__doc__
+        )
+        upgrade_args.add_argument("PATTERNS", nargs="*", help="Patterns to match PDF set against")
+        upgrade_args.add_argument(
+            "--outdated", help="Upgrade all installed outdated sets", action="store_true"
+        )
+        upgrade_args.add_argument(
+            "--jobs",
+            type=int,
+            default=management.DEFAULT_JOBS,
+            help="Number of sets upgraded concurrently (default: %(default)s)",
+        )
+        upgrade_args.add_argument("--keep", help="Keep the downloaded tarball", action="store_true")
+        args = self._parser.parse_args(extra_args)
+
+        outdated = list(_filter_by_pattern(management.get_outdated_list(), args.PATTERNS))
+        if not outdated:
+            logger.info("All installed PDF sets are up to date")
+            return True
+
+        results = management.upgrade_pdfs(outdated, jobs=args.jobs, keep=args.keep)
+        if self._interactive:
+            return results
+
+        for name, success in results.items():
+            print(f"{name}: {'upgraded' if success else 'FAILED'}")
+        return all(results.values())
+
     def install(self, *extra_args):
         """Download and install new PDF set data files"""
         install_args = self._parser.add_argument_group(
@@ -202,8 +665,35 @@ Error type: {pdf.error_type}"""
             action="store_true",
         )
         install_args.add_argument("--keep", help="Keep the downloaded tarball", action="store_true")
-        install_args.add_argument("--dryrun", help="Don't actually download", action="store_true")
+        install_args.add_argument(
+            "--dryrun",
+            help="Don't actually download, print the download size and disk usage instead",
+            action="store_true",
+        )
+        install_args.add_argument(
+            "--jobs",
+            type=int,
+            default=management.DEFAULT_JOBS,
+            help="Number of concurrent size queries or extraction threads (default: %(default)s)",
+        )
+        install_args.add_argument(
+            "--archive-only",
+            help="Keep only the tarball without extracting it, the PDF is read from the tarball",
+            action="store_true",
+        )
+        install_args.add_argument(
+            "--members",
+            type=management.parse_members,
+            help="Install only the given members (e.g., 0-99,150), the set is marked as partial",
+        )
+        install_args.add_argument(
+            "--link",
+            choices=management.LINK_MODES,
+            help="If the set is found unpacked in a local source (e.g., CVMFS), link it from there",
+        )
         args = self._parser.parse_args(extra_args)
+        if args.members is not None and (args.keep or args.archive_only):
+            self._parser.error("--members cannot be used together with --keep or --archive-only")
 
         # Check whether we have a pattern-like argument
         pdfs_to_install = args.pdf_name
@@ -214,9 +704,22 @@ Error type: {pdf.error_type}"""
                 logger.error(f"No PDF found matching the given pattern: {' '.join(args.pdf_name)}")
                 return False
 
+        if args.dryrun:
+            sizes = management.get_download_sizes(pdfs_to_install, jobs=args.jobs)
+            if self._interactive:
+                return sizes
+            _print_size_report(sizes)
+            return all(i is not None for i in sizes.values())
+
         for pdf_name in pdfs_to_install:
             if not management.install_pdf(
-                pdf_name, dry=args.dryrun, upgrade=args.upgrade, keep=args.keep
+                pdf_name,
+                upgrade=args.upgrade,
+                keep=args.keep,
+                archive_only=args.archive_only,
+                link_mode=args.link,
+                jobs=args.jobs,
+                members=args.members,
             ):
                 return False
 
@@ -0,0 +1,373 @@
+"""
+Local PDF server
+
+Keeps ``PDF`` objects resident in memory and answers batched queries
+over a Unix domain socket, so that short-lived processes can get metadata
+and grids without having to parse the files again.
+
+Every message (in both directions) is a frame made of a fixed-size prefix
+containing the size of a JSON header and of a binary payload.
+The payload is the concatenation of the raw (float64) arrays described in the header.
+
+Example
+-------
+
+>>> lhapdf-management serve --max-sets 10 &
+>>> from lhapdf_management.server import PDFClient
+>>> pdf = PDFClient().load("NNPDF40_nnlo_as_01180")
+>>> grids = pdf.get_member_grids(0)
+>>> xf = pdf.xfxQ2([0], [21, 2], x, q2)
+"""
+
+from collections import OrderedDict
+import json
+import logging
+import os
+from pathlib import Path
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+
+import numpy as np
+
+from .configuration import environment
+from .interpolation import interpolate, stack_members
+from .pdfsets import TARBALL_SUFFIX, PDF, GridPDF
+
+logger = logging.getLogger(__name__)
+
+_PREFIX = struct.Struct("!IQ")
+_ARRAYS = ("x", "q2", "flav", "grid")
+# Keys of the queries whose values are sent as arrays
+_QUERY_ARRAYS = ("x", "q2")
+DEFAULT_MAX_SETS = 16
+
+
+def default_socket_path():
+    """Socket used by default by both the server and the clients"""
+    path = os.environ.get("LHAPDF_MANAGEMENT_SOCKET")
+    if path is None:
+        path = Path(tempfile.gettempdir()) / f"lhapdf-management-{os.getuid()}.sock"
+    return Path(path)
+
+
+def _recv_exactly(sock, size):
+    """Receive exactly ``size`` bytes from the socket, return None if the connection is closed"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        nbytes = sock.recv_into(view[received:])
+        if nbytes == 0:
+            return None
+        received += nbytes
+    return buffer
+
+
+def _send_frame(sock, header, arrays=()):
+    """Send a JSON header followed by the raw content of the arrays"""
+    arrays = [np.ascontiguousarray(i, dtype=np.float64) for i in arrays]
+    header["arrays"] = [i.shape for i in arrays]
+    raw_header = json.dumps(header, default=str).encode()
+    payload_size = sum(i.nbytes for i in arrays)
+    sock.sendall(_PREFIX.pack(len(raw_header), payload_size) + raw_header)
+    for array in arrays:
+        sock.sendall(memoryview(array).cast("B"))
+
+
+def _recv_frame(sock):
+    """Receive a frame, return the header and the list of arrays
+    or None if the connection has been closed"""
+    prefix = _recv_exactly(sock, _PREFIX.size)
+    if prefix is None:
+        return None
+    header_size, payload_size = _PREFIX.unpack(prefix)
+    header = json.loads(_recv_exactly(sock, header_size))
+    payload = _recv_exactly(sock, payload_size) if payload_size else bytearray()
+    arrays = []
+    offset = 0
+    for shape in header.pop("arrays", []):
+        array = np.frombuffer(payload, dtype=np.float64, count=int(np.prod(shape)), offset=offset)
+        arrays.append(array.reshape(shape))
+        offset += array.nbytes
+    return header, arrays
+
+
+def _find_pdf(name):
+    """Look for the PDF in all paths of the environment"""
+    for possible_path in environment.paths:
+        for pdf_path in (possible_path / name, possible_path / f"{name}{TARBALL_SUFFIX}"):
+            if pdf_path.exists():
+                return PDF(pdf_path)
+    raise FileNotFoundError(f"Could not find {name} in the system.")
+
+
+class _PDFCache:
+    """Least-recently-used cache of PDF objects"""
+
+    def __init__(self, max_sets=DEFAULT_MAX_SETS):
+        self._max_sets = max_sets
+        self._pdfs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            pdf = self._pdfs.get(name)
+            if pdf is not None:
+                self._pdfs.move_to_end(name)
+                return pdf
+        pdf = _find_pdf(name)
+        with self._lock:
+            pdf = self._pdfs.setdefault(name, pdf)
+            self._pdfs.move_to_end(name)
+            while len(self._pdfs) > self._max_sets:
+                evicted, _ = self._pdfs.popitem(last=False)
+                logger.debug("Evicting %s from the cache", evicted)
+        return pdf
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    """Answer all the batches of queries sent through one connection"""
+
+    def handle(self):
+        while True:
+            frame = _recv_frame(self.request)
+            if frame is None:
+                return
+            header, query_arrays = frame
+            results = []
+            arrays = []
+            for query in header.get("queries", []):
+                for key in _QUERY_ARRAYS:
+                    if key in query:
+                        query[key] = query_arrays[query[key]]
+                try:
+                    results.append({"ok": True, "result": self._answer(query, arrays)})
+                except Exception as e:
+                    results.append({"ok": False, "error": f"{type(e).__name__}: {e}"})
+            _send_frame(self.request, {"results": results}, arrays)
+
+    def _answer(self, query, arrays):
+        """Answer one query, the arrays are appended to ``arrays``
+        and the result contains their position in the list"""
+        op = query["op"]
+        if op == "ping":
+            return "pong"
+        pdf = self.server.cache.get(query["set"])
+        if op == "info":
+            return pdf.info
+        if op == "members":
+            return pdf.members
+        if op == "grids":
+            members = {}
+            for member in query["members"]:
+                subgrids = []
+                for grid in pdf.get_member_grids(member):
+                    subgrids.append(list(range(len(arrays), len(arrays) + len(_ARRAYS))))
+                    arrays.extend(getattr(grid, key) for key in _ARRAYS)
+                members[str(member)] = subgrids
+            return members
+        if op == "xfxQ2":
+            stack = stack_members(pdf, query.get("members"))
+            xf = interpolate(stack, query["x"], query["q2"])
+            flavours = [int(i) for i in stack[0].flav]
+            if query.get("flavours") is not None:
+                missing = set(query["flavours"]) - set(flavours)
+                if missing:
+                    raise ValueError(f"Flavours {sorted(missing)} not in {query['set']}")
+                xf = xf[..., [flavours.index(i) for i in query["flavours"]]]
+            arrays.append(xf)
+            return len(arrays) - 1
+        raise ValueError(f"Unknown operation {op}")
+
+
+class PDFServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Server keeping PDF objects resident in memory"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=None, max_sets=DEFAULT_MAX_SETS):
+        if socket_path is None:
+            socket_path = default_socket_path()
+        self.socket_path = Path(socket_path)
+        # Remove a stale socket from a previous server
+        if self.socket_path.is_socket():
+            self.socket_path.unlink()
+        self.cache = _PDFCache(max_sets)
+        super().__init__(self.socket_path.as_posix(), _Handler)
+
+    def server_close(self):
+        super().server_close()
+        self.socket_path.unlink(missing_ok=True)
+
+
+def serve(socket_path=None, max_sets=DEFAULT_MAX_SETS):
+    """Run the server until interrupted"""
+    with PDFServer(socket_path, max_sets=max_sets) as server:
+        logger.info("Serving PDFs at %s", server.socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Server stopped by user")
+
+
+class PDFClient:
+    """Connection to a running ``PDFServer``"""
+
+    def __init__(self, socket_path=None):
+        if socket_path is None:
+            socket_path = default_socket_path()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(Path(socket_path).as_posix())
+        self._lock = threading.Lock()
+
+    def query(self, queries):
+        """Send a batch of queries and return the list of results.
+        Grids are returned as dictionaries of lists of GridPDF objects
+        and interpolations as arrays.
+        """
+        query_arrays = []
+        sent = []
+        for query in queries:
+            query = dict(query)
+            for key in _QUERY_ARRAYS:
+                if key in query:
+                    query_arrays.append(query[key])
+                    query[key] = len(query_arrays) - 1
+            sent.append(query)
+        with self._lock:
+            _send_frame(self._socket, {"queries": sent}, query_arrays)
+            header, arrays = _recv_frame(self._socket)
+        results = []
+        for query, answer in zip(queries, header["results"]):
+            if not answer["ok"]:
+                raise RuntimeError(f"Query {query} failed: {answer['error']}")
+            result = answer["result"]
+            if query["op"] == "grids":
+                result = {
+                    int(member): [GridPDF(*(arrays[i] for i in subgrid)) for subgrid in subgrids]
+                    for member, subgrids in result.items()
+                }
+            elif query["op"] == "xfxQ2":
+                result = arrays[result]
+            results.append(result)
+        return results
+
+    def load(self, name):
+        """Return a RemotePDF for the given PDF set"""
+        return RemotePDF(name, client=self)
+
+    def close(self):
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RemotePDF:
+    """PDF whose data is kept by a ``PDFServer``.
+    It reproduces the interface of ``PDF``.
+    """
+
+    def __init__(self, name, client=None, socket_path=None):
+        if client is None:
+            client = PDFClient(socket_path)
+        self._name = name
+        self._client = client
+        self._info = None
+        self._members = None
+        self._grid = {}
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def info(self):
+        """Information from the PDF .info file as a dictionary"""
+        if self._info is None:
+            (self._info,) = self._client.query([{"op": "info", "set": self._name}])
+        return self._info
+
+    @property
+    def description(self):
+        return self.info.get("SetDesc")
+
+    @property
+    def error_type(self):
+        return self.info.get("ErrorType")
+
+    @property
+    def version(self):
+        return self.info.get("DataVersion")
+
+    @property
+    def members(self):
+        """List of the members available"""
+        if self._members is None:
+            (self._members,) = self._client.query([{"op": "members", "set": self._name}])
+        return self._members
+
+    def get_members(self, members):
+        """Get several members in a single query"""
+        missing = [i for i in members if i not in self._grid]
+        if missing:
+            (grids,) = self._client.query(
+                [{"op": "grids", "set": self._name, "members": missing}]
+            )
+            self._grid.update(grids)
+        return {i: self._grid[i] for i in members}
+
+    def get_member_grids(self, i):
+        """Get a PDF member (as a list of GridPDF)"""
+        return self.get_members([int(i)])[int(i)]
+
+    def get_all_member_grids(self):
+        """Get all PDF members"""
+        return self.get_members(self.members)
+
+    def xfxQ2(self, members, flavours, x, q2):
+        """Interpolate xf(x, q2) in the server, only the result is sent back.
+        The interpolation is linear in (log x, log q2), see ``interpolation``
+
+        Parameters
+        ----------
+            members: list(int)
+                members to interpolate (None for all of them)
+            flavours: list(int)
+                PDG ids of the flavours (None for all of them)
+            x: np.ndarray
+                values of x
+            q2: np.ndarray
+                values of q2, same shape as ``x``
+
+        Returns
+        -------
+            xf: np.ndarray
+                array of shape (members, *x.shape, flavours)
+        """
+        x = np.asarray(x, dtype=np.float64)
+        q2 = np.broadcast_to(np.asarray(q2, dtype=np.float64), x.shape)
+        query = {"op": "xfxQ2", "set": self._name, "x": x, "q2": q2}
+        query["members"] = None if members is None else [int(i) for i in members]
+        query["flavours"] = None if flavours is None else [int(i) for i in flavours]
+        (xf,) = self._client.query([query])
+        return xf
+
+    def __getitem__(self, key):
+        """Return an item from the info file"""
+        item = self.info.get(key)
+        if item is None:
+            raise KeyError(f"key={key} not found in {self._name} info file")
+        return item
+
+    def __repr__(self):
+        return self._name
+
+    def __len__(self):
+        return len(self.members)
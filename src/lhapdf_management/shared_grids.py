@@ -0,0 +1,221 @@
+"""
+Share the grids of a PDF set between processes
+
+The arrays of all members of a PDF are written once to a file-backed memory map
+(by default under ``/dev/shm``) and any other process can attach to it by name
+obtaining zero-copy, read-only, ``GridPDF`` views.
+
+Example
+-------
+
+>>> from lhapdf_management.shared_grids import publish, attach
+>>> shared = publish(pdf)  # in the main process, loads all members once
+>>> shared_pdf = attach(shared.name)  # in every worker
+>>> grids = shared_pdf.get_member_grids(0)
+>>> shared.unlink()  # once all workers are done
+"""
+
+import json
+import logging
+import mmap
+import os
+from pathlib import Path
+import struct
+import tempfile
+import uuid
+
+import numpy as np
+
+from .pdfsets import GridPDF
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"LHAMSHM1"
+_HEADER = struct.Struct("<8sQ")
+_ALIGNMENT = 64
+_ARRAYS = ("x", "q2", "flav", "grid")
+
+
+def _default_dir():
+    """Prefer a memory-backed filesystem when available"""
+    shm = Path("/dev/shm")
+    if shm.is_dir() and os.access(shm, os.W_OK):
+        return shm
+    return Path(tempfile.gettempdir())
+
+
+def _resolve(name):
+    """Get the path of the shared file corresponding to a name"""
+    path = Path(name)
+    if path.parent == Path("."):
+        path = _default_dir() / name
+    return path
+
+
+def _align(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+class SharedPDF:
+    """Handle to a PDF published by ``publish``.
+    The process which published the PDF is responsible for unlinking it.
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+    @property
+    def name(self):
+        """Name to be passed to ``attach`` in other processes"""
+        return self._path.as_posix()
+
+    def unlink(self):
+        """Remove the shared grids, processes already attached keep their views"""
+        self._path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.unlink()
+
+    def __repr__(self):
+        return f"SharedPDF({self.name})"
+
+
+def publish(pdf, members=None, name=None):
+    """Write the grids of the given PDF to shared memory
+
+    Parameters
+    ----------
+        pdf: PDF
+            PDF to be shared
+        members: list(int)
+            Members to share, by default all of them
+        name: str
+            Name (or path) of the shared file, by default a unique name is generated
+
+    Returns
+    -------
+        shared: SharedPDF
+            handle to the shared grids
+    """
+    if members is None:
+        members = pdf.members
+    if name is None:
+        name = f"lhapdf_management_{pdf.name}_{uuid.uuid4().hex[:8]}"
+    path = _resolve(name)
+
+    # First compute the layout of the file
+    layout = {}
+    arrays = []
+    offset = 0
+    for member in members:
+        member_layout = []
+        for subgrid in pdf.get_member_grids(member):
+            subgrid_layout = {}
+            for key in _ARRAYS:
+                array = np.ascontiguousarray(getattr(subgrid, key), dtype=np.float64)
+                offset = _align(offset)
+                subgrid_layout[key] = (offset, array.shape)
+                arrays.append((offset, array))
+                offset += array.nbytes
+            member_layout.append(subgrid_layout)
+        layout[str(member)] = member_layout
+
+    metadata = json.dumps({"name": pdf.name, "info": pdf.info, "members": layout}, default=str)
+    metadata = metadata.encode()
+    data_start = _align(_HEADER.size + len(metadata))
+
+    # Write it down to a temporary file which is then renamed so that
+    # nobody can attach to a half-written set of grids
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with tmp_path.open("wb") as shared_file:
+        shared_file.write(_HEADER.pack(_MAGIC, len(metadata)))
+        shared_file.write(metadata)
+        for array_offset, array in arrays:
+            shared_file.seek(data_start + array_offset)
+            shared_file.write(array.tobytes())
+    tmp_path.replace(path)
+    logger.debug("Published %s to %s", pdf.name, path)
+    return SharedPDF(path)
+
+
+class SharedGridsPDF:
+    """Read-only view of a PDF published by another process.
+    It reproduces the interface of ``PDF`` for the metadata and the grids.
+    """
+
+    def __init__(self, name):
+        path = _resolve(name)
+        with path.open("rb") as shared_file:
+            self._mmap = mmap.mmap(shared_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, metadata_size = _HEADER.unpack_from(self._mmap)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} does not contain shared PDF grids")
+        metadata = json.loads(self._mmap[_HEADER.size : _HEADER.size + metadata_size])
+        self._path = path
+        self._name = metadata["name"]
+        self._info = metadata["info"]
+        self._layout = metadata["members"]
+        self._data_start = _align(_HEADER.size + metadata_size)
+        self._grid = {}
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def info(self):
+        return self._info
+
+    @property
+    def members(self):
+        """List of the members published"""
+        return sorted(int(i) for i in self._layout)
+
+    def _view(self, offset, shape):
+        return np.ndarray(
+            shape, dtype=np.float64, buffer=self._mmap, offset=self._data_start + offset
+        )
+
+    def get_member_grids(self, i):
+        """Get a PDF member (as a list of GridPDF) as views of the shared memory"""
+        i = str(i)
+        member = self._grid.get(i)
+        if member is not None:
+            return member
+        member_layout = self._layout.get(i)
+        if member_layout is None:
+            raise KeyError(f"Member {i} of {self._name} has not been published")
+        member = [
+            GridPDF(*(self._view(*subgrid[key]) for key in _ARRAYS)) for subgrid in member_layout
+        ]
+        self._grid[i] = member
+        return member
+
+    def get_all_member_grids(self):
+        """Get all shared PDF members"""
+        return {i: self.get_member_grids(i) for i in self.members}
+
+    def __getitem__(self, key):
+        """Return an item from the info file"""
+        item = self._info.get(key)
+        if item is None:
+            raise KeyError(f"key={key} not found in {self._name} info file")
+        return item
+
+    def __repr__(self):
+        return self._name
+
+    def __len__(self):
+        return len(self._layout)
+
+
+def attach(name):
+    """Attach to grids published by ``publish`` (possibly in a different process)"""
+    return SharedGridsPDF(name)
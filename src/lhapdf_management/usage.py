@@ -0,0 +1,303 @@
+"""
+Disk usage and access tracking of installed PDF sets
+
+Every time a set is opened or its members are read (but not when it is only inspected
+by the management commands), a line with the time and the name of the set is appended
+to an access log (``ACCESS_LOG_FILENAME``) in the folder where the set lives,
+at most once every ``RECORD_INTERVAL`` seconds per process.
+This is much cheaper (and more reliable) than relying on the atime of the files.
+The log is compacted under an exclusive lock, the writers hold a shared one.
+
+The log is used to prune the least recently used sets, either explicitly (``prune_pdfs``)
+or automatically after every installation when the environment variable
+``LHAPDF_MANAGEMENT_QUOTA`` is set (e.g., ``LHAPDF_MANAGEMENT_QUOTA=200G``).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import fcntl
+import logging
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from .configuration import environment
+from .pdfsets import TARBALL_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+ACCESS_LOG_FILENAME = ".access.log"
+# Serializes the pruning of the sets of a folder (between threads and processes)
+PRUNE_LOCK_FILENAME = ".prune.lock"
+QUOTA_VARIABLE = "LHAPDF_MANAGEMENT_QUOTA"
+DEFAULT_JOBS = 8
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+_AGE_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+# Prefix of the grids shared in memory (see shared_grids.publish)
+_SHARED_PREFIX = "lhapdf_management_"
+
+# Accesses to the same set are recorded at most once every this many seconds (per process)
+RECORD_INTERVAL = 300
+# Time of the last access recorded by this process for every set, {pdf_path: time}
+_recorded = {}
+_recorded_lock = threading.Lock()
+
+
+def parse_size(size):
+    """Parse a size such as 200G, 1.5T or 500M into bytes"""
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)i?B?\s*", size, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Cannot understand the size {size}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def parse_age(age):
+    """Parse an age such as 90d, 12h or 2w into seconds"""
+    match = re.fullmatch(r"\s*([\d.]+)\s*([smhdw]?)\s*", age)
+    if match is None:
+        raise ValueError(f"Cannot understand the age {age}")
+    return float(match.group(1)) * _AGE_UNITS[match.group(2) or "d"]
+
+
+def record_access(pdf_path):
+    """Append the access to the set at ``pdf_path`` to the access log of its folder.
+    The accesses of a process to a set are recorded at most once every ``RECORD_INTERVAL``
+    seconds so that it can be called for every use, failures (e.g., read-only folders)
+    are ignored.
+    """
+    now = time.time()
+    with _recorded_lock:
+        if now - _recorded.get(pdf_path, -RECORD_INTERVAL) < RECORD_INTERVAL:
+            return
+        _recorded[pdf_path] = now
+    pdf_path = Path(pdf_path)
+    name = pdf_path.name[: -len(TARBALL_SUFFIX)] if pdf_path.is_file() else pdf_path.name
+    try:
+        # A single small write with O_APPEND is atomic, even with several writers
+        with _open_access_log(pdf_path.parent, fcntl.LOCK_SH) as fd:
+            os.write(fd, f"{now:.0f} {name}\n".encode())
+    except OSError as e:
+        logger.debug("Cannot record the access to %s: %s", name, e)
+
+
+@contextmanager
+def _open_access_log(data_path, operation):
+    """Open the access log of ``data_path`` for appending and lock it (shared or exclusive).
+    If the log is replaced while waiting for the lock, the new one is opened"""
+    log_path = Path(data_path) / ACCESS_LOG_FILENAME
+    while True:
+        fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            fcntl.flock(fd, operation)
+            if os.fstat(fd).st_ino == os.stat(log_path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def read_access_log(data_path):
+    """Last access time of every set recorded in the access log of ``data_path``"""
+    last_access = {}
+    try:
+        with (Path(data_path) / ACCESS_LOG_FILENAME).open() as log_file:
+            for line in log_file:
+                timestamp, _, name = line.strip().partition(" ")
+                try:
+                    last_access[name] = max(last_access.get(name, 0.0), float(timestamp))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return last_access
+
+
+def _compact_access_log(data_path, removed=()):
+    """Rewrite the access log with a single line per set, dropping the ``removed`` sets.
+    The log is locked so that no access recorded meanwhile is lost"""
+    log_path = Path(data_path) / ACCESS_LOG_FILENAME
+    with _open_access_log(data_path, fcntl.LOCK_EX):
+        last_access = read_access_log(data_path)
+        lines = [
+            f"{timestamp:.0f} {name}\n"
+            for name, timestamp in sorted(last_access.items())
+            if name not in removed
+        ]
+        fd, tmp_path = tempfile.mkstemp(prefix=f"{log_path.name}.", dir=data_path)
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                tmp_file.write("".join(lines))
+            os.replace(tmp_path, log_path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+
+@dataclass
+class SetUsage:
+    """Disk usage of an installed set: its folder, tarball and any other cached file.
+    The grids shared in memory are removed together with the set
+    but they do not count towards its size"""
+
+    name: str
+    paths: list = field(default_factory=list)
+    size: int = 0
+    last_access: float = 0.0
+    shared: list = field(default_factory=list)
+
+
+def _path_size(path):
+    """Disk usage of a file or folder (counting every inode only once)"""
+    if path.is_symlink() or path.is_file():
+        return path.lstat().st_blocks * 512
+    total = 0
+    seen = set()
+    for root, _, files in os.walk(path):
+        for filename in files:
+            stat = os.lstat(os.path.join(root, filename))
+            if stat.st_ino not in seen:
+                seen.add(stat.st_ino)
+                total += stat.st_blocks * 512
+    return total
+
+
+def _shared_grids(name):
+    """Grids of the set shared in memory (see shared_grids)"""
+    shm = Path("/dev/shm")
+    if not shm.is_dir():
+        return []
+    pattern = re.compile(rf"{_SHARED_PREFIX}{re.escape(name)}_[0-9a-f]{{8}}")
+    return [i for i in shm.glob(f"{_SHARED_PREFIX}{name}_*") if pattern.fullmatch(i.name)]
+
+
+def disk_usage(data_path=None, jobs=DEFAULT_JOBS):
+    """Compute concurrently the disk usage of all sets installed in ``data_path``
+
+    Returns
+    -------
+        usage: list(SetUsage)
+            sorted from the least to the most recently used
+    """
+    if data_path is None:
+        data_path = environment.datapath
+    data_path = Path(data_path)
+
+    sets = {}
+    for info_file in data_path.glob("*/*.info"):
+        name = info_file.stem
+        if name == info_file.parent.name:
+            sets.setdefault(name, SetUsage(name)).paths.append(info_file.parent)
+    for tarball in data_path.glob(f"*{TARBALL_SUFFIX}"):
+        name = tarball.name[: -len(TARBALL_SUFFIX)]
+        sets.setdefault(name, SetUsage(name)).paths.append(tarball)
+    # Note that lock files are never removed (see management._install_lock)
+    for name, set_usage in sets.items():
+        set_usage.shared = _shared_grids(name)
+
+    last_access = read_access_log(data_path)
+
+    def _measure(set_usage):
+        set_usage.size = sum(_path_size(i) for i in set_usage.paths)
+        # Sets never opened are considered accessed when they were installed
+        installed = max(i.lstat().st_mtime for i in set_usage.paths)
+        set_usage.last_access = last_access.get(set_usage.name, installed)
+        return set_usage
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        usage = list(executor.map(_measure, sets.values()))
+    return sorted(usage, key=lambda i: i.last_access)
+
+
+def _remove(set_usage, data_path):
+    """Remove all the files of a set, the folder is first moved away
+    so that it disappears at once for any reader"""
+    for path in set_usage.paths + set_usage.shared:
+        if path.is_dir() and not path.is_symlink():
+            trash = Path(tempfile.mkdtemp(prefix=f".{set_usage.name}.", dir=data_path))
+            path.rename(trash / path.name)
+            shutil.rmtree(trash, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+
+
+def prune_pdfs(keep_size=None, older_than=None, data_path=None, dry=False, exclude=()):
+    """Remove the least recently used sets from ``data_path``
+
+    Parameters
+    ----------
+        keep_size: int
+            remove sets (least recently used first) until the total size is below this (bytes)
+        older_than: float
+            remove all sets not accessed in this many seconds
+        data_path: Path
+            folder with the sets, by default ``environment.datapath``
+        dry: bool
+            only report which sets would be removed
+        exclude: list(str)
+            names of sets that must never be removed
+
+    Returns
+    -------
+        removed: list(SetUsage)
+    """
+    if data_path is None:
+        data_path = environment.datapath
+    data_path = Path(data_path)
+    if dry:
+        return _prune(keep_size, older_than, data_path, dry, exclude)
+    # Concurrent pruners would pick the same sets
+    with _prune_lock(data_path):
+        return _prune(keep_size, older_than, data_path, dry, exclude)
+
+
+@contextmanager
+def _prune_lock(data_path):
+    """Exclusive lock over the pruning of the sets of ``data_path``"""
+    with (data_path / PRUNE_LOCK_FILENAME).open("a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def _prune(keep_size, older_than, data_path, dry, exclude):
+    """See ``prune_pdfs``"""
+    usage = disk_usage(data_path)
+    total = sum(i.size for i in usage)
+    now = time.time()
+
+    removed = []
+    for set_usage in usage:
+        if set_usage.name in exclude:
+            continue
+        too_old = older_than is not None and now - set_usage.last_access > older_than
+        too_big = keep_size is not None and total > keep_size
+        if not (too_old or too_big):
+            continue
+        logger.info("Removing %s (last used %s)", set_usage.name, time.ctime(set_usage.last_access))
+        if not dry:
+            _remove(set_usage, data_path)
+        total -= set_usage.size
+        removed.append(set_usage)
+
+    if removed and not dry:
+        _compact_access_log(data_path, {i.name for i in removed})
+    return removed
+
+
+def enforce_quota(data_path=None, exclude=()):
+    """Prune the least recently used sets if the quota given by ``QUOTA_VARIABLE`` is exceeded"""
+    quota = os.environ.get(QUOTA_VARIABLE)
+    if not quota:
+        return []
+    return prune_pdfs(keep_size=parse_size(quota), data_path=data_path, exclude=exclude)
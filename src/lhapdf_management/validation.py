@@ -0,0 +1,165 @@
+"""
+Validation of installed PDF sets
+
+Every set is loaded in a separate process and the following checks are run
+for all members at once:
+
+    - all values of the grids are finite
+    - the knots in x and q2 are strictly increasing (and x in (0, 1])
+    - the subgrids are contiguous in q2
+    - the PDFs are positive (only a warning, negative PDFs are allowed)
+    - momentum and valence sum rules at the lowest scale (only for proton PDFs)
+
+The sum rules are integrated with the trapezoidal rule over the knots of the grid in log(x),
+so they are only satisfied within ``SUM_RULE_TOLERANCE``.
+"""
+
+import logging
+from multiprocessing import Pool
+from pathlib import Path
+import resource
+import time
+
+import numpy as np
+
+from .interpolation import stack_members
+from .pdfsets import PDF
+
+logger = logging.getLogger(__name__)
+
+# Members are loaded and checked in batches to limit the memory usage of big sets
+BATCH_SIZE = 100
+SUM_RULE_TOLERANCE = 0.05
+_PROTON = 2212
+_GLUON = 21
+# Number of valence quarks of the proton for every flavour
+_VALENCE = {1: 1.0, 2: 2.0, 3: 0.0}
+
+
+def _check_knots(stack):
+    """Check the knots of all subgrids, return a list of failures"""
+    failures = []
+    previous_q2 = None
+    for i, subgrid in enumerate(stack):
+        if np.any(np.diff(subgrid.x) <= 0) or subgrid.x[0] <= 0 or subgrid.x[-1] > 1:
+            failures.append(f"subgrid {i}: x knots are not strictly increasing in (0, 1]")
+        if np.any(np.diff(subgrid.q2) <= 0):
+            failures.append(f"subgrid {i}: q2 knots are not strictly increasing")
+        if previous_q2 is not None and not np.isclose(subgrid.q2[0], previous_q2):
+            failures.append(f"subgrid {i}: starts at q2={subgrid.q2[0]}, expected {previous_q2}")
+        previous_q2 = subgrid.q2[-1]
+    return failures
+
+
+def _integrate(subgrid, xf):
+    """Integrate f(x) dx = xf d(log x) with the trapezoidal rule over the x knots.
+    ``xf`` has the x axis second to last"""
+    log_x = np.log(subgrid.x)
+    widths = np.diff(log_x)
+    average = 0.5 * (xf[..., 1:, :] + xf[..., :-1, :])
+    return np.einsum("...ka,k->...a", average, widths)
+
+
+def _sum_rules(subgrid, members):
+    """Momentum and valence sum rules at the lowest q2 for the given members, returns failures"""
+    flavours = [_GLUON if int(i) == 0 else int(i) for i in subgrid.flav]
+    # Values at the lowest q2: (members, x, flavours)
+    xf = subgrid.values[:, :, 0, :]
+    failures = []
+
+    # The momentum is shared by all flavours (including the photon, if present)
+    momentum = _integrate(subgrid, xf * subgrid.x[None, :, None]).sum(axis=-1)
+    for member, value in zip(members, momentum):
+        if abs(value - 1.0) > SUM_RULE_TOLERANCE:
+            failures.append(f"member {member}: momentum sum rule gives {value:.4f}")
+
+    for quark, expected in _VALENCE.items():
+        if quark not in flavours or -quark not in flavours:
+            continue
+        valence = xf[..., [flavours.index(quark)]] - xf[..., [flavours.index(-quark)]]
+        value = _integrate(subgrid, valence)[..., 0]
+        for member, result in zip(members, value):
+            if abs(result - expected) > max(SUM_RULE_TOLERANCE * expected, SUM_RULE_TOLERANCE):
+                failures.append(f"member {member}: valence sum rule for {quark} gives {result:.4f}")
+    return failures
+
+
+def _check_members(stack, members, check_sum_rules):
+    """Run all checks in a batch of members, return (failures, warnings)"""
+    failures = []
+    warnings = []
+    for i, subgrid in enumerate(stack):
+        finite = np.isfinite(subgrid.values).all(axis=(1, 2, 3))
+        for member in np.asarray(members)[~finite]:
+            failures.append(f"member {member}: subgrid {i} contains NaN or Inf")
+        negative = (subgrid.values < 0).mean(axis=(1, 2, 3))
+        for member, fraction in zip(members, negative):
+            if fraction > 0:
+                warnings.append(f"member {member}: subgrid {i} has {fraction:.1%} negative values")
+    if check_sum_rules:
+        failures += _sum_rules(stack[0], members)
+    return failures, warnings
+
+
+def validate_set(pdf_path, batch_size=BATCH_SIZE):
+    """Load a PDF set and run all checks on every member
+
+    Returns
+    -------
+        report: dict
+            with the name of the set, the number of members, timings (s),
+            memory (bytes) of the grids and the peak resident memory of the process,
+            and the list of failures and warnings
+    """
+    pdf_path = Path(pdf_path)
+    report = {"path": str(pdf_path), "load_time": 0.0, "check_time": 0.0, "grid_bytes": 0}
+    failures = []
+    warnings = []
+    try:
+        start = time.perf_counter()
+        pdf = PDF(pdf_path, record=False)
+        report["name"] = pdf.name
+        members = pdf.members
+        report["members"] = len(members)
+        info = pdf.info
+        report["load_time"] += time.perf_counter() - start
+        check_sum_rules = (
+            info.get("Particle", _PROTON) == _PROTON and info.get("SetType", "parton") == "parton"
+        )
+
+        for first in range(0, len(members), batch_size):
+            batch = members[first : first + batch_size]
+            start = time.perf_counter()
+            stack = stack_members(pdf, batch)
+            loaded = time.perf_counter()
+            if first == 0:
+                failures += _check_knots(stack)
+            batch_failures, batch_warnings = _check_members(stack, batch, check_sum_rules)
+            failures += batch_failures
+            warnings += batch_warnings
+            report["check_time"] += time.perf_counter() - loaded
+            report["load_time"] += loaded - start
+            report["grid_bytes"] = max(report["grid_bytes"], sum(i.values.nbytes for i in stack))
+            pdf.clear_cache()
+    except Exception as e:
+        failures.append(f"could not be loaded: {type(e).__name__}: {e}")
+
+    report.setdefault("name", pdf_path.name)
+    # In linux ru_maxrss is given in kB
+    report["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    report["failures"] = failures
+    report["warnings"] = warnings
+    report["ok"] = not failures
+    total_time = report["load_time"] + report["check_time"]
+    logger.debug("Validated %s in %.2fs", report["name"], total_time)
+    return report
+
+
+def validate_pdfs(pdf_paths, jobs=None):
+    """Validate concurrently the given PDF sets, each set is validated in a separate process
+
+    Returns the list of reports (see ``validate_set``) in the same order as the input
+    """
+    # A fresh process per set so that the peak memory of every set is measured separately
+    with Pool(jobs, maxtasksperchild=1) as pool:
+        return pool.map(validate_set, pdf_paths, chunksize=1)
@@ -6,10 +6,15 @@ A working installation of LHAPDF is necessary to be able to run these tests.
 import os
 from pathlib import Path
 import subprocess as sp
+import tarfile
 
 import lhapdf
+import numpy as np
 import pytest
 
+from lhapdf_management.configuration import environment
+from lhapdf_management.pdfsets import TARBALL_SUFFIX, GridPDF, write_pdf
+
 # Environment variables for LHAPDF data path
 DATA_PATH_VAR = "LHAPDF_DATA_PATH"
 BASE_ENV = dict(os.environ)
@@ -31,6 +36,10 @@ PATTERNS = [
 
 ALL_PDFSETS = PDFSETS + PATTERNS
 
+# Small fake set used by the tests which do not need a real PDF
+TEST_SET = "TEST_SET"
+TEST_SET_ID = 990000
+
 
 def run_for_path(command, datapath, capture=False):
     """Run the given command for the given LHAPDF_DATA_PATH."""
@@ -73,6 +82,55 @@ def lhapdf_path():
     return ret
 
 
+def make_test_set(folder, name=TEST_SET, nmembers=5):
+    """Write down a small (fake) Monte Carlo PDF set in ``folder`` together with its tarball"""
+    x = np.geomspace(1e-5, 1.0, 12)
+    flavours = [-2, -1, 1, 2, 21]
+    members = []
+    for member in range(nmembers):
+        grids = []
+        for q in ([1.65, 2.0, 4.0], [4.0, 10.0, 100.0]):
+            shape = np.outer(x**-0.2 * (1.0 - x) ** 3, np.arange(1, len(flavours) + 1))
+            values = np.repeat(shape * (1.0 + 0.01 * member), len(q), axis=0)
+            grids.append(GridPDF(x, np.array(q) ** 2, flavours, values))
+        members.append(grids)
+    info = {
+        "SetDesc": "test set",
+        "Format": "lhagrid1",
+        "DataVersion": 1,
+        "ErrorType": "replicas",
+        "Flavors": flavours,
+    }
+    set_dir = Path(folder) / name
+    write_pdf(set_dir, info, members, jobs=1)
+    with tarfile.open(Path(folder) / f"{name}{TARBALL_SUFFIX}", "w:gz") as tar_file:
+        tar_file.add(set_dir, arcname=name)
+    return set_dir
+
+
+@pytest.fixture
+def local_source(tmp_path):
+    """Local source (e.g., CVMFS) containing ``TEST_SET`` both unpacked and as a tarball"""
+    source = tmp_path / "source"
+    source.mkdir()
+    make_test_set(source)
+    return source
+
+
+@pytest.fixture
+def local_datapath(tmp_path, local_source, monkeypatch):
+    """Isolated environment with an empty data path (with an index) and ``local_source``
+    as the only source"""
+    datapath = tmp_path / "datapath"
+    datapath.mkdir()
+    (datapath / environment.index_filename).write_text(f"{TEST_SET_ID} {TEST_SET} 1\n")
+    monkeypatch.setattr(environment, "_sources", [f"{local_source.as_posix()}/"])
+    monkeypatch.setattr(environment, "_paths", [datapath])
+    monkeypatch.setattr(environment, "_datapath", datapath)
+    monkeypatch.setattr(environment, "_listdir", None)
+    return datapath
+
+
 def compare_command_output(cmd, data_path, lhapdf_path, *args):
     """Compare the show command between LHAPDF and lhapdf-management."""
     old_raw = run_for_path(["lhapdf", cmd] + list(args), lhapdf_path, capture=True)
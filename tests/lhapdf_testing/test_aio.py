@@ -0,0 +1,116 @@
+"""
+Test the asyncio interface against a local HTTP server
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+import pytest
+
+from lhapdf_management import aio, management, manifest, usage
+from lhapdf_management.configuration import environment
+from lhapdf_management.pdfsets import PDF, TARBALL_SUFFIX
+
+from .conftest import TEST_SET, make_test_set
+
+
+@pytest.fixture(scope="module", autouse=True)
+def install_before_running():
+    """Override ``install_before_running``, these tests do not need the real PDF sets"""
+    pass
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_source(local_source, local_datapath, monkeypatch):
+    """Serve the local source through HTTP, the only source of the environment"""
+    handler = functools.partial(_QuietHandler, directory=local_source.as_posix())
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    monkeypatch.setattr(environment, "_sources", [url])
+    yield url
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _run(coroutine, workers=2):
+    """Run the coroutine with a small default executor"""
+
+    async def _main():
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(workers))
+        return await asyncio.wait_for(coroutine, 60)
+
+    return asyncio.run(_main())
+
+
+def test_install(http_source, local_datapath):
+    assert _run(aio.install_pdf(TEST_SET, keep=True))
+    set_dir = local_datapath / TEST_SET
+    assert PDF(set_dir).members == list(range(5))
+    assert management.verify_pdfs([set_dir]) == {set_dir: []}
+    assert (local_datapath / f"{TEST_SET}{TARBALL_SUFFIX}").is_file()
+    assert not _run(aio.install_pdf(TEST_SET))
+
+
+@pytest.mark.parametrize("asynchronous", [True, False])
+def test_tarball_hashed_once(http_source, local_source, local_datapath, monkeypatch, asynchronous):
+    """The hash of a downloaded tarball is computed while it is downloaded, not again"""
+
+    def _no_hashing(*args):
+        raise AssertionError("The tarball has already been hashed")
+
+    monkeypatch.setattr(manifest, "HashingReader", _no_hashing)
+    if asynchronous:
+        assert _run(aio.install_pdf(TEST_SET))
+    else:
+        assert management.install_pdf(TEST_SET)
+    installed = manifest.read_manifest(local_datapath / TEST_SET)
+    assert installed["source"].startswith(http_source)
+    assert installed["tarball_sha256"] == manifest.hash_file(
+        local_source / f"{TEST_SET}{TARBALL_SUFFIX}"
+    )
+
+
+def test_more_waiters_than_workers(http_source, local_datapath):
+    """Waiting for the install lock does not take the threads of the executor"""
+    async def _install_all():
+        return await asyncio.gather(*(aio.install_pdf(TEST_SET, upgrade=True) for _ in range(4)))
+
+    results = _run(_install_all(), workers=2)
+    assert results == [True] * 4
+    set_dir = local_datapath / TEST_SET
+    assert management.verify_pdfs([set_dir]) == {set_dir: []}
+    assert sorted(i.name for i in local_datapath.glob(f".{TEST_SET}*")) == [f".{TEST_SET}.lock"]
+
+
+def test_archive_only_quota(http_source, local_datapath, monkeypatch):
+    """The quota is enforced after asynchronous installations too"""
+    make_test_set(local_datapath, "OLD_SET")
+    monkeypatch.setenv(usage.QUOTA_VARIABLE, "1")
+    assert _run(aio.install_pdf(TEST_SET, archive_only=True))
+    assert (local_datapath / f"{TEST_SET}{TARBALL_SUFFIX}").is_file()
+    assert not (local_datapath / TEST_SET).exists()
+    assert not (local_datapath / "OLD_SET").exists()
+
+
+def test_unsupported_options(http_source, local_datapath):
+    with pytest.raises(ValueError):
+        _run(aio.install_pdf(TEST_SET, members=[0, 1]))
+    with pytest.raises(ValueError):
+        _run(aio.install_pdf(TEST_SET, link_mode="symlink"))
+
+    assert management.install_pdf(TEST_SET, members=[0, 1])
+    with pytest.raises(ValueError):
+        _run(aio.install_pdf(TEST_SET, upgrade=True))
+    assert PDF(local_datapath / TEST_SET).members == [0, 1]
@@ -0,0 +1,113 @@
+"""
+Test the catalog of installed sets and its query language
+"""
+
+import shutil
+
+import pytest
+
+from lhapdf_management import catalog, pdfsets
+from lhapdf_management.catalog import Catalog, parse_where
+from lhapdf_management.configuration import environment
+
+from .conftest import make_test_set
+
+
+@pytest.fixture(scope="module", autouse=True)
+def install_before_running():
+    """Override ``install_before_running``, these tests do not need the real PDF sets"""
+    pass
+
+
+@pytest.fixture
+def datapath(tmp_path, monkeypatch):
+    """A datapath with an installed set (SET_A) and an archive-only set (SET_B)"""
+    datapath = tmp_path / "datapath"
+    make_test_set(datapath, "SET_A", nmembers=5)
+    make_test_set(datapath, "SET_B", nmembers=3)
+    shutil.rmtree(datapath / "SET_B")
+    (datapath / "SET_A.tar.gz").unlink()
+    monkeypatch.setattr(environment, "_paths", [datapath])
+    monkeypatch.setattr(environment, "_datapath", datapath)
+    return datapath
+
+
+def test_refresh(datapath, monkeypatch):
+    """Sets are parsed once and parsed again only when they change"""
+
+    def _no_tarball_source(*args):
+        raise AssertionError("The whole tarball should not be read")
+
+    monkeypatch.setattr(pdfsets._TarballSource, "__init__", _no_tarball_source)
+    with Catalog() as db:
+        assert db.refresh() == 2
+        assert db.refresh() == 0
+        assert db.query() == ["SET_A", "SET_B"]
+        assert db.info("SET_B")["NumMembers"] == 3
+
+        info_file = datapath / "SET_A" / "SET_A.info"
+        info_file.write_text(info_file.read_text().replace("test set", "modified set"))
+        assert db.refresh() == 1
+        assert db.query("SetDesc='modified set'") == ["SET_A"]
+
+        (datapath / "SET_B.tar.gz").unlink()
+        assert db.refresh() == 0
+        assert db.query() == ["SET_A"]
+        with pytest.raises(KeyError):
+            db.info("SET_B")
+    assert catalog.query("NumMembers=5", refresh=False) == ["SET_A"]
+
+
+@pytest.mark.parametrize(
+    "where, expected",
+    [
+        ("NumMembers>4", ["SET_A"]),
+        ("NumMembers<=3", ["SET_B"]),
+        ("numMembers>0", []),
+        ("not NumMembers=5", ["SET_B"]),
+        ("NumMembers!=5", ["SET_B"]),
+        ("SetDesc~'test*'", ["SET_A", "SET_B"]),
+        ("ErrorType=replicas AND (NumMembers=3 or NumMembers=5)", ["SET_A", "SET_B"]),
+        ("Format=lhagrid1 and not (NumMembers<4 or DataVersion!=1)", ["SET_A"]),
+        ("Flavors~'*21*'", ["SET_A", "SET_B"]),
+    ],
+)
+def test_query(datapath, where, expected):
+    with Catalog() as db:
+        db.refresh()
+        assert db.query(where) == expected
+
+
+@pytest.mark.parametrize(
+    "where",
+    [
+        "NumMembers>",
+        "NumMembers",
+        "(NumMembers=5",
+        "NumMembers=5)",
+        "NumMembers=5 and",
+        "and NumMembers=5",
+        "NumMembers=5 NumMembers=3",
+        "NumMembers==5",
+        "NumMembers=5; DROP TABLE sets",
+        "NumMembers=5 or 1=1",
+        "NumMembers=5 -- comment",
+        "name=SET_A) OR (1",
+    ],
+)
+def test_malformed_query(datapath, where):
+    with pytest.raises(ValueError):
+        parse_where(where)
+
+
+def test_injection(datapath):
+    """Values are always passed as parameters, never as part of the SQL"""
+    where = """SetDesc="x' OR '1'='1" and Format~'*'"""
+    condition, params = parse_where(where)
+    assert "x' OR" not in condition and "*" not in condition
+    assert params == ["SetDesc", "x' OR '1'='1", "Format", "*"]
+    with Catalog() as db:
+        db.refresh()
+        assert db.query(where) == []
+        assert db.query("SetDesc='test set; DROP TABLE sets'") == []
+        assert db.query() == ["SET_A", "SET_B"]
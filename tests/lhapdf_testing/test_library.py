@@ -2,9 +2,23 @@
 Test the library features of lhapdf-management
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import json
 from pathlib import Path
+from subprocess import CalledProcessError
+
+import lhapdf
+import numpy as np
+import pytest
 
 import lhapdf_management as lha
+from lhapdf_management.compressor import compress_replicas, select_replicas
+from lhapdf_management.pdfsets import PDF, GridPDF, write_pdf
+from lhapdf_management.regrid import regrid
+from lhapdf_management.rotations import basis_labels, rotate_members, rotation_matrix
+from lhapdf_management.validation import validate_set
+
+from .conftest import PDFSETS, run_for_path
 
 
 def test_prepend():
@@ -19,3 +33,108 @@ def test_append():
     test_path = Path("/test/path")
     lha.pathsAppend(test_path)
     assert lha.paths()[-1] == test_path
+
+
+def test_write_pdf(lhapdf_path, tmp_path):
+    """Check that a PDF written by lhapdf-management can be read back, also by LHAPDF"""
+    original = PDF(lhapdf_path / PDFSETS[0])
+    copy = original.write(tmp_path / "COPY_SET")
+    assert len(copy) == len(original)
+    for member in (0, len(original) - 1):
+        for old, new in zip(original.get_member_grids(member), copy.get_member_grids(member)):
+            np.testing.assert_allclose(new.x, old.x)
+            np.testing.assert_allclose(new.q2, old.q2)
+            np.testing.assert_allclose(new.grid, old.grid, rtol=1e-7)
+
+    lhapdf.pathsPrepend(tmp_path.as_posix())
+    old_pdf = lhapdf.mkPDF(PDFSETS[0], 0)
+    new_pdf = lhapdf.mkPDF("COPY_SET", 0)
+    for x in (1e-4, 0.1, 0.5):
+        assert np.isclose(new_pdf.xfxQ2(21, x, 100.0), old_pdf.xfxQ2(21, x, 100.0))
+
+
+def test_regrid(lhapdf_path, tmp_path):
+    """Regridding onto the original knots must give back the original grids"""
+    original = PDF(lhapdf_path / PDFSETS[0])
+    grids = original.get_member_grids(0)
+    q_knots = np.sqrt(np.concatenate([i.q2 for i in grids]))
+    new = regrid(original, grids[0].x, q_knots, tmp_path / "REGRID_SET", members=[0, 1])
+    assert len(new) == 2
+    for member in (0, 1):
+        for old, regridded in zip(original.get_member_grids(member), new.get_member_grids(member)):
+            np.testing.assert_allclose(regridded.q2, old.q2)
+            np.testing.assert_allclose(regridded.grid, old.grid, rtol=1e-7, atol=1e-12)
+
+
+def test_sum_rules(lhapdf_path, tmp_path):
+    """The sum rules are satisfied by a real set and fail for a deliberately scaled grid"""
+    pdf = PDF(lhapdf_path / PDFSETS[0])
+    report = validate_set(pdf.path)
+    assert report["ok"], report["failures"]
+
+    scaled = {
+        i: [GridPDF(g.x, g.q2, g.flav, 1.2 * g.grid) for g in pdf.get_member_grids(i)]
+        for i in (0, 1)
+    }
+    scaled_pdf = write_pdf(tmp_path / "SCALED_SET", pdf.info, scaled, jobs=1)
+    report = validate_set(scaled_pdf.path)
+    assert not report["ok"]
+    assert report["members"] == 2
+    for member in (0, 1):
+        for check in ("momentum sum rule", "valence sum rule for 1", "valence sum rule for 2"):
+            assert any(i.startswith(f"member {member}: {check} gives") for i in report["failures"])
+
+
+def test_compress_replicas(lhapdf_path, tmp_path):
+    """The compressed set must be better than a random selection and have a proper central member"""
+    original = PDF(lhapdf_path / "NNPDF40_nlo_as_01180")
+    random_selection = select_replicas(original, 10, trials=1, iterations=0, jobs=1)
+    compressed = compress_replicas(original, 10, tmp_path / "COMPRESSED_SET", iterations=200)
+    assert len(compressed) == 11
+    assert compressed.error_type == "replicas"
+    replicas = [compressed.get_member_grids(i)[0].grid for i in range(1, 11)]
+    np.testing.assert_allclose(compressed.get_member_grids(0)[0].grid, np.mean(replicas, axis=0))
+    assert select_replicas(original, 10, iterations=200).erf < random_selection.erf
+
+
+def test_prefetch(data_path, tmp_path):
+    """Prefetch the sets of a job manifest, unknown sets are reported as failed"""
+    manifest = tmp_path / "job.yaml"
+    manifest.write_text(f"{PDFSETS[0]}: 0-2\n{PDFSETS[1]}:\nNOT_A_PDF_SET: 0\n")
+    status_file = tmp_path / "status.json"
+    command = ["lhapdf-management", "prefetch", manifest.as_posix(), "--status", status_file]
+    # The command fails since one of the sets cannot be prefetched
+    with pytest.raises(CalledProcessError):
+        run_for_path([str(i) for i in command], data_path)
+    status = json.loads(status_file.read_text())
+    assert status[PDFSETS[0]] == {"state": "ready", "members": 3, "error": None}
+    assert status[PDFSETS[1]]["state"] == "ready"
+    assert status["NOT_A_PDF_SET"]["state"] == "failed"
+
+
+def test_evolution_basis(lhapdf_path):
+    """Check the rotation to the evolution basis of a set without photon nor top"""
+    pdf = PDF(lhapdf_path / PDFSETS[0])
+    rotated = rotate_members(pdf, members=[0, 1])
+    labels = basis_labels("evolution")
+    grids = pdf.get_member_grids(1)
+    for subgrid, rotated_subgrid in zip(grids, rotated):
+        flavours = [int(i) for i in subgrid.flav]
+        assert 22 not in flavours and 6 not in flavours
+        up, ubar, down, dbar = (subgrid.grid[:, flavours.index(i)] for i in (2, -2, 1, -1))
+        t3 = rotated_subgrid[1, :, labels.index("T3")]
+        np.testing.assert_allclose(t3, up + ubar - down - dbar)
+        assert not rotated_subgrid[..., labels.index("photon")].any()
+    # The matrix is built only once
+    assert rotation_matrix(grids[0].flav) is rotation_matrix(grids[0].flav)
+
+
+def test_concurrent_members(lhapdf_path):
+    """Check that a member requested from many threads is parsed only once"""
+    pdf = PDF(lhapdf_path / PDFSETS[0])
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(pdf.get_member_grids, [1] * 32))
+    assert all(i is results[0] for i in results)
+    prefetched = pdf.prefetch([1, 2])
+    assert prefetched[0].result() is results[0]
+    assert prefetched[1].result() is pdf.get_member_grids(2)
@@ -0,0 +1,66 @@
+"""
+Test the parton luminosities with a small fake set
+"""
+
+import numpy as np
+import pytest
+
+from lhapdf_management.interpolation import interpolate, stack_members
+from lhapdf_management.pdfsets import PDF
+
+from .conftest import make_test_set
+
+
+@pytest.fixture(scope="module", autouse=True)
+def install_before_running():
+    """Override ``install_before_running``, these tests do not need the real PDF sets"""
+    pass
+
+
+MASSES = [20.0, 90.0]
+SQRTS = 2000.0
+
+
+@pytest.fixture
+def test_pdf(tmp_path):
+    return PDF(make_test_set(tmp_path))
+
+
+def _direct_luminosity(pdf, flavour_a, flavour_b, mass, points=20001):
+    """Convolution 1/s int_tau^1 dx/x f_a(x) f_b(tau/x) for all members
+    as a trapezoidal integral in log(x)"""
+    stack = stack_members(pdf)
+    index = {int(i): n for n, i in enumerate(stack[0].flav)}
+    tau = (mass / SQRTS) ** 2
+    log_x = np.linspace(np.log(tau), 0.0, points)
+    q2 = np.full_like(log_x, mass**2)
+    xf1 = interpolate(stack, np.exp(log_x), q2)[..., index[flavour_a]]
+    xf2 = interpolate(stack, tau / np.exp(log_x), q2)[..., index[flavour_b]]
+    # f_a(x1) f_b(x2) = xf_a xf_b / tau
+    integrand = xf1 * xf2
+    integral = np.sum(integrand[:, 1:] + integrand[:, :-1], axis=-1) * np.diff(log_x)[0] / 2
+    return integral / (tau * SQRTS**2)
+
+
+@pytest.mark.parametrize("channel, pair", [("gg", (21, 21)), ((2, -1), (2, -1))])
+def test_direct_convolution(test_pdf, channel, pair):
+    """The quadrature in rapidity agrees with a direct convolution of the grids"""
+    lumi = test_pdf.luminosity(MASSES, SQRTS, channel=channel, nodes=256)
+    assert lumi.values.shape == (len(test_pdf), len(MASSES))
+    for i, mass in enumerate(MASSES):
+        expected = _direct_luminosity(test_pdf, *pair, mass)
+        np.testing.assert_allclose(lumi.values[:, i], expected, rtol=1e-3)
+    np.testing.assert_allclose(lumi.central, lumi.values[1:].mean(axis=0))
+
+
+def test_symmetry(test_pdf):
+    """Exchanging the two partons does not change the luminosity"""
+    gg = test_pdf.luminosity(MASSES, SQRTS, channel="gg").values
+    np.testing.assert_allclose(gg, test_pdf.luminosity(MASSES, SQRTS, channel=(0, 21)).values)
+
+    qqbar = test_pdf.luminosity(MASSES, SQRTS, channel="qqbar").values
+    pairs = [(1, -1), (-1, 1), (2, -2), (-2, 2)]
+    by_pair = {i: test_pdf.luminosity(MASSES, SQRTS, channel=i).values for i in pairs}
+    np.testing.assert_allclose(by_pair[(2, -2)], by_pair[(-2, 2)], rtol=1e-12)
+    np.testing.assert_allclose(by_pair[(1, -1)], by_pair[(-1, 1)], rtol=1e-12)
+    np.testing.assert_allclose(qqbar, sum(by_pair.values()), rtol=1e-12)
@@ -0,0 +1,217 @@
+"""
+Test the installation machinery of lhapdf-management with a small fake set
+available in a local source (no network access nor LHAPDF needed)
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import io
+import tarfile
+
+import numpy as np
+import pytest
+
+from lhapdf_management import management, usage
+from lhapdf_management.pdfsets import PDF, TARBALL_SUFFIX
+
+from .conftest import TEST_SET, make_test_set
+
+
+@pytest.fixture(scope="module", autouse=True)
+def install_before_running():
+    """Override ``install_before_running``, these tests do not need the real PDF sets"""
+    pass
+
+
+def test_archive_only(local_datapath, local_source):
+    """Sets installed in archive-only mode are read directly from the tarball"""
+    assert management.install_pdf(TEST_SET, archive_only=True)
+    tarball = local_datapath / f"{TEST_SET}{TARBALL_SUFFIX}"
+    assert tarball.is_file()
+    assert not (local_datapath / TEST_SET).exists()
+
+    archived = PDF(tarball)
+    original = PDF(local_source / TEST_SET)
+    assert archived.info == original.info
+    for member in original.members:
+        for old, new in zip(original.get_member_grids(member), archived.get_member_grids(member)):
+            np.testing.assert_allclose(new.grid, old.grid)
+
+    # The decompressed files are forgotten together with the parsed members
+    assert archived._source._cache
+    archived.clear_cache()
+    assert not archived._source._cache
+
+
+def test_archive_metadata(local_datapath, local_source, tmp_path):
+    """The metadata of an archive-only set is read without decompressing the whole tarball"""
+    assert management.install_pdf(TEST_SET, archive_only=True)
+    tarball = local_datapath / f"{TEST_SET}{TARBALL_SUFFIX}"
+    archived = PDF(tarball)
+    assert archived.info == PDF(local_source / TEST_SET).info
+    assert archived._source._members is None
+    archived.get_member_grids(3)
+    assert archived._source._tar is not None
+    archived.close()
+    assert archived._source._tar is None
+    # The tarball is opened again when needed
+    assert len(archived.get_member_grids(4)) == 2
+
+    # Only the beginning of the tarball is needed for the metadata
+    truncated = tmp_path / "truncated" / tarball.name
+    truncated.parent.mkdir()
+    truncated.write_bytes(tarball.read_bytes()[: tarball.stat().st_size // 2])
+    partial = PDF(truncated)
+    assert partial.info == archived.info
+    with pytest.raises((EOFError, tarfile.ReadError)):
+        partial.get_member_grids(4)
+
+
+def test_archive_only_quota(local_datapath, monkeypatch):
+    """Archive-only installations also make space for the new set"""
+    make_test_set(local_datapath, "OLD_SET")
+    monkeypatch.setenv(usage.QUOTA_VARIABLE, "1")
+    assert management.install_pdf(TEST_SET, archive_only=True)
+    assert (local_datapath / f"{TEST_SET}{TARBALL_SUFFIX}").is_file()
+    assert not (local_datapath / "OLD_SET").exists()
+
+
+@pytest.fixture
+def count_extractions(monkeypatch):
+    """Count the calls to ``management._extract_tarball``"""
+    calls = []
+    extract_tarball = management._extract_tarball
+
+    def _counting_extract(*args, **kwargs):
+        calls.append(args[0])
+        return extract_tarball(*args, **kwargs)
+
+    monkeypatch.setattr(management, "_extract_tarball", _counting_extract)
+    return calls
+
+
+def test_install_after_lock_release(local_datapath, count_extractions, monkeypatch):
+    """Another process installs the set between the existence check and the lock,
+    the set must not be installed a second time"""
+    install_lock = management._install_lock
+
+    def _late_lock(target_path, name):
+        monkeypatch.setattr(management, "_install_lock", install_lock)
+        assert management.install_pdf(name, target_path=target_path)
+        return install_lock(target_path, name)
+
+    monkeypatch.setattr(management, "_install_lock", _late_lock)
+    assert management.install_pdf(TEST_SET)
+    assert len(count_extractions) == 1
+    assert PDF(local_datapath / TEST_SET).members == list(range(5))
+
+
+def test_concurrent_installs(local_datapath, count_extractions):
+    """Concurrent installations of the same set download and extract it only once"""
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda _: management.install_pdf(TEST_SET), range(4)))
+    assert len(count_extractions) == 1
+    assert not management.verify_pdfs([local_datapath / TEST_SET])[local_datapath / TEST_SET]
+    # No staging directory is left behind
+    assert sorted(i.name for i in local_datapath.glob(f".{TEST_SET}*")) == [f".{TEST_SET}.lock"]
+
+
+def test_link_and_keep(local_datapath, local_source):
+    """A linked set has no tarball to keep, the installation must succeed regardless"""
+    assert management.install_pdf(TEST_SET, link_mode="symlink", keep=True)
+    installed = local_datapath / TEST_SET
+    assert installed.is_symlink()
+    assert installed.resolve() == (local_source / TEST_SET).resolve()
+    assert not (local_datapath / f"{TEST_SET}{TARBALL_SUFFIX}").exists()
+
+
+def test_upgrade_archive_only(local_datapath):
+    """Sets installed as archives are upgraded as archives"""
+    tarball = local_datapath / f"{TEST_SET}{TARBALL_SUFFIX}"
+    assert management.install_pdf(TEST_SET, archive_only=True)
+    set_info = next(i for i in management.get_reference_list() if i.name == TEST_SET)
+    installed = tarball.stat().st_ino
+
+    assert management.upgrade_pdfs([set_info]) == {TEST_SET: True}
+    assert tarball.stat().st_ino != installed
+    assert not (local_datapath / TEST_SET).exists()
+
+    assert management.install_pdf(TEST_SET, upgrade=True)
+    assert not (local_datapath / TEST_SET).exists()
+    assert PDF(tarball).members == list(range(5))
+
+
+@pytest.mark.parametrize("option", ["keep", "archive_only"])
+def test_members_incompatible_options(local_datapath, option):
+    """A selection of members is never kept as a tarball"""
+    with pytest.raises(ValueError):
+        management.install_pdf(TEST_SET, members=[0, 2], **{option: True})
+    assert not list(local_datapath.glob(f"{TEST_SET}*"))
+
+
+def test_upgrade_partial(local_datapath):
+    """Upgrading a partial installation keeps the selection of members"""
+    assert management.install_pdf(TEST_SET, members=[0, 2])
+    assert PDF(local_datapath / TEST_SET).members == [0, 2]
+
+    assert management.install_pdf(TEST_SET, upgrade=True)
+    assert PDF(local_datapath / TEST_SET).members == [0, 2]
+
+    set_info = next(i for i in management.get_reference_list() if i.name == TEST_SET)
+    assert management.upgrade_pdfs([set_info], keep=True) == {TEST_SET: True}
+    assert PDF(local_datapath / TEST_SET).members == [0, 2]
+    assert not (local_datapath / f"{TEST_SET}{TARBALL_SUFFIX}").exists()
+    assert not management.verify_pdfs([local_datapath / TEST_SET])[local_datapath / TEST_SET]
+
+
+def _crafted_tarball(path, members):
+    """Write down a tarball with the given (name, type, content or link target) members"""
+    with tarfile.open(path, "w:gz") as tar_file:
+        for name, member_type, content in members:
+            member = tarfile.TarInfo(name)
+            member.type = member_type
+            if member_type == tarfile.SYMTYPE:
+                member.linkname = content
+                tar_file.addfile(member)
+            else:
+                member.size = len(content)
+                tar_file.addfile(member, io.BytesIO(content))
+    return path
+
+
+@pytest.mark.parametrize("member_name", ["../x", "SET/../../x", "/abs"])
+def test_extract_outside(tmp_path, member_name):
+    """Members which would be extracted outside of the destination are rejected"""
+    dest_dir = tmp_path / "dest"
+    dest_dir.mkdir()
+    with pytest.raises(ValueError):
+        management._safe_path(dest_dir, member_name)
+
+    tarball = _crafted_tarball(
+        tmp_path / "crafted.tar.gz",
+        [("SET/SET.info", tarfile.REGTYPE, b"info"), (member_name, tarfile.REGTYPE, b"evil")],
+    )
+    with pytest.raises(ValueError):
+        management._extract_tarball(tarball, dest_dir, jobs=1)
+    assert not (tmp_path / "x").exists()
+    assert not any(i.read_bytes() == b"evil" for i in dest_dir.rglob("*") if i.is_file())
+
+
+def test_extract_symlink(tmp_path):
+    """Links are never extracted, files are not written through a link either"""
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    dest_dir = tmp_path / "dest"
+    dest_dir.mkdir()
+    tarball = _crafted_tarball(
+        tmp_path / "crafted.tar.gz",
+        [
+            ("SET/link", tarfile.SYMTYPE, outside.as_posix()),
+            ("SET/link/x", tarfile.REGTYPE, b"evil"),
+            ("SET/SET.info", tarfile.REGTYPE, b"info"),
+        ],
+    )
+    files, _ = management._extract_tarball(tarball, dest_dir, jobs=1)
+    assert sorted(files) == ["SET/SET.info", "SET/link/x"]
+    assert not (dest_dir / "SET" / "link").is_symlink()
+    assert (dest_dir / "SET" / "link" / "x").read_bytes() == b"evil"
+    assert not list(outside.iterdir())
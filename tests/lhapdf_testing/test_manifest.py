@@ -0,0 +1,68 @@
+"""
+Test the install manifests and the verification of installed sets
+"""
+
+import logging
+import os
+
+import pytest
+
+from lhapdf_management import management, manifest
+
+from .conftest import TEST_SET, make_test_set
+
+
+@pytest.fixture(scope="module", autouse=True)
+def install_before_running():
+    """Override ``install_before_running``, these tests do not need the real PDF sets"""
+    pass
+
+
+def test_verify_installed_set(local_datapath):
+    """All kind of damage done to an installed set is reported"""
+    assert management.install_pdf(TEST_SET)
+    set_dir = local_datapath / TEST_SET
+    installed = manifest.read_manifest(set_dir)
+    assert installed["source"]
+    assert sorted(installed["files"]) == sorted(i.name for i in set_dir.glob(f"{TEST_SET}*"))
+    assert manifest.verify_set(set_dir) == []
+
+    # Corrupt a file without changing its size, only its modification time changes
+    corrupted = set_dir / f"{TEST_SET}_0001.dat"
+    stat = corrupted.stat()
+    content = bytearray(corrupted.read_bytes())
+    content[-2] = ord("7") if content[-2] != ord("7") else ord("8")
+    corrupted.write_bytes(content)
+    os.utime(corrupted, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert corrupted.stat().st_size == stat.st_size
+
+    truncated = set_dir / f"{TEST_SET}_0002.dat"
+    with truncated.open("r+b") as opened_file:
+        opened_file.truncate(100)
+    (set_dir / f"{TEST_SET}_0003.dat").unlink()
+
+    problems = management.verify_pdfs([set_dir])[set_dir]
+    assert len(problems) == 3
+    assert f"{corrupted.name} is corrupted (hash mismatch)" in problems
+    expected_size = installed["files"][truncated.name]["size"]
+    assert f"{truncated.name} has size 100, expected {expected_size}" in problems
+    assert f"{TEST_SET}_0003.dat is missing" in problems
+
+
+def test_touched_file_is_intact(local_datapath):
+    """A file whose modification time changed but whose content did not is intact"""
+    assert management.install_pdf(TEST_SET)
+    touched = local_datapath / TEST_SET / f"{TEST_SET}_0000.dat"
+    stat = touched.stat()
+    os.utime(touched, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert manifest.verify_set(touched.parent) == []
+
+
+def test_no_manifest(tmp_path, caplog):
+    """Sets without a manifest cannot be verified, updating their manifest is a no-op"""
+    set_dir = make_test_set(tmp_path)
+    assert management.verify_pdfs([set_dir]) == {set_dir: None}
+    with caplog.at_level(logging.WARNING, logger=manifest.__name__):
+        manifest.replace_entries(set_dir, [f"{TEST_SET}_0000.dat"], {})
+    assert "No manifest found" in caplog.text
+    assert manifest.read_manifest(set_dir) is None
@@ -0,0 +1,54 @@
+"""
+Test the regridding of PDF sets with a small fake set
+"""
+
+import numpy as np
+import pytest
+
+from lhapdf_management.pdfsets import PDF
+from lhapdf_management.regrid import regrid
+
+from .conftest import make_test_set
+
+
+@pytest.fixture(scope="module", autouse=True)
+def install_before_running():
+    """Override ``install_before_running``, these tests do not need the real PDF sets"""
+    pass
+
+
+def _original_knots(pdf):
+    grids = pdf.get_member_grids(0)
+    return grids[0].x, np.sqrt(np.concatenate([i.q2 for i in grids]))
+
+
+def test_regrid_members(tmp_path):
+    """A selection of members keeps its numbering, member 1 does not become the central one"""
+    original = PDF(make_test_set(tmp_path / "source"))
+    x_knots, q_knots = _original_knots(original)
+    new = regrid(original, x_knots, q_knots, tmp_path / "REGRID_SET", members=[3, 1], jobs=1)
+    assert new.is_partial
+    assert new.members == [1, 3]
+    assert new.info["NumMembers"] == original.info["NumMembers"]
+    assert (new.path / "REGRID_SET_0001.dat").read_text().startswith("PdfType: replica")
+    for member in (1, 3):
+        for old, regridded in zip(original.get_member_grids(member), new.get_member_grids(member)):
+            np.testing.assert_allclose(regridded.q2, old.q2)
+            np.testing.assert_allclose(regridded.grid, old.grid, rtol=1e-7, atol=1e-12)
+
+    with pytest.raises(ValueError):
+        regrid(original, x_knots, q_knots, tmp_path / "OTHER_SET", members=[7], jobs=1)
+
+
+def test_regrid_parallel(tmp_path):
+    """The batches interpolated in parallel processes give the same set"""
+    original = PDF(make_test_set(tmp_path / "source"))
+    x_knots = np.geomspace(1e-4, 1.0, 7)
+    q_knots = np.geomspace(1.65, 100.0, 6)
+    serial = regrid(original, x_knots, q_knots, tmp_path / "SERIAL_SET", jobs=1)
+    parallel = regrid(original, x_knots, q_knots, tmp_path / "PARALLEL_SET", jobs=2)
+    assert not parallel.is_partial
+    assert parallel.members == serial.members == original.members
+    for member in original.members:
+        for one, other in zip(serial.get_member_grids(member), parallel.get_member_grids(member)):
+            np.testing.assert_allclose(other.grid, one.grid)
@@ -0,0 +1,61 @@
+"""
+Test the local PDF server
+"""
+
+import threading
+
+import numpy as np
+import pytest
+
+from lhapdf_management.interpolation import interpolate, stack_members
+from lhapdf_management.pdfsets import PDF
+from lhapdf_management.server import PDFClient, PDFServer
+
+from .conftest import TEST_SET
+
+
+@pytest.fixture(scope="module", autouse=True)
+def install_before_running():
+    """Override ``install_before_running``, these tests do not need the real PDF sets"""
+    pass
+
+
+def test_server(local_datapath, local_source, tmp_path):
+    """Start a server on a temporary socket, query a set and shut it down"""
+    socket_path = tmp_path / "server.sock"
+    server = PDFServer(socket_path, max_sets=1)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with PDFClient(socket_path) as client:
+            assert client.query([{"op": "ping"}]) == ["pong"]
+            # The set is found in the data path of the environment
+            (local_datapath / TEST_SET).symlink_to(local_source / TEST_SET)
+            remote = client.load(TEST_SET)
+            original = PDF(local_source / TEST_SET)
+            assert remote.info == original.info
+            assert remote.members == original.members
+            for old, new in zip(original.get_member_grids(2), remote.get_member_grids(2)):
+                np.testing.assert_array_equal(new.x, old.x)
+                np.testing.assert_array_equal(new.q2, old.q2)
+                np.testing.assert_array_equal(new.grid, old.grid)
+            # The interpolation is done in the server, for the selected members and flavours
+            x = np.geomspace(1e-4, 0.9, 6).reshape(2, 3)
+            q2 = np.full_like(x, 10.0)
+            stack = stack_members(original, [1, 3])
+            flavours = [int(i) for i in stack[0].flav][::-1]
+            xf = remote.xfxQ2([1, 3], flavours, x, q2)
+            expected = interpolate(stack, x, q2)[..., ::-1]
+            assert xf.shape == (2, 2, 3, len(flavours))
+            np.testing.assert_allclose(xf, expected)
+            all_xf = remote.xfxQ2(None, None, x, 10.0)
+            np.testing.assert_allclose(all_xf[[1, 3]], expected[..., ::-1])
+            with pytest.raises(RuntimeError, match="ValueError"):
+                remote.xfxQ2([0], [12345], x, q2)
+            with pytest.raises(RuntimeError, match="FileNotFoundError"):
+                client.load("NOT_A_PDF_SET").info
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert not socket_path.exists()
@@ -0,0 +1,42 @@
+"""
+Test sharing the grids of a PDF set between processes
+"""
+
+import numpy as np
+import pytest
+
+from lhapdf_management.pdfsets import PDF
+from lhapdf_management.shared_grids import attach, publish
+
+from .conftest import TEST_SET
+
+
+@pytest.fixture(scope="module", autouse=True)
+def install_before_running():
+    """Override ``install_before_running``, these tests do not need the real PDF sets"""
+    pass
+
+
+def test_shared_grids(local_source, tmp_path):
+    """Publish a set, attach to it and check that the grids are the same (and read-only)"""
+    pdf = PDF(local_source / TEST_SET)
+    shared = publish(pdf, name=tmp_path / "shared_grids")
+    shared_pdf = attach(shared.name)
+    assert shared_pdf.name == pdf.name
+    assert shared_pdf.info == pdf.info
+    assert shared_pdf.members == pdf.members
+    for member in pdf.members:
+        for old, new in zip(pdf.get_member_grids(member), shared_pdf.get_member_grids(member)):
+            np.testing.assert_array_equal(new.x, old.x)
+            np.testing.assert_array_equal(new.q2, old.q2)
+            np.testing.assert_array_equal(new.flav, old.flav)
+            np.testing.assert_array_equal(new.grid, old.grid)
+    with pytest.raises(ValueError):
+        shared_pdf.get_member_grids(0)[0].grid[0, 0] = 1.0
+
+    shared.unlink()
+    assert not (tmp_path / "shared_grids").exists()
+    # Processes already attached keep their views
+    assert shared_pdf.get_member_grids(1)[0].grid.any()
+    with pytest.raises(FileNotFoundError):
+        attach(shared.name)
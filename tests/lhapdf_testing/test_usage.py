@@ -0,0 +1,131 @@
+"""
+Test the access tracking and the pruning of installed sets
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import threading
+import uuid
+
+import pytest
+
+from lhapdf_management import load_pdf_meta, management, usage
+from lhapdf_management.catalog import Catalog
+from lhapdf_management.configuration import environment
+from lhapdf_management.pdfsets import PDF, SetInfo
+from lhapdf_management.validation import validate_set
+
+from .conftest import make_test_set
+
+
+@pytest.fixture(scope="module", autouse=True)
+def install_before_running():
+    """Override ``install_before_running``, these tests do not need the real PDF sets"""
+    pass
+
+
+@pytest.fixture
+def datapath(tmp_path, monkeypatch):
+    datapath = tmp_path / "datapath"
+    datapath.mkdir()
+    monkeypatch.setattr(environment, "_paths", [datapath])
+    monkeypatch.setattr(environment, "_datapath", datapath)
+    monkeypatch.setattr(usage, "_recorded", {})
+    return datapath
+
+
+def test_record_only_usage(datapath):
+    """Inspecting a set does not count as using it"""
+    set_dir = make_test_set(datapath, "SET_A")
+    PDF(set_dir, record=False).get_member_grids(0)
+    SetInfo("SET_A", 1).load(record=False)
+    validate_set(set_dir)
+    management._installed_version(SetInfo("SET_A", 1))
+    with Catalog() as db:
+        db.refresh()
+    assert usage.read_access_log(datapath) == {}
+
+    load_pdf_meta("SET_A")
+    assert list(usage.read_access_log(datapath)) == ["SET_A"]
+
+    make_test_set(datapath, "SET_B")
+    SetInfo("SET_B", 2).load().get_member_grids(0)
+    assert sorted(usage.read_access_log(datapath)) == ["SET_A", "SET_B"]
+
+
+def test_record_continuous_usage(datapath, monkeypatch):
+    """A set in use for a long time is recorded again, but not at every read"""
+    set_dir = make_test_set(datapath, "SET_A")
+    pdf = PDF(set_dir)
+    pdf.get_member_grids(0)
+    pdf.get_member_grids(1)
+    log_path = datapath / usage.ACCESS_LOG_FILENAME
+    assert len(log_path.read_text().splitlines()) == 1
+
+    # Some time later, the members already loaded are still being used
+    monkeypatch.setitem(usage._recorded, set_dir, 0.0)
+    pdf.get_member_grids(0)
+    lines = log_path.read_text().splitlines()
+    assert len(lines) == 2
+    assert usage.read_access_log(datapath)["SET_A"] > 0.0
+
+
+def test_compaction_keeps_accesses(datapath):
+    """Accesses recorded while the log is being compacted are not lost"""
+    (datapath / usage.ACCESS_LOG_FILENAME).write_text("1 GONE\n2 KEPT\n3 KEPT\n")
+    names = [f"SET_{i}" for i in range(200)]
+    done = threading.Event()
+
+    def _compact():
+        while not done.is_set():
+            usage._compact_access_log(datapath, {"GONE"})
+
+    compactor = threading.Thread(target=_compact)
+    compactor.start()
+    try:
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(lambda i: usage.record_access(datapath / i), names))
+    finally:
+        done.set()
+        compactor.join()
+    usage._compact_access_log(datapath, {"GONE"})
+
+    last_access = usage.read_access_log(datapath)
+    assert sorted(last_access) == sorted(names + ["KEPT"])
+    assert last_access["KEPT"] == 3.0
+    # A single line per set and no temporary file left behind
+    assert len((datapath / usage.ACCESS_LOG_FILENAME).read_text().splitlines()) == len(names) + 1
+    assert not list(datapath.glob(f"{usage.ACCESS_LOG_FILENAME}.*"))
+
+
+def test_concurrent_prune(datapath):
+    """Concurrent pruners never pick the same set twice"""
+    for i in range(6):
+        make_test_set(datapath, f"SET_{i}")
+    with ThreadPoolExecutor(4) as executor:
+        results = list(
+            executor.map(lambda _: usage.prune_pdfs(keep_size=1, data_path=datapath), range(4))
+        )
+    removed = [i.name for result in results for i in result]
+    assert sorted(removed) == sorted(f"SET_{i}" for i in range(6))
+    assert usage.disk_usage(datapath) == []
+
+
+@pytest.mark.skipif(not Path("/dev/shm").is_dir(), reason="No shared memory folder")
+def test_shared_grids_not_counted(datapath):
+    """The grids shared in memory do not count towards the quota but are removed with the set"""
+    name = f"SET_{uuid.uuid4().hex[:8]}"
+    set_dir = make_test_set(datapath, name)
+    shared = Path("/dev/shm") / f"{usage._SHARED_PREFIX}{name}_0123abcd"
+    shared.write_bytes(bytes(1024**2))
+    try:
+        (set_usage,) = usage.disk_usage(datapath)
+        assert set_usage.shared == [shared]
+        assert shared not in set_usage.paths
+        assert set_usage.size == usage._path_size(set_dir) + usage._path_size(
+            datapath / f"{name}.tar.gz"
+        )
+        assert usage.prune_pdfs(keep_size=1, data_path=datapath) == [set_usage]
+        assert not shared.exists()
+    finally:
+        shared.unlink(missing_ok=True)
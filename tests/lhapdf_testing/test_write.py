@@ -0,0 +1,70 @@
+"""
+Test the writer of LHAPDF sets with a small fake set
+"""
+
+import numpy as np
+import pytest
+
+from lhapdf_management import manifest
+from lhapdf_management.pdfsets import PDF, write_pdf
+
+from .conftest import make_test_set
+
+
+@pytest.fixture(scope="module", autouse=True)
+def install_before_running():
+    """Override ``install_before_running``, these tests do not need the real PDF sets"""
+    pass
+
+
+def _assert_same_member(old_pdf, new_pdf, old_member, new_member=None):
+    new_member = old_member if new_member is None else new_member
+    for old, new in zip(old_pdf.get_member_grids(old_member), new_pdf.get_member_grids(new_member)):
+        np.testing.assert_allclose(new.x, old.x)
+        np.testing.assert_allclose(new.q2, old.q2)
+        np.testing.assert_allclose(new.grid, old.grid, rtol=1e-7)
+
+
+def test_write_copy(tmp_path):
+    """A copy of a full set is a full set with the same members"""
+    original = PDF(make_test_set(tmp_path / "source"))
+    copy = original.write(tmp_path / "COPY_SET")
+    assert not copy.is_partial
+    assert copy.members == original.members
+    assert copy.info == original.info
+    assert manifest.read_manifest(copy.path) is None
+    for member in original.members:
+        _assert_same_member(original, copy, member)
+
+
+def test_write_partial(tmp_path):
+    """Writing some of the members keeps their numbering and marks the set as partial"""
+    original = PDF(make_test_set(tmp_path / "source"))
+    members = {i: original.get_member_grids(i) for i in (3, 1)}
+    partial = write_pdf(tmp_path / "PARTIAL_SET", original.info, members, jobs=1)
+    assert partial.is_partial
+    assert partial.members == [1, 3]
+    assert partial.info["NumMembers"] == original.info["NumMembers"]
+    assert not (partial.path / "PARTIAL_SET_0000.dat").exists()
+    assert manifest.verify_set(partial.path) == []
+    for member in (1, 3):
+        _assert_same_member(original, partial, member)
+    assert partial.get_member_grids(3)[0].grid[0, 0] != partial.get_member_grids(1)[0].grid[0, 0]
+
+    # And a copy of the partial set is still partial
+    copy = partial.write(tmp_path / "COPY_SET", jobs=1)
+    assert copy.members == [1, 3]
+    for member in (1, 3):
+        _assert_same_member(original, copy, member)
+
+
+def test_write_list(tmp_path):
+    """Members given as a list are numbered from 0"""
+    original = PDF(make_test_set(tmp_path / "source"))
+    info = {**original.info}
+    info.pop("NumMembers")
+    new = write_pdf(tmp_path / "NEW_SET", info, [original.get_member_grids(4)], jobs=1)
+    assert new.members == [0]
+    assert new.info["NumMembers"] == 1
+    _assert_same_member(original, new, 4, 0)
+    assert (new.path / "NEW_SET_0000.dat").read_text().startswith("PdfType: central")